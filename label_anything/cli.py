@@ -122,6 +122,17 @@ def validate(parameters):
     default="default",
     help="Mean and std for normalization (can be default or standard) (Only for huggingface models)",
 )
+@click.option(
+    "--precision",
+    default="fp32",
+    type=click.Choice(["fp32", "fp16", "bf16", "int8"]),
+    help="Storage precision of the embeddings (int8 stores per-channel scales)",
+)
+@click.option(
+    "--fast_decode",
+    is_flag=True,
+    help="Decode JPEGs at the smallest scale at or above the image resolution",
+)
 def generate_embeddings(
     encoder,
     checkpoint,
@@ -137,6 +148,8 @@ def generate_embeddings(
     model_name,
     image_resolution,
     mean_std,
+    precision,
+    fast_decode,
 ):
 
     if huggingface:
@@ -151,6 +164,8 @@ def generate_embeddings(
             image_resolution=image_resolution,
             custom_preprocess=custom_preprocess,
             mean_std=mean_std,
+            precision=precision,
+            fast_decode=fast_decode,
         )
     else:
         from label_anything.preprocess import preprocess_images_to_embeddings
@@ -165,6 +180,8 @@ def generate_embeddings(
             last_block_dir=last_block_dir,
             compile=compile,
             custom_preprocess=custom_preprocess,
+            precision=precision,
+            fast_decode=fast_decode,
         )
 
 
@@ -224,6 +241,17 @@ def generate_embeddings(
     default="default",
     help="Mean and std for normalization (can be default or standard)",
 )
+@click.option(
+    "--precision",
+    default="fp32",
+    type=click.Choice(["fp32", "fp16", "bf16", "int8"]),
+    help="Storage precision of the embeddings (int8 stores per-channel scales)",
+)
+@click.option(
+    "--fast_decode",
+    is_flag=True,
+    help="Decode JPEGs at the smallest scale at or above the image resolution",
+)
 def generate_feature_pyramids(
     encoder_name,
     directory,
@@ -236,6 +264,8 @@ def generate_feature_pyramids(
     custom_preprocess,
     out_features,
     mean_std,
+    precision,
+    fast_decode,
 ):
     out_features = out_features.split(",")
 
@@ -252,6 +282,8 @@ def generate_feature_pyramids(
         custom_preprocess=custom_preprocess,
         out_features=out_features,
         mean_std=mean_std,
+        precision=precision,
+        fast_decode=fast_decode,
     )
     
 
@@ -268,13 +300,226 @@ def generate_feature_pyramids(
 )
 @click.option(
     "--outfolder",
-    default="embeddings",
-    help="Folder to save the embeddings",
+    default="data/processed/ground_truths",
+    help="Folder to save the ground truth store",
+)
+@click.option(
+    "--num_workers",
+    default=None,
+    type=int,
+    help="Number of processes, defaults to the number of CPUs",
 )
-def generate_gt(dataset_name, anns_path, outfolder):
+@click.option(
+    "--shard_size",
+    default=1000,
+    help="Number of images per ground truth shard",
+)
+def generate_gt(dataset_name, anns_path, outfolder, num_workers, shard_size):
     from label_anything.preprocess import generate_ground_truths
 
-    generate_ground_truths(dataset_name, anns_path, outfolder)
+    generate_ground_truths(
+        dataset_name,
+        anns_path,
+        outfolder,
+        num_workers=num_workers,
+        shard_size=shard_size,
+    )
+
+
+@main.command("pack_embeddings")
+@click.option(
+    "--emb_dir",
+    default="data/processed/embeddings",
+    help="Folder containing one safetensors file per image",
+)
+@click.option(
+    "--outfolder",
+    default="data/processed/embeddings_packed",
+    help="Folder to save the packed embedding store",
+)
+@click.option(
+    "--shard_size",
+    default=4 * 1024**3,
+    help="Size in bytes after which a new shard is started",
+)
+def pack_embeddings(emb_dir, outfolder, shard_size):
+    from label_anything.data.embedding_store import pack_embeddings as pack_embeddings_fn
+
+    pack_embeddings_fn(emb_dir, outfolder, shard_size=shard_size)
+
+
+@main.command("quantize_embeddings")
+@click.option(
+    "--emb_dir",
+    default="data/processed/embeddings",
+    help="Folder containing one safetensors file per image",
+)
+@click.option(
+    "--outfolder",
+    default="data/processed/embeddings_quantized",
+    help="Folder to save the converted embeddings",
+)
+@click.option(
+    "--precision",
+    default="fp16",
+    type=click.Choice(["fp32", "fp16", "bf16", "int8"]),
+    help="Storage precision of the embeddings (int8 stores per-channel scales)",
+)
+def quantize_embeddings(emb_dir, outfolder, precision):
+    from label_anything.preprocess import quantize_embeddings as quantize_embeddings_fn
+
+    quantize_embeddings_fn(emb_dir, outfolder, precision)
+
+
+@main.command("quantization_report")
+@click.option("--parameters", default="test.yaml", help="Path to the validation parameters file")
+@click.option(
+    "--outfolder",
+    default="data/processed/quantized",
+    help="Folder to save the converted embeddings and the report",
+)
+@click.option(
+    "--precisions",
+    default="fp16,bf16,int8",
+    help="Precisions to compare with fp32",
+)
+def quantization_report(parameters, outfolder, precisions):
+    from label_anything.experiment.experiment import (
+        quantization_report as quantization_report_fn,
+    )
+
+    quantization_report_fn(
+        param_path=parameters,
+        outfolder=outfolder,
+        precisions=tuple(precisions.split(",")),
+    )
+
+
+@main.command("precompute_prompt_masks")
+@click.option(
+    "--instances_path",
+    default="data/coco/annotations/instances_train2014.json",
+    help="Path to the instances file",
+)
+@click.option(
+    "--outfolder",
+    default="data/processed/prompt_masks",
+    help="Folder to save the resized prompt masks",
+)
+@click.option(
+    "--image_size",
+    default=1024,
+    help="Long side of the preprocessed images",
+)
+@click.option(
+    "--masks_side_length",
+    default=256,
+    help="Side of the resized prompt masks",
+)
+@click.option(
+    "--no_custom_preprocess",
+    is_flag=True,
+    help="Resize images to a square instead of keeping the aspect ratio",
+)
+@click.option(
+    "--num_workers",
+    default=None,
+    type=int,
+    help="Number of processes, defaults to the number of CPUs",
+)
+def precompute_prompt_masks(
+    instances_path,
+    outfolder,
+    image_size,
+    masks_side_length,
+    no_custom_preprocess,
+    num_workers,
+):
+    from label_anything.data.prompt_masks import (
+        precompute_prompt_masks as precompute_prompt_masks_fn,
+    )
+
+    precompute_prompt_masks_fn(
+        instances_path,
+        outfolder,
+        masks_side_length=masks_side_length,
+        long_side_length=image_size,
+        custom_preprocess=not no_custom_preprocess,
+        num_workers=num_workers,
+    )
+
+
+@main.command("plan_episodes")
+@click.option(
+    "--parameters",
+    default="parameters.yaml",
+    help="Path to the parameters file of the run",
+)
+@click.option(
+    "--outfolder",
+    default="data/processed/episode_plans",
+    help="Folder to save the episode plans",
+)
+@click.option(
+    "--num_epochs",
+    default=None,
+    type=int,
+    help="Number of epochs to plan, defaults to max_epochs",
+)
+@click.option(
+    "--num_processes",
+    default=1,
+    help="Number of training processes",
+)
+@click.option(
+    "--num_workers",
+    default=None,
+    type=int,
+    help="Number of processes, defaults to the number of CPUs",
+)
+def plan_episodes(parameters, outfolder, num_epochs, num_processes, num_workers):
+    from label_anything.data.episode_plan import plan_episodes_from_parameters
+
+    plan_episodes_from_parameters(
+        parameters,
+        outfolder,
+        num_epochs=num_epochs,
+        num_processes=num_processes,
+        num_workers=num_workers,
+    )
+
+
+@main.command("export_shards")
+@click.option(
+    "--parameters",
+    default="parameters.yaml",
+    help="Path to the parameters file of the run",
+)
+@click.option(
+    "--outfolder",
+    default="data/processed/shards",
+    help="Folder to save the shards, one subfolder per training dataset",
+)
+@click.option(
+    "--shard_size",
+    default=1000,
+    help="Number of images per shard",
+)
+@click.option(
+    "--num_workers",
+    default=None,
+    type=int,
+    help="Number of processes, defaults to the number of CPUs",
+)
+def export_shards(parameters, outfolder, shard_size, num_workers):
+    from label_anything.data.shards import export_shards_from_parameters
+
+    export_shards_from_parameters(
+        parameters,
+        outfolder,
+        shard_size=shard_size,
+        num_workers=num_workers,
+    )
 
 
 @main.command("benchmark")
@@ -6,12 +6,16 @@ from label_anything.data.kvasir import KvarisTestDataset
 from label_anything.data.transforms import Normalize, Resize
 
 from label_anything.data.dataset import LabelAnythingDataset, VariableBatchSampler
+from label_anything.data.shards import ShardedEpisodeDataset
 from label_anything.data.coco import CocoLVISTestDataset, CocoLVISDataset
 from label_anything.data.dram import DramTestDataset, collate_fn as dram_collate
 from label_anything.data.transforms import CustomNormalize, CustomResize
 from label_anything.data.utils import get_mean_std
 from label_anything.data.weedmap import WeedMapTestDataset
 from label_anything.data.brain_mri import BrainMriTestDataset, BrainTestDataset
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
 
 
 TEST_DATASETS = {
@@ -76,6 +80,17 @@ def get_dataloaders(dataset_args, dataloader_args, num_processes):
 
     val_prompt_types = dataloader_args.pop("val_prompt_types", prompt_types)
     num_steps = dataloader_args.pop("num_steps", None)
+    max_batch_cost = dataloader_args.pop("max_batch_cost", None)
+    episode_plan_dir = dataloader_args.pop("episode_plan_dir", None)
+    # download the images of the next batch ahead (needs an image_cache_dir)
+    prefetch_images = dataloader_args.pop("prefetch_images", False)
+    # options of ShardedEpisodeDataset, to stream the training dataset from its shards
+    streaming = dataloader_args.pop("streaming", None)
+    # batches collated in the main process can be allocated directly in pinned memory
+    collate_pin_memory = (
+        dataloader_args.get("pin_memory", False)
+        and dataloader_args.get("num_workers", 0) == 0
+    )
 
     val_datasets_params = {
         k: v for k, v in datasets_params.items() if k.startswith("val_")
@@ -89,10 +104,36 @@ def get_dataloaders(dataset_args, dataloader_args, num_processes):
         if k not in list(val_datasets_params.keys()) + list(test_datasets_params.keys())
     }
     train_dataloader = None
-    if train_datasets_params:
+    if train_datasets_params and streaming is not None:
+        if len(train_datasets_params) != 1:
+            raise ValueError("Streaming supports a single training dataset.")
+        if num_steps is not None or max_batch_cost is not None or episode_plan_dir:
+            logger.warning(
+                "num_steps, max_batch_cost and episode_plan_dir are ignored when streaming."
+            )
+        ((dataset_name, params),) = train_datasets_params.items()
+        train_dataset = ShardedEpisodeDataset(
+            dataset_name=dataset_name,
+            possible_batch_example_nums=possible_batch_example_nums,
+            prompt_types=prompt_types,
+            prompt_choice_level=prompt_choice_level,
+            num_processes=num_processes,
+            pin_memory=collate_pin_memory,
+            **streaming,
+            **{**common_params, **params, "preprocess": preprocess},
+        )
+        train_dataloader = DataLoader(
+            dataset=train_dataset,
+            **dataloader_args,
+            batch_size=None,
+            collate_fn=train_dataset.collate_fn,
+        )
+    elif train_datasets_params:
         train_dataset = LabelAnythingDataset(
             datasets_params=train_datasets_params,
             common_params={**common_params, "preprocess": preprocess},
+            pin_memory=collate_pin_memory,
+            mixing_ratios=dataset_args.get("mixing_ratios"),
         )
         train_batch_sampler = VariableBatchSampler(
             train_dataset,
@@ -102,6 +143,9 @@ def get_dataloaders(dataset_args, dataloader_args, num_processes):
             prompt_choice_level=prompt_choice_level,
             shuffle=True,
             num_steps=num_steps,
+            max_batch_cost=max_batch_cost,
+            episode_plan_dir=episode_plan_dir,
+            prefetch=prefetch_images,
         )
         train_dataloader = DataLoader(
             dataset=train_dataset,
@@ -120,12 +164,14 @@ def get_dataloaders(dataset_args, dataloader_args, num_processes):
             val_dataset = LabelAnythingDataset(
                 datasets_params={dataset_name: params},
                 common_params={**common_params, "preprocess": preprocess},
+                pin_memory=collate_pin_memory,
             )
             val_batch_sampler = VariableBatchSampler(
                 val_dataset,
                 possible_batch_example_nums=val_possible_batch_example_nums,
                 num_processes=num_processes,
                 prompt_types=val_prompt_types,
+                prefetch=prefetch_images,
             )
             val_dataloader = DataLoader(
                 dataset=val_dataset,
@@ -0,0 +1,218 @@
+from collections.abc import Mapping
+from functools import reduce
+
+import numpy as np
+
+from label_anything.data.instances_cache import PackedInstances
+
+
+def _offsets(counts: np.ndarray) -> np.ndarray:
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+class AnnotationIndex:
+    """Array-backed (CSR) index over PackedInstances.
+
+    Images and categories are mapped to dense indices (positions in the sorted arrays
+    image_ids and category_ids). The index stores, as flat numpy arrays:
+        - image -> annotations (in the order of the instances file): img_ann_offsets, img_anns;
+        - image -> category pairs, sorted by image and category: img_cat_offsets, img_cats;
+        - (image, category) pair -> annotations: pair_ann_offsets, pair_anns;
+        - category -> images (sorted): cat_img_offsets, cat_imgs.
+    Annotations are referred to by their row in the packed instances. Since no Python object is
+    kept per annotation (or per image/category pair), forked DataLoader workers share the pages
+    of the index instead of copying them on refcount updates.
+    """
+
+    def __init__(self, packed: PackedInstances):
+        self.packed = packed
+        self.image_ids = np.unique(packed.ann_image_ids)
+        self.category_ids = np.unique(packed.ann_category_ids)
+        n_images, n_categories = len(self.image_ids), len(self.category_ids)
+
+        ann_imgs = np.searchsorted(self.image_ids, packed.ann_image_ids)
+        ann_cats = np.searchsorted(self.category_ids, packed.ann_category_ids)
+
+        # image -> annotations
+        self.img_anns = np.argsort(ann_imgs, kind="stable")
+        self.img_ann_offsets = _offsets(np.bincount(ann_imgs, minlength=n_images))
+
+        # (image, category) pair -> annotations
+        pair_keys = ann_imgs.astype(np.int64) * n_categories + ann_cats
+        self.pair_anns = np.argsort(pair_keys, kind="stable")
+        unique_pairs, pair_starts = np.unique(
+            pair_keys[self.pair_anns], return_index=True
+        )
+        self.pair_ann_offsets = np.append(pair_starts, len(self.pair_anns)).astype(
+            np.int64
+        )
+        pair_imgs = unique_pairs // max(n_categories, 1)
+        pair_cats = unique_pairs % max(n_categories, 1)
+
+        # image -> categories
+        self.img_cats = pair_cats
+        self.img_cat_offsets = _offsets(np.bincount(pair_imgs, minlength=n_images))
+
+        # category -> images
+        cat_order = np.argsort(pair_cats, kind="stable")
+        self.cat_imgs = pair_imgs[cat_order]
+        self.cat_img_offsets = _offsets(np.bincount(pair_cats, minlength=n_categories))
+
+        self.img2cat = ImageCategoriesView(self)
+        self.cat2img = CategoryImagesView(self)
+        self.img2cat_annotations = ImageCategoryAnnotationsView(self)
+
+    @staticmethod
+    def _dense_idx(ids: np.ndarray, value: int) -> int:
+        idx = np.searchsorted(ids, value)
+        if idx < len(ids) and ids[idx] == value:
+            return int(idx)
+        return -1
+
+    def image_idx(self, image_id: int) -> int:
+        """Dense index of the image, -1 if the image has no annotation."""
+        return self._dense_idx(self.image_ids, image_id)
+
+    def category_idx(self, cat_id: int) -> int:
+        """Dense index of the category, -1 if the category has no annotation."""
+        return self._dense_idx(self.category_ids, cat_id)
+
+    def image_categories(self, image_id: int) -> np.ndarray:
+        """Category ids of the image."""
+        i = self.image_idx(image_id)
+        if i < 0:
+            return self.category_ids[:0]
+        start, end = self.img_cat_offsets[i], self.img_cat_offsets[i + 1]
+        return self.category_ids[self.img_cats[start:end]]
+
+    def category_image_idxs(self, cat_id: int) -> np.ndarray:
+        """Sorted dense indices of the images containing the category."""
+        c = self.category_idx(cat_id)
+        if c < 0:
+            return self.cat_imgs[:0]
+        return self.cat_imgs[self.cat_img_offsets[c] : self.cat_img_offsets[c + 1]]
+
+    def category_images(self, cat_id: int) -> np.ndarray:
+        """Image ids of the images containing the category."""
+        return self.image_ids[self.category_image_idxs(cat_id)]
+
+    def image_annotations(self, image_id: int) -> np.ndarray:
+        """Rows of the annotations of the image, in the order of the instances file."""
+        i = self.image_idx(image_id)
+        if i < 0:
+            return self.img_anns[:0]
+        return self.img_anns[self.img_ann_offsets[i] : self.img_ann_offsets[i + 1]]
+
+    def annotations(self, image_id: int, cat_id: int) -> np.ndarray:
+        """Rows of the annotations of the category in the image."""
+        i, c = self.image_idx(image_id), self.category_idx(cat_id)
+        if i < 0 or c < 0:
+            return self.pair_anns[:0]
+        start, end = self.img_cat_offsets[i], self.img_cat_offsets[i + 1]
+        p = start + np.searchsorted(self.img_cats[start:end], c)
+        if p == end or self.img_cats[p] != c:
+            return self.pair_anns[:0]
+        return self.pair_anns[self.pair_ann_offsets[p] : self.pair_ann_offsets[p + 1]]
+
+    def intersection(self, cat_ids: list[int], excluded_ids: list[int]) -> set:
+        """Ids of the images containing all the categories, except the excluded ones."""
+        idxs = sorted(
+            (self.category_image_idxs(cat_id) for cat_id in cat_ids), key=len
+        )
+        common = reduce(
+            lambda a, b: np.intersect1d(a, b, assume_unique=True), idxs
+        )
+        if len(excluded_ids) > 0 and len(common) > 0:
+            excluded = np.array([self.image_idx(x) for x in excluded_ids])
+            common = np.setdiff1d(common, excluded, assume_unique=True)
+        return set(self.image_ids[common].tolist())
+
+    def annotation_id(self, row: int) -> int:
+        return int(self.packed.ann_ids[row])
+
+    def category_id(self, row: int) -> int:
+        return int(self.packed.ann_category_ids[row])
+
+    def area(self, row: int) -> float:
+        return float(self.packed.ann_areas[row])
+
+    def bbox(self, row: int) -> list[float]:
+        return self.packed.ann_bboxes[row].tolist()
+
+    def segmentation(self, row: int) -> dict:
+        return self.packed.segmentation(row)
+
+
+class ImageCategoriesView(Mapping):
+    """Read-only img2cat mapping (image id -> set of category ids) over an AnnotationIndex."""
+
+    def __init__(self, index: AnnotationIndex):
+        self.index = index
+
+    def __getitem__(self, image_id):
+        if image_id not in self:
+            raise KeyError(image_id)
+        return set(self.index.image_categories(image_id).tolist())
+
+    def __contains__(self, image_id):
+        return self.index.image_idx(image_id) >= 0
+
+    def __iter__(self):
+        return iter(self.index.image_ids.tolist())
+
+    def __len__(self):
+        return len(self.index.image_ids)
+
+
+class CategoryImagesView(Mapping):
+    """Read-only cat2img mapping (category id -> set of image ids) over an AnnotationIndex."""
+
+    def __init__(self, index: AnnotationIndex):
+        self.index = index
+
+    def __getitem__(self, cat_id):
+        if cat_id not in self:
+            raise KeyError(cat_id)
+        return set(self.index.category_images(cat_id).tolist())
+
+    def __contains__(self, cat_id):
+        return self.index.category_idx(cat_id) >= 0
+
+    def __iter__(self):
+        return iter(self.index.category_ids.tolist())
+
+    def __len__(self):
+        return len(self.index.category_ids)
+
+    def intersection(self, cat_ids: list[int], excluded_ids: list[int]) -> set:
+        return self.index.intersection(cat_ids, excluded_ids)
+
+
+class ImageCategoryAnnotationsView(Mapping):
+    """Read-only img2cat_annotations mapping (image id -> category id -> list of annotation
+    dicts) over an AnnotationIndex. Annotation dicts are built on access."""
+
+    def __init__(self, index: AnnotationIndex):
+        self.index = index
+
+    def __getitem__(self, image_id):
+        if image_id not in self:
+            raise KeyError(image_id)
+        return {
+            cat_id: [
+                self.index.packed.annotation(row)
+                for row in self.index.annotations(image_id, cat_id)
+            ]
+            for cat_id in self.index.image_categories(image_id).tolist()
+        }
+
+    def __contains__(self, image_id):
+        return self.index.image_idx(image_id) >= 0
+
+    def __iter__(self):
+        return iter(self.index.image_ids.tolist())
+
+    def __len__(self):
+        return len(self.index.image_ids)
@@ -0,0 +1,146 @@
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+class AliasTable:
+    """Walker's alias table of a discrete distribution: after an O(K) setup, every draw
+    costs one uniform index and one coin flip, and many draws are a single vectorized call.
+
+    Args:
+        weights (np.ndarray): Non negative weights of the K outcomes (not necessarily normalized).
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        k = len(weights)
+        scaled = weights * (k / weights.sum())
+        self.prob = np.ones(k, dtype=np.float64)
+        self.alias = np.arange(k)
+        small = [i for i in range(k) if scaled[i] < 1.0]
+        large = [i for i in range(k) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # what is left has probability 1 up to rounding errors
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, num_samples: int = 1) -> np.ndarray:
+        """Draw num_samples outcomes (with replacement)."""
+        idxs = np.random.randint(0, len(self.prob), size=num_samples)
+        keep = np.random.random_sample(num_samples) < self.prob[idxs]
+        return np.where(keep, idxs, self.alias[idxs])
+
+    def sample_distinct(self, num_samples: int, excluded=()) -> np.ndarray:
+        """Draw num_samples distinct outcomes, in order of draw, as successive sampling
+        proportional to the weights of the outcomes not drawn (or excluded) yet.
+
+        The first occurrences in a stream of draws with replacement follow exactly this
+        distribution, so the stream is drawn in blocks until enough outcomes are found.
+        """
+        seen = set(excluded)
+        if len(self.prob) - len(seen) < num_samples:
+            raise ValueError("Not enough outcomes to draw from.")
+        drawn = []
+        while len(drawn) < num_samples:
+            for idx in self.sample(2 * (num_samples - len(drawn)) + 1).tolist():
+                if idx not in seen:
+                    seen.add(idx)
+                    drawn.append(idx)
+                    if len(drawn) == num_samples:
+                        break
+        return np.array(drawn, dtype=np.int64)
+
+
+@lru_cache(maxsize=None)
+def power_law_table(n: int, alpha: float) -> AliasTable:
+    """Alias table of the power law over 1..n used by sample_power_law."""
+    return AliasTable(np.arange(1, n + 1, dtype=np.float64) ** -alpha)
+
+
+class PowerLawSampler:
+    """Drop-in replacement of partial(sample_power_law, alpha=alpha), drawing from an
+    alias table cached for each n.
+
+    Args:
+        alpha (float): exponent of the power law distribution
+    """
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+
+    def __call__(self, n: int, num_samples: int = 1) -> torch.Tensor:
+        return torch.from_numpy(power_law_table(n, self.alpha).sample(num_samples) + 1)
+
+
+def _sample_frequency_weighted(counts: np.ndarray, num_samples: int, inverse: bool):
+    """Positions of num_samples distinct classes drawn as repeated calls of
+    sample_over_inverse_frequency do.
+
+    Without inverse, each class is drawn proportionally to its count among the remaining
+    ones, which is successive sampling from a single alias table. With inverse,
+    proportionally to T - count, where T is the total count of the remaining classes:
+    the weights of all the classes change with every draw, so the draws stay sequential,
+    but each one is a cumulative sum and a binary search over the counts, with the
+    uniforms of all the draws generated at once.
+    """
+    if not inverse:
+        return AliasTable(counts).sample_distinct(num_samples)
+    remaining = np.ones(len(counts), dtype=bool)
+    total = counts.sum()
+    uniforms = np.random.random_sample(num_samples)
+    drawn = np.empty(num_samples, dtype=np.int64)
+    for t in range(num_samples):
+        cumulative = np.cumsum(np.where(remaining, total - counts, 0.0))
+        k = np.searchsorted(cumulative, uniforms[t] * cumulative[-1], side="right")
+        if k == len(counts):
+            # rounding of uniforms[t] * cumulative[-1] up to cumulative[-1]
+            k = np.flatnonzero(remaining)[-1]
+        drawn[t] = k
+        remaining[k] = False
+        total -= counts[k]
+    return drawn
+
+
+def sample_class_subset(
+    class_list: list, n_elements: int, frequencies: Optional[dict] = None
+) -> list:
+    """Sample a subset of n_elements classes as ExampleGenerator.sample_classes_from_query
+    does with uniform_sampling (frequencies is None) or sample_over_inverse_frequency, with
+    one call per subset instead of one sampling call per class.
+
+    Args:
+        class_list (list): Classes to sample from.
+        n_elements (int): Number of classes to sample, less than len(class_list).
+        frequencies (Optional[dict], optional): Mapping from class ids to how often they
+            were sampled, the classes of sample_over_inverse_frequency. Defaults to None.
+
+    Returns:
+        list: The sampled classes.
+    """
+    if n_elements > len(class_list) // 2:
+        # sample the classes to remove
+        num_samples, inverse = len(class_list) - n_elements, False
+    else:
+        num_samples, inverse = n_elements, True
+
+    if frequencies is None:
+        population = class_list
+        positions = np.random.permutation(len(population))[:num_samples]
+    else:
+        population = list(frequencies.keys())
+        counts = np.array([frequencies[k] + 1 for k in population], dtype=np.float64)
+        positions = _sample_frequency_weighted(counts, num_samples, inverse)
+    sampled = [population[i] for i in positions.tolist()]
+
+    if num_samples != n_elements:
+        removed = set(sampled)
+        return [c for c in class_list if c not in removed]
+    return sampled
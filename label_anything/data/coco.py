@@ -2,27 +2,41 @@ import itertools
 import os
 import random
 import warnings
-from io import BytesIO
 from typing import Any, Optional
 
 import numpy as np
-import requests
 import torch
 from PIL import Image
-from safetensors.torch import load_file
 from torch.utils.data import Dataset
 from torchvision.transforms import PILToTensor, ToTensor
 from label_anything.logger.text_logger import get_logger
 
 import label_anything.data.utils as utils
+from label_anything.data.embedding_store import EmbeddingsBackend, open_embedding_store
 from label_anything.data.examples import (
     build_example_generator,
     uniform_sampling,
 )
+from label_anything.data.annotation_index import AnnotationIndex
+from label_anything.data.gt_store import open_gt_store
+from label_anything.data.image_decoding import decode_image
+from label_anything.data.image_fetcher import ImageFetcher
+from label_anything.data.instances_cache import (
+    PackedInstances,
+    load_packed_instances,
+)
+from label_anything.data.mask_cache import MaskCache
+from label_anything.data.prompt_masks import open_prompt_mask_store
+from label_anything.data.quantization import (
+    SCALE_SUFFIX,
+    dequantize_tensors,
+    is_embedding_key,
+)
 from label_anything.data.transforms import (
     CustomNormalize,
     CustomResize,
     PromptsProcessor,
+    runs_to_positions,
 )
 from label_anything.data.utils import (
     AnnFileKeys,
@@ -61,6 +75,18 @@ class CocoLVISDataset(Dataset):
         sample_function: str = "power_law",
         custom_preprocess: bool = True,
         is_pyramids: bool = False,
+        embeddings_backend: str = EmbeddingsBackend.SAFETENSORS,
+        annotations_cache_dir: Optional[str] = None,
+        gt_dir: Optional[str] = None,
+        prompt_masks_dir: Optional[str] = None,
+        mask_cache_bytes: int = 0,
+        embedding_cache_bytes: int = 0,
+        keep_embedding_cache: bool = False,
+        target_size: Optional[int] = None,
+        lazy_dequantization: bool = False,
+        fast_decode: bool = False,
+        image_cache_dir: Optional[str] = None,
+        fetch_connections: int = 8,
     ):
         """Initialize the dataset.
 
@@ -82,16 +108,27 @@ class CocoLVISDataset(Dataset):
             sample_function (str, optional): Specify strategy to sample support images.
             custom_preprocess (bool, optional): Specify if custom preprocessing is used. Defaults to True.
             is_pyramids (bool, optional): Specify if the embeddings are pyramids. Defaults to False.
+            embeddings_backend (str, optional): How embeddings are stored in emb_dir, either one safetensors file per image ("safetensors") or a packed store ("sharded"). Defaults to "safetensors".
+            annotations_cache_dir (Optional[str], optional): Directory where the parsed and filtered instances are cached. Defaults to None (no cache).
+            gt_dir (Optional[str], optional): Directory of the ground truth store created by generate_gt, used when load_gts is True. Defaults to None (ground truths stored in the embeddings).
+            prompt_masks_dir (Optional[str], optional): Directory of the resized prompt masks created by precompute_prompt_masks. Defaults to None (masks resized on the fly).
+            mask_cache_bytes (int, optional): Byte budget of the per-worker LRU cache of decoded annotation masks. Defaults to 0 (no cache).
+            embedding_cache_bytes (int, optional): Byte budget of the node-level LRU cache of embeddings in shared memory, read once per node and shared by all the ranks and workers. Defaults to 0 (no cache).
+            keep_embedding_cache (bool, optional): Keep the shared memory cache of embeddings on the node when training ends, so that the next runs start warm. Defaults to False (removed).
+            target_size (Optional[int], optional): If set, the ground truths are emitted at this resolution, in the padded input frame of the model (e.g. 256), so that losses and metrics are computed there. Meant for training only, leave it unset for validation and test. Defaults to None (original resolution).
+            lazy_dequantization (bool, optional): If True, quantized embeddings (see generate_embeddings --precision) are returned as stored, together with their int8 scales, and dequantized by the training loop once on the device. Defaults to False (dequantized when loaded).
+            fast_decode (bool, optional): If True, JPEG images are decoded at the smallest scale at or above the size they are resized to by preprocess (see decode_image). Defaults to False (full decode).
+            image_cache_dir (Optional[str], optional): When img_dir is None and images are downloaded from their coco_url, directory of the on-disk cache of the downloaded images, shared by all the processes. Required to prefetch images. Defaults to None (no cache).
+            fetch_connections (int, optional): Maximum number of concurrent connections used to download images, per process. Defaults to 8.
         """
         super().__init__()
-        print(f"Loading dataset annotations from {instances_path}...")
 
         assert (
             img_dir is not None or emb_dir is not None
         ), "Either img_dir or emb_dir must be provided."
         assert (
-            not load_gts or emb_dir is not None
-        ), "If load_gts is True, emb_dir must be provided."
+            not load_gts or emb_dir is not None or gt_dir is not None
+        ), "If load_gts is True, emb_dir or gt_dir must be provided."
         assert (
             not load_embeddings or emb_dir is not None
         ), "If load_embeddings is True, emb_dir must be provided."
@@ -115,37 +152,31 @@ class CocoLVISDataset(Dataset):
         self.add_box_noise = add_box_noise
         self.n_ways = n_ways
         self.image_size = image_size
+        self.target_size = target_size
+        self.lazy_dequantization = lazy_dequantization
+        self.fast_decode = fast_decode
+        self.image_fetcher = (
+            ImageFetcher(image_cache_dir, max_connections=fetch_connections)
+            if img_dir is None
+            else None
+        )
         self.remove_small_annotations = remove_small_annotations
         self.all_example_categories = all_example_categories
         self.sample_function = sample_function
         self.is_pyramids = is_pyramids
+        self.embedding_store = open_embedding_store(
+            self.emb_dir,
+            embeddings_backend,
+            cache_bytes=embedding_cache_bytes,
+            keep_cache=keep_embedding_cache,
+        )
+        self.annotations_cache_dir = annotations_cache_dir
+        self.gt_store = open_gt_store(gt_dir)
 
-        # load instances
-        instances = utils.load_instances(self.instances_path)
-        self.annotations = {
-            x[AnnFileKeys.ID]: x for x in instances[AnnFileKeys.ANNOTATIONS]
-        }
-        self.categories = {
-            x[AnnFileKeys.ID]: x for x in instances[AnnFileKeys.CATEGORIES]
-        }
-
-        # useful dicts
-        (
-            self.img_annotations,
-            self.img2cat,
-            self.img2cat_annotations,
-            self.cat2img,
-            self.cat2img_annotations,
-        ) = self._load_annotation_dicts()
-
-        # load image ids and info
-        img2cat_keys = set(self.img2cat.keys())
-        self.images = {
-            x[AnnFileKeys.ID]: x
-            for x in instances[AnnFileKeys.IMAGES]
-            if x[AnnFileKeys.ID] in img2cat_keys
-        }
-        self.image_ids = list(self.images.keys())
+        # load instances and build the annotation index
+        packed = self._load_packed_instances()
+        self.categories = {x[AnnFileKeys.ID]: x for x in packed.categories}
+        self._load_annotation_index(packed)
 
         # example generator/selector
         self.example_generator = build_example_generator(
@@ -163,78 +194,60 @@ class CocoLVISDataset(Dataset):
             masks_side_length=256,
             custom_preprocess=custom_preprocess,
         )
+        self.prompt_mask_store = open_prompt_mask_store(prompt_masks_dir)
+        self.mask_cache = MaskCache(mask_cache_bytes) if mask_cache_bytes > 0 else None
+        if self.prompt_mask_store is not None and (
+            self.prompt_mask_store.masks_side_length
+            != self.prompts_processor.masks_side_length
+            or self.prompt_mask_store.long_side_length
+            != self.prompts_processor.long_side_length
+            or self.prompt_mask_store.custom_preprocess != custom_preprocess
+        ):
+            raise ValueError(
+                f"The prompt masks in {prompt_masks_dir} were computed with different preprocessing settings."
+            )
+
+    def _load_packed_instances(
+        self, category_ids: Optional[list[int]] = None
+    ) -> PackedInstances:
+        """Load the filtered instances, from the annotations cache if enabled.
 
-    def _load_annotation_dicts(self) -> tuple[dict, dict, dict, dict, dict]:
-        """Load useful annotation dicts.
+        Args:
+            category_ids (Optional[list[int]], optional): Categories to keep. Defaults to None (all).
 
         Returns:
-            (dict, dict, dict, dict, dict): Returns four dictionaries:
-                0. img_annotations: A dictionary mapping image ids to lists of annotations.
-                1. img2cat: A dictionary mapping image ids to sets of category ids.
-                2. img2cat_annotations: A dictionary mapping image ids to dictionaries mapping category ids to annotations.
-                3. cat2img: A dictionary mapping category ids to sets of image ids.
-                4. cat2img_annotations: A dictionary mapping category ids to dictionaries mapping image ids to annotations.
+            PackedInstances: The packed instances.
         """
-        img_annotations = {}
-        img2cat_annotations = {}
-        cat2img_annotations = {}
-
-        img2cat = {}
-        cat2img = {}
-
-        category_ids = set(self.categories.keys())
-
-        for ann in self.annotations.values():
-            if self._remove_small_annotations(ann):
-                continue
-
-            if AnnFileKeys.ISCROWD in ann and ann[AnnFileKeys.ISCROWD] == 1:
-                continue
+        print(f"Loading dataset annotations from {self.instances_path}...")
+        if self.annotations_cache_dir is not None:
+            return load_packed_instances(
+                self.instances_path,
+                self.annotations_cache_dir,
+                remove_small_annotations=self.remove_small_annotations,
+                category_ids=category_ids,
+            )
+        return PackedInstances.from_instances(
+            utils.load_instances(self.instances_path),
+            remove_small_annotations=self.remove_small_annotations,
+            category_ids=category_ids,
+        )
 
-            if ann[AnnFileKeys.CATEGORY_ID] not in category_ids:
-                continue
+    def _load_annotation_index(self, packed: PackedInstances):
+        """Build the annotation index and the useful mappings over it:
+            - img2cat: A mapping from image ids to sets of category ids.
+            - cat2img: A mapping from category ids to sets of image ids.
+            - img2cat_annotations: A mapping from image ids to dictionaries mapping category ids to annotations.
+            - images: A dictionary mapping image ids to image data (only images with annotations).
 
-            if ann[AnnFileKeys.IMAGE_ID] not in img_annotations:
-                img_annotations[ann[AnnFileKeys.IMAGE_ID]] = []
-            img_annotations[ann[AnnFileKeys.IMAGE_ID]].append(ann)
-
-            if ann[AnnFileKeys.IMAGE_ID] not in img2cat_annotations:
-                img2cat_annotations[ann[AnnFileKeys.IMAGE_ID]] = {}
-                img2cat[ann[AnnFileKeys.IMAGE_ID]] = set()
-
-            if (
-                ann[AnnFileKeys.CATEGORY_ID]
-                not in img2cat_annotations[ann[AnnFileKeys.IMAGE_ID]]
-            ):
-                img2cat_annotations[ann[AnnFileKeys.IMAGE_ID]][
-                    ann[AnnFileKeys.CATEGORY_ID]
-                ] = []
-                img2cat[ann[AnnFileKeys.IMAGE_ID]].add(ann[AnnFileKeys.CATEGORY_ID])
-
-            img2cat_annotations[ann[AnnFileKeys.IMAGE_ID]][
-                ann[AnnFileKeys.CATEGORY_ID]
-            ].append(ann)
-
-            if ann[AnnFileKeys.CATEGORY_ID] not in cat2img_annotations:
-                cat2img_annotations[ann[AnnFileKeys.CATEGORY_ID]] = {}
-                cat2img[ann[AnnFileKeys.CATEGORY_ID]] = set()
-
-            if ann["image_id"] not in cat2img_annotations[ann[AnnFileKeys.CATEGORY_ID]]:
-                cat2img_annotations[ann[AnnFileKeys.CATEGORY_ID]][
-                    ann[AnnFileKeys.IMAGE_ID]
-                ] = []
-                cat2img[ann[AnnFileKeys.CATEGORY_ID]].add(ann[AnnFileKeys.IMAGE_ID])
-
-            cat2img_annotations[ann[AnnFileKeys.CATEGORY_ID]][
-                ann[AnnFileKeys.IMAGE_ID]
-            ].append(ann)
-        return (
-            img_annotations,
-            img2cat,
-            img2cat_annotations,
-            cat2img,
-            cat2img_annotations,
-        )
+        Args:
+            packed (PackedInstances): The filtered instances.
+        """
+        self.annotation_index = AnnotationIndex(packed)
+        self.img2cat = self.annotation_index.img2cat
+        self.cat2img = self.annotation_index.cat2img
+        self.img2cat_annotations = self.annotation_index.img2cat_annotations
+        self.images = {x[AnnFileKeys.ID]: x for x in packed.images}
+        self.image_ids = list(self.images.keys())
 
     def _load_safe(self, img_data: dict) -> (torch.Tensor, Optional[torch.Tensor]):
         """Open a safetensors file and load the embedding and the ground truth.
@@ -248,18 +261,26 @@ class CocoLVISDataset(Dataset):
         assert self.emb_dir is not None, "emb_dir must be provided."
         gt = None
 
-        f = load_file(
-            f"{self.emb_dir}/{str(img_data[AnnFileKeys.ID]).zfill(12)}.safetensors"
-        )
-        if not self.is_pyramids:
-            embedding = f["embedding"]
+        f = self.embedding_store[str(img_data[AnnFileKeys.ID]).zfill(12)]
+        if self.lazy_dequantization:
+            # the embedding tensors and their scales, as stored
+            embedding = {
+                k: v
+                for k, v in f.items()
+                if is_embedding_key(k) or k.endswith(SCALE_SUFFIX)
+            }
+        elif not self.is_pyramids:
+            embedding = dequantize_tensors(f)["embedding"]
         else:
             # embedding is the subset of f with keys starting with "stage"
             embedding = {
-                k: v for k, v in f.items() if k.startswith("stage")
+                k: v for k, v in dequantize_tensors(f).items() if k.startswith("stage")
             }
         if self.load_gts:
-            gt = f[f"{self.name}_gt"]
+            if self.gt_store is not None:
+                gt = self.gt_store[img_data[AnnFileKeys.ID]]
+            else:
+                gt = f[f"{self.name}_gt"]
         return embedding, gt
 
     def _load_image(self, img_data: dict) -> Image:
@@ -271,11 +292,10 @@ class CocoLVISDataset(Dataset):
         Returns:
             PIL.Image: The loaded image.
         """
+        preprocess = self.preprocess if self.fast_decode else None
         if self.img_dir is not None:
-            return Image.open(f'{self.img_dir}/{img_data["file_name"]}').convert("RGB")
-        return Image.open(BytesIO(requests.get(img_data["coco_url"]).content)).convert(
-            "RGB"
-        )
+            return decode_image(f'{self.img_dir}/{img_data["file_name"]}', preprocess)
+        return decode_image(self.image_fetcher.get(img_data["coco_url"]), preprocess)
 
     def _load_and_preprocess_image(self, img_data: dict) -> torch.Tensor:
         """Load and preprocess an image.
@@ -329,19 +349,62 @@ class CocoLVISDataset(Dataset):
             num_classes=num_classes,
         )
 
-    def _sample_num_points(self, image_id: int, ann: dict) -> int:
+    def _decode_mask(
+        self,
+        row: int,
+        img_size: tuple[int, int],
+        decoded_masks: Optional[dict] = None,
+    ) -> np.ndarray:
+        """Decode the mask of an annotation, through the mask cache if enabled.
+
+        Args:
+            row (int): The row of the annotation in the annotation index.
+            img_size (tuple[int, int]): The image size (height, width).
+            decoded_masks (Optional[dict], optional): Masks decoded for the current episode, by row. Defaults to None.
+
+        Returns:
+            np.ndarray: The binary mask.
+        """
+        if decoded_masks is not None and row in decoded_masks:
+            return decoded_masks[row]
+        if self.mask_cache is None:
+            mask = self.prompts_processor.convert_mask(
+                self.annotation_index.segmentation(row), *img_size
+            )
+        else:
+            mask = self.mask_cache.get_or_decode(
+                self.annotation_index.annotation_id(row),
+                lambda: self.prompts_processor.convert_mask(
+                    self.annotation_index.segmentation(row), *img_size
+                ),
+            )
+        if decoded_masks is not None:
+            decoded_masks[row] = mask
+        return mask
+
+    def _get_decoded_mask(
+        self, row: int, decoded_masks: Optional[dict] = None
+    ) -> Optional[np.ndarray]:
+        """Return the mask of an annotation if it is already decoded, None otherwise."""
+        if decoded_masks is not None and row in decoded_masks:
+            return decoded_masks[row]
+        if self.mask_cache is not None:
+            return self.mask_cache.lookup(self.annotation_index.annotation_id(row))
+        return None
+
+    def _sample_num_points(self, image_id: int, area: float) -> int:
         """
         Calculate the number of points to sample for a given image and category proportionally to the area of the annotation.
 
         Args:
             image_id (int): The ID of the image.
-            ann (dict): The annotation.
+            area (float): The area of the annotation.
 
         Returns:
             int: The number of points to sample.
         """
         image_area = self.images[image_id]["height"] * self.images[image_id]["width"]
-        annotation_area = ann["area"] / image_area
+        annotation_area = area / image_area
         poisson_mean = self.max_points_per_annotation * np.sqrt(
             annotation_area
         )  # poisson mean is proportional to the square root of the area
@@ -349,21 +412,12 @@ class CocoLVISDataset(Dataset):
             np.random.poisson(poisson_mean) + 1, 1, self.max_points_per_annotation
         )
 
-    def _remove_small_annotations(self, ann: dict) -> bool:
-        """Remove annotation smaller than 2*32*32 pixels.
-
-        Args:
-            ann (dict): The annotation.
-
-        Returns:
-            bool: True if the annotation is too small, False otherwise.
-        """
-        if self.remove_small_annotations:
-            return ann["area"] < 2 * 32 * 32
-        return False
-
     def _get_prompts(
-        self, image_ids: list, cat_ids: list, possible_prompt_types: list[PromptType]
+        self,
+        image_ids: list,
+        cat_ids: list,
+        possible_prompt_types: list[PromptType],
+        decoded_masks: Optional[dict] = None,
     ) -> (list, list, list, list, list):
         """Get the annotations for the chosen examples.
 
@@ -371,6 +425,7 @@ class CocoLVISDataset(Dataset):
             image_ids (list): A list of image ids of the examples.
             cat_ids (list): A list of sets of category ids of the examples.
             possible_prompt_types (list[PromptType]): A list of possible prompt types to be sampled.
+            decoded_masks (Optional[dict], optional): Filled with the masks decoded for the mask prompts, by row, to be reused by compute_ground_truths. Defaults to None.
 
         Returns:
             (list, list, list, list, list): Returns five lists:
@@ -394,47 +449,57 @@ class CocoLVISDataset(Dataset):
         for i, (img_id, img_size) in enumerate(zip(image_ids, img_sizes)):
             for cat_id in cat_ids:
                 # for each pair (image img_id and category cat_id)
-                if cat_id not in self.img2cat_annotations[img_id]:
+                ann_rows = self.annotation_index.annotations(img_id, cat_id)
+                if len(ann_rows) == 0:
                     continue
                 classes[i].append(cat_id)
 
                 # get the prompt type for each annotation
-                n_ann = len(self.img2cat_annotations[img_id][cat_id])
+                n_ann = len(ann_rows)
                 if n_ann > self.max_points_annotations:
+                    if (
+                        self.prompt_mask_store is not None
+                        and not self.remove_small_annotations
+                    ):
+                        # the stored union covers exactly the annotations of the pair
+                        masks[i][cat_id].append(
+                            self.prompt_mask_store.pair_mask(img_id, cat_id)
+                        )
+                        continue
                     prompt_types = [PromptType.MASK] * n_ann
                 else:
                     prompt_types = random.choices(possible_prompt_types, k=n_ann)
-                for ann, prompt_type in zip(
-                    self.img2cat_annotations[img_id][cat_id], prompt_types
-                ):
+                for row, prompt_type in zip(ann_rows, prompt_types):
                     if prompt_type == PromptType.BBOX:
                         # take the bbox
                         bboxes[i][cat_id].append(
                             self.prompts_processor.convert_bbox(
-                                ann["bbox"],
+                                self.annotation_index.bbox(row),
                                 *img_size,
                                 noise=self.add_box_noise,
                             ),
                         )
                     elif prompt_type == PromptType.MASK:
                         # take the mask
-                        masks[i][cat_id].append(
-                            self.prompts_processor.convert_mask(
-                                ann[AnnFileKeys.SEGMENTATION],
-                                *img_size,
+                        if self.prompt_mask_store is not None:
+                            mask = self.prompt_mask_store.annotation_mask(
+                                self.annotation_index.annotation_id(row)
                             )
-                        )
+                        else:
+                            mask = self._decode_mask(row, img_size, decoded_masks)
+                        masks[i][cat_id].append(mask)
                     elif prompt_type == PromptType.POINT:
-                        # take the point
-                        mask = self.prompts_processor.convert_mask(
-                            ann[AnnFileKeys.SEGMENTATION],
-                            *img_size,
+                        # take the points
+                        num_points = self._sample_num_points(
+                            img_id, self.annotation_index.area(row)
                         )
-                        num_points = self._sample_num_points(img_id, ann)
-                        for _ in range(num_points):
-                            points[i][cat_id].append(
-                                self.prompts_processor.sample_point(mask)
+                        points[i][cat_id].extend(
+                            self.prompts_processor.sample_points(
+                                self.annotation_index.segmentation(row),
+                                *img_size,
+                                num_points,
                             )
+                        )
 
         # convert the lists of prompts to arrays
         for i in range(len(image_ids)):
@@ -444,6 +509,26 @@ class CocoLVISDataset(Dataset):
                 points[i][cat_id] = np.array((points[i][cat_id]))
         return bboxes, masks, points, classes, img_sizes
 
+    def _masks_to_tensor(
+        self, masks: list, img_sizes: list
+    ) -> (torch.Tensor, torch.Tensor):
+        """Convert the mask prompts returned by _get_prompts to a tensor.
+
+        Args:
+            masks (list): A list of dicts mapping category ids to arrays of masks.
+            img_sizes (list): A list of tuples containing the image sizes.
+
+        Returns:
+            (torch.Tensor, torch.Tensor): The tensor containing the masks and their flags.
+        """
+        if self.prompt_mask_store is not None:
+            return utils.resized_masks_to_tensor(
+                masks, self.prompt_mask_store.masks_side_length
+            )
+        return utils.annotations_to_tensor(
+            self.prompts_processor, masks, img_sizes, PromptType.MASK
+        )
+
     def _get_images_or_embeddings(
         self, image_ids: list[int]
     ) -> (torch.Tensor, str, Optional[torch.Tensor]):
@@ -464,7 +549,7 @@ class CocoLVISDataset(Dataset):
             if not self.load_gts:
                 gts = None
 
-            if not self.is_pyramids:
+            if isinstance(embeddings[0], torch.Tensor):
                 embeddings = torch.stack(embeddings)
             else:
                 embeddings = {
@@ -477,55 +562,72 @@ class CocoLVISDataset(Dataset):
                 for image_data in [self.images[image_id] for image_id in image_ids]
             ]
             gts = None
+            if self.load_gts and self.gt_store is not None:
+                gts = [self.gt_store[image_id] for image_id in image_ids]
             return torch.stack(images), BatchKeys.IMAGES, gts
 
     def compute_ground_truths(
-        self, image_ids: list[int], cat_ids: list[int]
+        self,
+        image_ids: list[int],
+        cat_ids: list[int],
+        decoded_masks: Optional[dict] = None,
     ) -> list[torch.Tensor]:
         """Compute the ground truths for the given image ids and category ids.
 
+        Label maps are painted in a single pass over the annotations: masks already decoded
+        (for the prompts of the episode, or in the mask cache) are reused, the others are painted
+        from their RLE runs without being decoded.
+
         Args:
             image_ids (list[int]): Image ids.
             cat_ids (list[int]): Category ids.
+            decoded_masks (Optional[dict], optional): Masks decoded by _get_prompts for the same episode. Defaults to None.
 
         Returns:
-            list[torch.Tensor]: A list of tensors containing the ground truths (per image).
+            list[torch.Tensor]: A list of tensors containing the ground truths (per image), as category indices in a compact dtype.
         """
-        ground_truths = []
+        cat_idxs = {}
+        for cat_idx, cat_id in enumerate(cat_ids):
+            cat_idxs.setdefault(cat_id, cat_idx)
+        dtype = np.uint8 if len(cat_ids) <= np.iinfo(np.uint8).max + 1 else np.uint16
 
-        # generate masks
-        for i, image_id in enumerate(image_ids):
-            img_size = (self.images[image_id]["height"], self.images[image_id]["width"])
-            ground_truths.append(np.zeros(img_size, dtype=np.int64))
-
-            for ann in self.img_annotations[image_id]:
-                ann_cat = ann[AnnFileKeys.CATEGORY_ID]
-                if ann_cat not in cat_ids:
+        ground_truths = []
+        for image_id in image_ids:
+            h, w = self.images[image_id]["height"], self.images[image_id]["width"]
+            # column-major buffer, so that RLE runs are contiguous
+            label_map = np.zeros((w, h), dtype=dtype)
+            flat_label_map = label_map.reshape(-1)
+
+            for row in self.annotation_index.image_annotations(image_id):
+                cat_idx = cat_idxs.get(self.annotation_index.category_id(row))
+                if cat_idx is None:
                     continue
-                cat_idx = cat_ids.index(ann_cat)
-
-                ann_mask = self.prompts_processor.convert_mask(
-                    ann[AnnFileKeys.SEGMENTATION], *img_size
-                )
-                ground_truths[i][ann_mask == 1] = cat_idx
+                ann_mask = self._get_decoded_mask(row, decoded_masks)
+                if ann_mask is not None:
+                    label_map[ann_mask.T == 1] = cat_idx
+                else:
+                    runs = self.prompts_processor.rle_runs(
+                        self.annotation_index.segmentation(row), h, w
+                    )
+                    flat_label_map[runs_to_positions(*runs)] = cat_idx
 
-        return [torch.tensor(x) for x in ground_truths]
+            if dtype == np.uint16:
+                # torch has no uint16 tensors
+                label_map = label_map.astype(np.int32)
+            ground_truths.append(torch.from_numpy(label_map.T))
+        return ground_truths
 
-    def __getitem__(self, idx_metadata: tuple[int, int]) -> dict:
-        """Get an item from the dataset.
+    def plan_episode(self, idx: int, batch_metadata: dict) -> (list[int], list[int]):
+        """Choose the examples and the categories of the episode of a query image.
 
         Args:
-            idx_metadata (tuple[int, dict]): A tuple containing the index of the image and the batch level metadata e.g. number of examples to be chosen and type of prompts.
+            idx (int): The index of the query image.
+            batch_metadata (dict): The batch level metadata (number of examples and classes).
 
         Returns:
-            dict: A dictionary containing the data.
+            (list[int], list[int]): The image ids (query first) and the sorted category ids.
         """
-        idx, batch_metadata = idx_metadata
-
         num_examples = batch_metadata[BatchMetadataKeys.NUM_EXAMPLES]
-        possible_prompt_types = batch_metadata[BatchMetadataKeys.PROMPT_TYPES]
-        if batch_metadata[BatchMetadataKeys.PROMPT_CHOICE_LEVEL] == "episode":
-            possible_prompt_types = random.choice(possible_prompt_types)
         num_classes = batch_metadata.get(BatchMetadataKeys.NUM_CLASSES, None)
 
         base_image_data = self.images[self.image_ids[idx]]
@@ -538,31 +640,72 @@ class CocoLVISDataset(Dataset):
                 set(self.img2cat[img]) for img in image_ids[1:]
             ]  # check if self.images must be called before
 
-        cat_ids = sorted(list(set(itertools.chain(*aux_cat_ids))))
+        return list(image_ids), sorted(list(set(itertools.chain(*aux_cat_ids))))
+
+    def prefetch_images(self, idx: int, batch_metadata: dict):
+        """Start downloading the images of the episode of a query image in the
+        background, when they are loaded from their url. Only the query image is known in
+        advance, unless the episode comes from an episode plan.
+
+        Args:
+            idx (int): The index of the query image.
+            batch_metadata (dict): The batch level metadata.
+        """
+        if self.image_fetcher is None or self.load_embeddings:
+            return
+        episode = batch_metadata.get(BatchMetadataKeys.EPISODE)
+        image_ids = episode[0] if episode is not None else [self.image_ids[idx]]
+        self.image_fetcher.prefetch(
+            self.images[image_id]["coco_url"] for image_id in image_ids
+        )
+
+    def __getitem__(self, idx_metadata: tuple[int, int]) -> dict:
+        """Get an item from the dataset.
+
+        Args:
+            idx_metadata (tuple[int, dict]): A tuple containing the index of the image and the batch level metadata e.g. number of examples to be chosen and type of prompts.
+
+        Returns:
+            dict: A dictionary containing the data.
+        """
+        idx, batch_metadata = idx_metadata
+
+        possible_prompt_types = batch_metadata[BatchMetadataKeys.PROMPT_TYPES]
+        if batch_metadata[BatchMetadataKeys.PROMPT_CHOICE_LEVEL] == "episode":
+            possible_prompt_types = random.choice(possible_prompt_types)
+
+        episode = batch_metadata.get(BatchMetadataKeys.EPISODE)
+        if episode is not None:
+            # precomputed by the episode plan
+            image_ids, cat_ids = episode
+            image_ids, cat_ids = list(image_ids), list(cat_ids)
+        else:
+            image_ids, cat_ids = self.plan_episode(idx, batch_metadata)
         cat_ids.insert(0, -1)  # add the background class
 
         # load, stack and preprocess the images
         images, image_key, ground_truths = self._get_images_or_embeddings(image_ids)
 
         # create the prompt dicts
+        decoded_masks = {}
         bboxes, masks, points, classes, img_sizes = self._get_prompts(
-            image_ids, cat_ids, possible_prompt_types
+            image_ids, cat_ids, possible_prompt_types, decoded_masks
         )
 
         # obtain padded tensors
         bboxes, flag_bboxes = utils.annotations_to_tensor(
             self.prompts_processor, bboxes, img_sizes, PromptType.BBOX
         )
-        masks, flag_masks = utils.annotations_to_tensor(
-            self.prompts_processor, masks, img_sizes, PromptType.MASK
-        )
+        masks, flag_masks = self._masks_to_tensor(masks, img_sizes)
         points, flag_points = utils.annotations_to_tensor(
             self.prompts_processor, points, img_sizes, PromptType.POINT
         )
 
         # obtain ground truths
         if ground_truths is None:
-            ground_truths = self.compute_ground_truths(image_ids, cat_ids)
+            ground_truths = self.compute_ground_truths(
+                image_ids, cat_ids, decoded_masks
+            )
 
         # stack ground truths
         dims = torch.tensor(img_sizes)
@@ -582,6 +725,18 @@ class CocoLVISDataset(Dataset):
                     continue
                 ground_truths[ground_truths_copy == cat_id] = i
 
+        if self.target_size is not None:
+            ground_truths = torch.stack(
+                [
+                    utils.resize_gt(
+                        gt[:h, :w],
+                        self.target_size,
+                        self.prompts_processor.custom_preprocess,
+                    )
+                    for gt, (h, w) in zip(ground_truths, img_sizes)
+                ]
+            )
+
         flag_examples = flags_merge(flag_masks, flag_points, flag_bboxes)
 
         data_dict = {
@@ -598,8 +753,65 @@ class CocoLVISDataset(Dataset):
             BatchKeys.IMAGE_IDS: image_ids,
             BatchKeys.GROUND_TRUTHS: ground_truths,
         }
+        if self.target_size is not None:
+            data_dict[BatchKeys.TARGET_SIZE] = self.target_size
         return data_dict
 
+    def episode_sizes(self) -> (np.ndarray, np.ndarray):
+        """Number of categories and largest number of annotations of a category of each
+        query image, in dataset order. Used by the sampler to estimate the padded size of
+        the episodes before loading them.
+
+        Returns:
+            (np.ndarray, np.ndarray): The number of categories and of annotations.
+        """
+        index = self.annotation_index
+        num_categories = np.diff(index.img_cat_offsets)
+        pair_images = np.repeat(np.arange(len(index.image_ids)), num_categories)
+        max_annotations = np.zeros(len(index.image_ids), dtype=np.int64)
+        np.maximum.at(max_annotations, pair_images, np.diff(index.pair_ann_offsets))
+        idxs = np.searchsorted(index.image_ids, self.image_ids)
+        return num_categories[idxs], max_annotations[idxs]
+
+    def export_sample(self, idx: int) -> dict:
+        """Gather everything stored for the query image idx, to be packed in a shard (see
+        label_anything.data.shards).
+
+        Args:
+            idx (int): The index of the image.
+
+        Returns:
+            dict: A dictionary with:
+                - key: The key of the image in the embedding store.
+                - json: The image data and its annotations, as in the instances file.
+                - jpg: The encoded image, if img_dir is set.
+                - safetensors: The stored tensors (embeddings and ground truths), if emb_dir is set.
+        """
+        image_data = self.images[self.image_ids[idx]]
+        key = str(image_data[AnnFileKeys.ID]).zfill(12)
+        annotations = []
+        for row in self.annotation_index.image_annotations(image_data[AnnFileKeys.ID]):
+            annotation = self.annotation_index.packed.annotation(row)
+            segmentation = annotation[AnnFileKeys.SEGMENTATION]
+            segmentation["counts"] = segmentation["counts"].decode()
+            annotations.append(annotation)
+
+        image = None
+        if self.img_dir is not None:
+            with open(f'{self.img_dir}/{image_data["file_name"]}', "rb") as f:
+                image = f.read()
+        tensors = None
+        if self.embedding_store is not None:
+            tensors = dict(self.embedding_store[key])
+            if self.gt_store is not None:
+                tensors[f"{self.name}_gt"] = self.gt_store[image_data[AnnFileKeys.ID]]
+        return {
+            "key": key,
+            "json": {"image": image_data, "annotations": annotations},
+            "jpg": image,
+            "safetensors": tensors,
+        }
+
     def __len__(self):
         return len(self.images)
 
@@ -760,12 +972,11 @@ class CocoLVISTestDataset(CocoLVISDataset, LabelAnythingTestDataset):
                         )
                     elif prompt_type == PromptType.POINT:
                         # take the point
-                        mask = self.prompts_processor.convert_mask(
-                            ann[AnnFileKeys.SEGMENTATION],
-                            *img_size,
-                        )
-                        points[i][cat_id].append(
-                            self.prompts_processor.sample_point(mask)
+                        points[i][cat_id].extend(
+                            self.prompts_processor.sample_points(
+                                ann[AnnFileKeys.SEGMENTATION],
+                                *img_size,
+                            )
                         )
 
         # convert the lists of prompts to arrays
@@ -828,17 +1039,21 @@ class CocoLVISTestDataset(CocoLVISDataset, LabelAnythingTestDataset):
 
 
 class LabelAnyThingOnlyImageDataset(Dataset):
-    def __init__(self, directory=None, preprocess=None):
+    def __init__(self, directory=None, preprocess=None, fast_decode=False):
         super().__init__()
         self.directory = directory
         self.files = os.listdir(directory)
         self.preprocess = preprocess
+        self.fast_decode = fast_decode
 
     def __len__(self):
         return len(self.files)
 
     def __getitem__(self, item):
-        img = Image.open(os.path.join(self.directory, self.files[item])).convert("RGB")
+        img = decode_image(
+            os.path.join(self.directory, self.files[item]),
+            self.preprocess if self.fast_decode else None,
+        )
         image_id, _ = os.path.splitext(self.files[item])
         return self.preprocess(img), image_id  # load image
 
@@ -6,7 +6,6 @@ import label_anything.data.utils as utils
 from label_anything.data.coco import CocoLVISDataset
 from label_anything.data.examples import build_example_generator
 from label_anything.data.utils import (
-    AnnFileKeys,
     BatchKeys,
     BatchMetadataKeys,
     PromptType,
@@ -81,24 +80,13 @@ class Coco20iDataset(CocoLVISDataset):
             k: v for i, (k, v) in enumerate(self.categories.items()) if i in idxs
         }
 
-        # update dicts
-        (
-            self.image_annotations,
-            self.img2cat,
-            self.img2cat_annotations,
-            self.cat2img,
-            self.cat2img_annotations,
-        ) = self._load_annotation_dicts()
-
-        # load image ids and info
-        instances = utils.load_instances(self.instances_path)
-        img2cat_keys = set(self.img2cat.keys())
-        self.images = {
-            x[AnnFileKeys.ID]: x
-            for x in instances[AnnFileKeys.IMAGES]
-            if x[AnnFileKeys.ID] in img2cat_keys
-        }
-        self.image_ids = list(self.images.keys())
+        # update the annotation index
+        category_ids = list(self.categories.keys())
+        if self.annotations_cache_dir is not None:
+            packed = self._load_packed_instances(category_ids=category_ids)
+        else:
+            packed = self.annotation_index.packed.filter_categories(category_ids)
+        self._load_annotation_index(packed)
 
         # example generator/selector
         self.example_generator = build_example_generator(
@@ -108,6 +96,13 @@ class Coco20iDataset(CocoLVISDataset):
             images_to_categories=self.img2cat,
         )
 
+    def plan_episode(self, idx: int, batch_metadata: dict):
+        """Plan the episode as the COCO dataset, only where __getitem__ builds it the same
+        way (the val split samples its own episodes)."""
+        if self.split == Coco20iSplit.TRAIN or self.n_shots == "min":
+            return super().plan_episode(idx, batch_metadata)
+        return None
+
     def __getitem__(self, idx_batchmetadata: tuple[int, int]) -> dict:
         """Get an item from the dataset. Preserves the original functionality
         of the COCO dataset for the train split. For the val split, it samples
@@ -149,24 +144,28 @@ class Coco20iDataset(CocoLVISDataset):
             images, image_key, ground_truths = self._get_images_or_embeddings(image_ids)
 
             # create the prompt dicts
+            decoded_masks = {}
             bboxes, masks, points, classes, img_sizes = self._get_prompts(
-                image_ids, cat_ids, metadata[BatchMetadataKeys.PROMPT_TYPES]
+                image_ids,
+                cat_ids,
+                metadata[BatchMetadataKeys.PROMPT_TYPES],
+                decoded_masks,
             )
 
             # obtain padded tensors
             bboxes, flag_bboxes = annotations_to_tensor(
                 self.prompts_processor, bboxes, img_sizes, PromptType.BBOX
             )
-            masks, flag_masks = annotations_to_tensor(
-                self.prompts_processor, masks, img_sizes, PromptType.MASK
-            )
+            masks, flag_masks = self._masks_to_tensor(masks, img_sizes)
             points, flag_points = annotations_to_tensor(
                 self.prompts_processor, points, img_sizes, PromptType.POINT
             )
 
             # obtain ground truths
             if ground_truths is None:
-                ground_truths = self.compute_ground_truths(image_ids, cat_ids)
+                ground_truths = self.compute_ground_truths(
+                    image_ids, cat_ids, decoded_masks
+                )
 
             # stack ground truths
             dims = torch.tensor(img_sizes)
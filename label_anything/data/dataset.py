@@ -1,11 +1,16 @@
+import os
 import random
+import numpy as np
 import torch
 import itertools
 
-from typing import Any, Dict, List, Tuple
+from bisect import bisect_right
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
 from torch.utils.data import Dataset, BatchSampler
 
 import label_anything.data.utils as utils
+from label_anything.data.episode_plan import EpisodePlan, episode_plan_path
 from label_anything.data.coco import CocoLVISDataset
 from label_anything.data.coco20i import Coco20iDataset
 from label_anything.data.pascal import PascalDataset
@@ -29,14 +34,27 @@ datasets = {
 
 
 class LabelAnythingDataset(Dataset):
-    def __init__(self, datasets_params: Dict, common_params: Dict) -> None:
+    def __init__(
+        self,
+        datasets_params: Dict,
+        common_params: Dict,
+        pin_memory: bool = False,
+        mixing_ratios: Optional[Dict[str, float]] = None,
+    ) -> None:
         """
         Initializes a LabelAnythingDataset Dataset object.
 
         Args:
             datasets_params (Dict): A dictionary containing the parameters for each dataset.
             common_params (Dict): A dictionary containing the common parameters for all datasets.
+            pin_memory (bool): Allocate the collated batches in pinned memory. Only useful when collating in the
+                main process (num_workers=0), as tensors sent back by the workers are not pinned.
+            mixing_ratios (Optional[Dict[str, float]]): Relative weight of each dataset. The length of the dataset
+                is unchanged, but each dataset gets a share of the indices proportional to its weight, so smaller
+                datasets are repeated and larger ones are strided over. The stride starts at a different offset
+                every epoch (see `set_epoch`), so that all the samples are seen. Defaults to None (every sample once).
         """
+        self.pin_memory = pin_memory
 
         self.datasets = {
             dataset_name: datasets[dataset_name](**{**common_params, **params})
@@ -46,19 +64,59 @@ class LabelAnythingDataset(Dataset):
             dataset_name: dataset.categories
             for dataset_name, dataset in self.datasets.items()
         }
-        index = sum(
-            [
-                [(dataset_name, i) for i in range(len(dataset))]
-                for dataset_name, dataset in self.datasets.items()
-            ],
-            [],
-        )
-        self.index = {i: index for i, index in enumerate(index)}
+        # global indices are mapped to the datasets through cumulative offsets
+        self.dataset_names = list(self.datasets.keys())
+        self.dataset_lengths = [len(dataset) for dataset in self.datasets.values()]
+        self.index_lengths = self._get_index_lengths(mixing_ratios)
+        self.offsets = np.cumsum([0] + self.index_lengths).tolist()
+        self.epoch = 0
 
         super().__init__()
 
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch, which selects the samples of the datasets strided over by mixing_ratios. Must be called
+        before the DataLoader workers are started.
+        """
+        self.epoch = epoch
+
+    def _get_index_lengths(
+        self, mixing_ratios: Optional[Dict[str, float]]
+    ) -> List[int]:
+        if mixing_ratios is None:
+            return self.dataset_lengths
+        if set(mixing_ratios.keys()) != set(self.dataset_names):
+            raise ValueError(
+                f"mixing_ratios must have a ratio for each dataset: {self.dataset_names}"
+            )
+        total_ratio = sum(mixing_ratios.values())
+        total_length = sum(self.dataset_lengths)
+        return [
+            round(mixing_ratios[name] / total_ratio * total_length)
+            for name in self.dataset_names
+        ]
+
+    def _dataset_positions(self, i: int, positions):
+        """
+        Maps positions in the share of indices of the i-th dataset to indices in it. When the dataset has more
+        samples than indices, the stride (at most ceil(dataset_length / index_length)) is shifted by one sample
+        every epoch, so that every sample is used once every ceil(dataset_length / index_length) epochs.
+        """
+        index_length, dataset_length = self.index_lengths[i], self.dataset_lengths[i]
+        if index_length >= dataset_length:
+            return positions * dataset_length // max(index_length, 1)
+        shift = self.epoch % -(-dataset_length // index_length)
+        return (positions * dataset_length // index_length + shift) % dataset_length
+
+    def _dataset_index(self, idx: int) -> Tuple[str, int]:
+        """Returns the name of the dataset of a global index and the index in it."""
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} out of range for length {len(self)}")
+        i = bisect_right(self.offsets, idx) - 1
+        return self.dataset_names[i], self._dataset_positions(i, idx - self.offsets[i])
+
     def __len__(self):
-        return sum([len(dataset) for dataset in self.datasets.values()])
+        return self.offsets[-1]
 
     def __getitem__(self, idx_metadata) -> Any:
         """
@@ -71,12 +129,56 @@ class LabelAnythingDataset(Dataset):
             Any: The item at the given index.
         """
         idx, batch_metadata = idx_metadata
-        dataset_name, dataset_index = self.index[idx]
+        dataset_name, dataset_index = self._dataset_index(idx)
         return (
             self.datasets[dataset_name][(dataset_index, batch_metadata)],
             dataset_name,
         )
 
+    def plan_episode(
+        self, idx: int, batch_metadata: Dict
+    ) -> Optional[Tuple[List[int], List[int]]]:
+        """
+        Returns the image ids (query first) and the category ids of the episode of the given index, as chosen by
+        its dataset, or None if the dataset can not plan its episodes in advance.
+        """
+        dataset_name, dataset_index = self._dataset_index(idx)
+        dataset = self.datasets[dataset_name]
+        if not hasattr(dataset, "plan_episode"):
+            return None
+        return dataset.plan_episode(dataset_index, batch_metadata)
+
+    def prefetch(self, batch: List[Tuple[int, Dict]]) -> None:
+        """
+        Starts loading the images of a batch of (index, metadata) pairs in the background, in the datasets that
+        support it (see CocoLVISDataset.prefetch_images).
+        """
+        for idx, batch_metadata in batch:
+            dataset_name, dataset_index = self._dataset_index(idx)
+            dataset = self.datasets[dataset_name]
+            if hasattr(dataset, "prefetch_images"):
+                dataset.prefetch_images(dataset_index, batch_metadata)
+
+    def episode_sizes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the number of categories and the largest number of annotations of a category of each query image,
+        indexed as the dataset. Datasets that can not tell count as 1 category with 1 annotation.
+        """
+        sizes = []
+        for i, (dataset, index_length) in enumerate(
+            zip(self.datasets.values(), self.index_lengths)
+        ):
+            dataset_sizes = (
+                dataset.episode_sizes() if hasattr(dataset, "episode_sizes") else None
+            )
+            if dataset_sizes is None or len(dataset_sizes[0]) != len(dataset):
+                ones = np.ones(len(dataset), dtype=np.int64)
+                dataset_sizes = (ones, ones)
+            idxs = self._dataset_positions(i, np.arange(index_length))
+            sizes.append(tuple(x[idxs] for x in dataset_sizes))
+        num_categories, num_annotations = zip(*sizes)
+        return np.concatenate(num_categories), np.concatenate(num_annotations)
+
     def load_and_preprocess_images(self, dataset_name, image_ids):
         return self.datasets[dataset_name].load_and_preprocess_images(image_ids)
 
@@ -140,54 +242,71 @@ class LabelAnythingDataset(Dataset):
             The batched output masks is a torch tensor of shape B x H x W.
         """
         batched_input, dataset_names = zip(*batched_input)
+        pin_memory = self.pin_memory
+        # every output is allocated once, at its padded size, and filled with slice copies
         # classes
-        max_classes = max([x["prompt_masks"].size(1) for x in batched_input])
+        num_examples, max_classes = torch.tensor(
+            [x["prompt_masks"].shape[:2] for x in batched_input]
+        ).amax(dim=0).tolist()
 
-        # gt
+        # gt, either at the original resolution (padded to the largest image of the
+        # episode) or all at target_size
         dims = torch.stack([x["dims"] for x in batched_input])
-        max_dims = torch.max(dims.view(-1, 2), 0).values.tolist()
-        ground_truths = [x["ground_truths"] for x in batched_input]
-        ground_truths = torch.stack(
-            [utils.collate_batch_gts(x, max_dims) for x in ground_truths]
+        ground_truths = utils.pad_and_stack(
+            [x["ground_truths"] for x in batched_input],
+            fill_value=-100,
+            dtype=torch.long,
+            pin_memory=pin_memory,
         )
 
         # prompt mask
         masks = [x["prompt_masks"] for x in batched_input]
-        flags = [x["flag_masks"] for x in batched_input]
-        masks_flags = [
-            utils.collate_mask(m, f, max_classes) for (m, f) in zip(masks, flags)
-        ]
-        masks = torch.stack([x[0] for x in masks_flags])
-        flag_masks = torch.stack([x[1] for x in masks_flags])
+        masks = utils.pad_and_stack(
+            masks,
+            (num_examples, max_classes, *masks[0].shape[2:]),
+            pin_memory=pin_memory,
+        )
+        flag_masks = utils.pad_and_stack(
+            [x["flag_masks"] for x in batched_input],
+            (num_examples, max_classes),
+            pin_memory=pin_memory,
+        )
 
         # prompt bbox
-        bboxes = [x["prompt_bboxes"] for x in batched_input]
-        flags = [x["flag_bboxes"] for x in batched_input]
-        max_annotations = max(x.size(2) for x in bboxes)
-        bboxes_flags = [
-            utils.collate_bbox(bboxes[i], flags[i], max_classes, max_annotations)
-            for i in range(len(bboxes))
-        ]
-        bboxes = torch.stack([x[0] for x in bboxes_flags])
-        flag_bboxes = torch.stack([x[1] for x in bboxes_flags])
+        max_annotations = max(x["prompt_bboxes"].size(2) for x in batched_input)
+        bboxes = utils.pad_and_stack(
+            [x["prompt_bboxes"] for x in batched_input],
+            (num_examples, max_classes, max_annotations, 4),
+            dtype=torch.float,
+            pin_memory=pin_memory,
+        )
+        flag_bboxes = utils.pad_and_stack(
+            [x["flag_bboxes"] for x in batched_input],
+            (num_examples, max_classes, max_annotations),
+            dtype=torch.float,
+            pin_memory=pin_memory,
+        )
 
         # prompt coords
-        points = [x["prompt_points"] for x in batched_input]
-        flags = [x["flag_points"] for x in batched_input]
-        max_annotations = max(x.size(2) for x in points)
-        points_flags = [
-            utils.collate_coords(points[i], flags[i], max_classes, max_annotations)
-            for i in range(len(points))
-        ]
-        points = torch.stack([x[0] for x in points_flags])
-        flag_points = torch.stack([x[1] for x in points_flags])
+        max_annotations = max(x["prompt_points"].size(2) for x in batched_input)
+        points = utils.pad_and_stack(
+            [x["prompt_points"] for x in batched_input],
+            (num_examples, max_classes, max_annotations, 2),
+            dtype=torch.float,
+            pin_memory=pin_memory,
+        )
+        flag_points = utils.pad_and_stack(
+            [x["flag_points"] for x in batched_input],
+            (num_examples, max_classes, max_annotations),
+            dtype=torch.float,
+            pin_memory=pin_memory,
+        )
 
         # flag examples
-        flag_examples = torch.stack(
-            [
-                utils.collate_example_flags(x["flag_examples"], max_classes)
-                for x in batched_input
-            ]
+        flag_examples = utils.pad_and_stack(
+            [x["flag_examples"] for x in batched_input],
+            (num_examples, max_classes),
+            pin_memory=pin_memory,
         )
 
         # aux gts
@@ -196,24 +315,32 @@ class LabelAnythingDataset(Dataset):
         # image ids
         image_ids = [x["image_ids"] for x in batched_input]
 
-        # flag_gts
-        flag_gts = torch.zeros((len(batched_input), max_classes), dtype=torch.bool)
-        for i, x in enumerate(classes):
-            flag_gts[i, : len(list(set(itertools.chain(*x)))) + 1] = 1
+        # flag_gts: the background and the classes of the episode
+        num_gts = torch.tensor(
+            [len(set(itertools.chain(*x))) + 1 for x in classes]
+        )
+        flag_gts = torch.arange(max_classes) < num_gts[:, None]
 
         # images
         if "embeddings" in batched_input[0].keys():
             image_key = "embeddings"
             if isinstance(batched_input[0][image_key], torch.Tensor):
-                images = torch.stack([x[image_key] for x in batched_input])
+                images = utils.pad_and_stack(
+                    [x[image_key] for x in batched_input], pin_memory=pin_memory
+                )
             else:
                 images = {
-                    k: torch.stack([x[image_key][k] for x in batched_input])
+                    k: utils.pad_and_stack(
+                        [x[image_key][k] for x in batched_input],
+                        pin_memory=pin_memory,
+                    )
                     for k in batched_input[0][image_key].keys()
                 }
         else:
             image_key = "images"
-            images = torch.stack([x["images"] for x in batched_input])
+            images = utils.pad_and_stack(
+                [x["images"] for x in batched_input], pin_memory=pin_memory
+            )
 
         data_dict = {
             image_key: images,
@@ -229,33 +356,47 @@ class LabelAnythingDataset(Dataset):
             "image_ids": image_ids,
             "flag_gts": flag_gts,
         }
+        target_sizes = {x.get("target_size") for x in batched_input}
+        assert (
+            len(target_sizes) == 1
+        ), "All the datasets in a batch must have the same target_size."
+        target_size = target_sizes.pop()
+        if target_size is not None:
+            data_dict["target_size"] = target_size
 
         return (data_dict, ground_truths), dataset_names
 
 
+def get_prompt_combinations(possible_prompts):
+    """Returns all the non empty combinations of the possible prompt types."""
+    combs = [
+        list(itertools.combinations(possible_prompts, i))
+        for i in range(1, len(possible_prompts) + 1)
+    ]
+    return [x for comb in combs for x in comb]
+
+
 def get_batch_metadata(
     dataset_len,
     possible_batch_example_nums,
     possible_prompts,
     prompt_choice_level,
     num_processes=1,
+    rng=random,
 ):
     """
     Returns a list of number of examples per batch and a list of batch sizes
-    such that the total number of examples is `batch_size * max_num_examples`
+    such that the total number of examples is `batch_size * max_num_examples`.
+    Batch shapes are drawn from `rng` (the `random` module by default).
     """
     examples_nums = []
     batch_sizes = []
     prompt_types = []
     num_classes = []
-    combs = [
-        list(itertools.combinations(possible_prompts, i))
-        for i in range(1, len(possible_prompts) + 1)
-    ]
-    multi_combs = [x for comb in combs for x in comb]
+    multi_combs = get_prompt_combinations(possible_prompts)
     remaining_images = dataset_len // num_processes
     while remaining_images > 0:
-        res = random.choice(possible_batch_example_nums)
+        res = rng.choice(possible_batch_example_nums)
         num_class = None
         if len(res) == 2:
             cur_batch_size, examples_num = res
@@ -265,7 +406,7 @@ def get_batch_metadata(
             raise ValueError("Invalid number of elements in the batch metadata.")
         if cur_batch_size > remaining_images:
             cur_batch_size = remaining_images
-        prompt_type = random.choice(multi_combs)
+        prompt_type = rng.choice(multi_combs)
         prompt_types.append(prompt_type)
         examples_nums.append(examples_num)
         batch_sizes.append(cur_batch_size)
@@ -301,6 +442,120 @@ def get_batch_metadata(
     return batch_sizes, batch_metadata
 
 
+def get_cost_balanced_batches(
+    num_categories,
+    num_annotations,
+    possible_batch_example_nums,
+    possible_prompts,
+    prompt_choice_level,
+    max_batch_cost,
+    num_processes=1,
+    shuffle=False,
+):
+    """
+    Groups the samples in batches of similar padded cost, B x M x C x N (batch size, number of examples, classes
+    and annotations per class), where C and N are estimated from the query image. Samples are sorted by cost
+    buckets (powers of two, randomly within a bucket if shuffling) and batches are filled until either the batch
+    size drawn from `possible_batch_example_nums` or `max_batch_cost` is reached, so every step does a similar
+    amount of work. As in `get_batch_metadata`, each batch shape is repeated `num_processes` times, for the
+    batches processed at the same step, and it is computed on the samples of all of them.
+
+    Returns:
+        The list of batches of sample indices, the list of batch sizes and the batch metadata.
+    """
+    multi_combs = get_prompt_combinations(possible_prompts)
+    # + 1 for the background class
+    sample_costs = (np.asarray(num_categories) + 1) * np.maximum(
+        np.asarray(num_annotations), 1
+    )
+    if shuffle:
+        order = np.random.permutation(len(sample_costs))
+    else:
+        order = np.arange(len(sample_costs))
+    buckets = np.floor(np.log2(sample_costs[order])).astype(np.int64)
+    order = order[np.argsort(buckets, kind="stable")].tolist()
+
+    step_batches = []
+    examples_nums = []
+    batch_sizes = []
+    prompt_types = []
+    num_classes = []
+    start = 0
+    while len(order) - start >= num_processes:
+        res = random.choice(possible_batch_example_nums)
+        num_class = None
+        if len(res) == 2:
+            max_batch_size, examples_num = res
+        elif len(res) == 3:
+            max_batch_size, num_class, examples_num = res
+        else:
+            raise ValueError("Invalid number of elements in the batch metadata.")
+        max_batch_size = min(max_batch_size, (len(order) - start) // num_processes)
+        # grow the batch while the padded cost of the step stays in budget
+        batch_size = 1
+        max_cost = sample_costs[order[start : start + num_processes]].max()
+        while batch_size < max_batch_size:
+            step = order[start : start + (batch_size + 1) * num_processes]
+            cost = max(max_cost, sample_costs[step[-num_processes:]].max())
+            if (batch_size + 1) * examples_num * cost > max_batch_cost:
+                break
+            batch_size += 1
+            max_cost = cost
+        step = order[start : start + batch_size * num_processes]
+        step_batches.append(
+            [step[i * batch_size : (i + 1) * batch_size] for i in range(num_processes)]
+        )
+        prompt_types.append(random.choice(multi_combs))
+        examples_nums.append(examples_num)
+        batch_sizes.append(batch_size)
+        if num_class is not None:
+            num_classes.append(num_class)
+        start += batch_size * num_processes
+
+    # steps are visited in random order, not from the cheapest to the most expensive
+    steps = list(range(len(step_batches)))
+    if shuffle:
+        random.shuffle(steps)
+    batches = [batch for i in steps for batch in step_batches[i]]
+    batch_sizes = [batch_sizes[i] for i in steps for _ in range(num_processes)]
+    examples_nums = [examples_nums[i] for i in steps for _ in range(num_processes)]
+    prompt_types = [prompt_types[i] for i in steps for _ in range(num_processes)]
+    if prompt_choice_level == "episode":
+        prompt_types = multi_combs
+    batch_metadata = {
+        utils.BatchMetadataKeys.NUM_EXAMPLES: examples_nums,
+        utils.BatchMetadataKeys.PROMPT_TYPES: prompt_types,
+    }
+    if len(num_classes) > 0:
+        batch_metadata[utils.BatchMetadataKeys.NUM_CLASSES] = [
+            num_classes[i] for i in steps for _ in range(num_processes)
+        ]
+
+    return batches, batch_sizes, batch_metadata
+
+
+def batch_metadata_at(batch_metadata, i, prompt_choice_level="batch"):
+    """
+    Returns the metadata of the i-th batch, as passed to the datasets, from the lists returned by
+    `get_batch_metadata`. With prompt_choice_level "episode", all the prompt combinations are passed, and
+    each episode chooses its own.
+    """
+    if prompt_choice_level == "episode":
+        metadata = {
+            k: v[i]
+            for k, v in batch_metadata.items()
+            if k != utils.BatchMetadataKeys.PROMPT_TYPES
+        }
+        metadata[utils.BatchMetadataKeys.PROMPT_TYPES] = batch_metadata[
+            utils.BatchMetadataKeys.PROMPT_TYPES
+        ]
+        metadata[utils.BatchMetadataKeys.PROMPT_CHOICE_LEVEL] = "episode"
+    else:
+        metadata = {k: v[i] for k, v in batch_metadata.items()}
+        metadata[utils.BatchMetadataKeys.PROMPT_CHOICE_LEVEL] = "batch"
+    return metadata
+
+
 class VariableBatchSampler(BatchSampler):
     """
     A custom batch sampler that generates variable-sized batches based on the provided constraints.
@@ -314,6 +569,16 @@ class VariableBatchSampler(BatchSampler):
         drop_last (bool, optional): Whether to drop the last batch if it is smaller than `max_batch_size`. Defaults to False.
         shuffle (bool, optional): Whether to shuffle the data before sampling. Defaults to False.
         num_processes (int, optional): The number of processes to use for parallel processing. Defaults to 1.
+        max_batch_cost (int, optional): If given, samples are grouped in batches of similar padded cost
+            (batch size x examples x classes x annotations), up to this cost, using the episode sizes of the
+            dataset (see `get_cost_balanced_batches`). Defaults to None (batches filled in random order).
+        episode_plan_dir (str, optional): Directory of the episode plans written by `plan_episodes`. The batches
+            of each epoch, with their episodes, are replayed from its plan (epochs without a plan are sampled as
+            usual). Defaults to None.
+        prefetch (bool, optional): If True, the images of the next batch of this process are prefetched by the
+            dataset (see `LabelAnythingDataset.prefetch`) while the current batch is loaded. Defaults to False.
+        process_index (int, optional): Index of this process, batch i being loaded by process
+            i % num_processes as in accelerate. Defaults to the RANK environment variable.
 
     Raises:
         ValueError: If no batch size is provided.
@@ -333,6 +598,10 @@ class VariableBatchSampler(BatchSampler):
         shuffle=False,
         num_processes=1,
         num_steps=None,
+        max_batch_cost=None,
+        episode_plan_dir=None,
+        prefetch=False,
+        process_index=None,
     ):
         self.data_source = data_source
         if prompt_types is None:
@@ -342,29 +611,60 @@ class VariableBatchSampler(BatchSampler):
                 utils.PromptType.POINT,
             ]
         self.prompt_choice_level = prompt_choice_level
+        self.prompt_types = prompt_types
+        self.possible_batch_example_nums = possible_batch_example_nums
+        self.max_batch_cost = max_batch_cost
+        self.batches = None
 
-        self.batch_sizes, self.batch_metadata = get_batch_metadata(
-            len(data_source),
-            possible_batch_example_nums,
-            num_processes=num_processes,
-            possible_prompts=prompt_types,
-            prompt_choice_level=prompt_choice_level,
-        )
         self.num_processes = num_processes
-        if num_steps is not None:
-            if num_steps % num_processes != 0:
-                logger.warning(
-                    "The number of steps is not divisible by the number of processes."
-                )
-                logger.warning(
-                    "The number of steps will be adjusted to be divisible by the number of processes."
+        if num_steps is not None and num_steps % num_processes != 0:
+            logger.warning(
+                "The number of steps is not divisible by the number of processes."
+            )
+            logger.warning(
+                "The number of steps will be adjusted to be divisible by the number of processes."
+            )
+            num_steps = num_steps - (num_steps % num_processes)
+            logger.warning(f"The new number of steps is {num_steps}.")
+        self.num_steps = num_steps
+        if max_batch_cost is not None:
+            self.num_categories, self.num_annotations = data_source.episode_sizes()
+            self._set_batches(
+                *get_cost_balanced_batches(
+                    self.num_categories,
+                    self.num_annotations,
+                    possible_batch_example_nums,
+                    possible_prompts=prompt_types,
+                    prompt_choice_level=prompt_choice_level,
+                    max_batch_cost=max_batch_cost,
+                    num_processes=num_processes,
                 )
-                num_steps = num_steps - (num_steps % num_processes)
-                logger.warning(f"The new number of steps is {num_steps}.")
-            self.batch_sizes = self.batch_sizes[:num_steps]
-            self.batch_metadata = {
-                k: v[:num_steps] for k, v in self.batch_metadata.items()
-            }
+            )
+        else:
+            self._set_batches(
+                None,
+                *get_batch_metadata(
+                    len(data_source),
+                    possible_batch_example_nums,
+                    num_processes=num_processes,
+                    possible_prompts=prompt_types,
+                    prompt_choice_level=prompt_choice_level,
+                ),
+            )
+        # every epoch is shuffled from this order, not from the one of the previous epoch
+        self._initial_batches = (self.batches, self.batch_sizes, self.batch_metadata)
+        self._initial_sizes = (
+            (self.num_categories, self.num_annotations)
+            if max_batch_cost is not None
+            else None
+        )
+        self.episode_plan_dir = episode_plan_dir
+        self.epoch = 0
+        self._plan = None
+        self.prefetch = prefetch
+        self.process_index = (
+            int(os.environ.get("RANK", 0)) if process_index is None else process_index
+        )
         self.drop_last = drop_last
         self.do_shuffle = shuffle
         if shuffle:
@@ -376,14 +676,87 @@ class VariableBatchSampler(BatchSampler):
             raise ValueError("At least one batch size should be provided.")
 
     def __len__(self):
+        plan = self._get_plan()
+        if plan is not None:
+            return len(plan)
         return len(self.batch_sizes)
 
+    def _set_batches(self, batches, batch_sizes, batch_metadata):
+        if self.num_steps is not None:
+            batch_sizes = batch_sizes[: self.num_steps]
+            batch_metadata = {k: v[: self.num_steps] for k, v in batch_metadata.items()}
+            if batches is not None:
+                batches = batches[: self.num_steps]
+        self.batches, self.batch_sizes, self.batch_metadata = (
+            batches,
+            batch_sizes,
+            batch_metadata,
+        )
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch to sample, which selects its episode plan, and the epoch of the dataset. The batches of
+        an epoch only depend on the epoch and on the random state when it is iterated, not on the epochs
+        iterated before, so that planned and resumed epochs are the same as in an uninterrupted run.
+        """
+        self.epoch = epoch
+        if hasattr(self.data_source, "set_epoch"):
+            self.data_source.set_epoch(epoch)
+        self.batches, self.batch_sizes, self.batch_metadata = self._initial_batches
+        if self.max_batch_cost is None:
+            return
+        # the samples of the epoch, and so their sizes, can depend on the epoch (see mixing_ratios)
+        self.num_categories, self.num_annotations = self.data_source.episode_sizes()
+        if not (
+            np.array_equal(self.num_categories, self._initial_sizes[0])
+            and np.array_equal(self.num_annotations, self._initial_sizes[1])
+        ):
+            self._set_batches(
+                *get_cost_balanced_batches(
+                    self.num_categories,
+                    self.num_annotations,
+                    self.possible_batch_example_nums,
+                    possible_prompts=self.prompt_types,
+                    prompt_choice_level=self.prompt_choice_level,
+                    max_batch_cost=self.max_batch_cost,
+                    num_processes=self.num_processes,
+                )
+            )
+
+    def _get_plan(self):
+        if self.episode_plan_dir is None:
+            return None
+        path = episode_plan_path(self.episode_plan_dir, self.epoch)
+        if self._plan is None or self._plan[0] != path:
+            if not os.path.exists(path):
+                logger.warning(f"No episode plan for epoch {self.epoch} in {path}")
+                self._plan = (path, None)
+            else:
+                self._plan = (path, EpisodePlan.load(path))
+        return self._plan[1]
+
+    def shuffle_cost_balanced(self):
+        # Regroup the samples, the number of batches can change slightly
+        self._set_batches(
+            *get_cost_balanced_batches(
+                self.num_categories,
+                self.num_annotations,
+                self.possible_batch_example_nums,
+                possible_prompts=self.prompt_types,
+                prompt_choice_level=self.prompt_choice_level,
+                max_batch_cost=self.max_batch_cost,
+                num_processes=self.num_processes,
+                shuffle=True,
+            )
+        )
+
     def shuffle(self):
-        # Remove th processes multiplication
-        batches = self.batch_sizes[:: self.num_processes]
-        metadata = {
-            k: v[:: self.num_processes] for k, v in list(self.batch_metadata.items())
-        }
+        if self.batches is not None:
+            return self.shuffle_cost_balanced()
+        # Remove th processes multiplication, starting from the initial order
+        _, batch_sizes, batch_metadata = self._initial_batches
+        batches = batch_sizes[:: self.num_processes]
+        metadata = {k: v[:: self.num_processes] for k, v in list(batch_metadata.items())}
         # Get permutation
         indices = torch.randperm(len(batches)).tolist()
         # Permute
@@ -405,6 +778,24 @@ class VariableBatchSampler(BatchSampler):
         }
 
     def __iter__(self):
+        if not self.prefetch:
+            yield from self._batches()
+            return
+        # keep the batches up to the next one of this process, to prefetch it
+        window = deque()
+        for i, batch in enumerate(self._batches()):
+            window.append(batch)
+            if len(window) > self.num_processes:
+                if (i - self.num_processes) % self.num_processes == self.process_index:
+                    self.data_source.prefetch(batch)
+                yield window.popleft()
+        yield from window
+
+    def _batches(self):
+        plan = self._get_plan()
+        if plan is not None:
+            yield from plan.batches()
+            return
         if self.do_shuffle:
             self.shuffle()
             indices = iter(list(torch.randperm(len(self.sampler.data_source)).tolist()))
@@ -412,19 +803,12 @@ class VariableBatchSampler(BatchSampler):
             indices = self.sampler.__iter__()
 
         for i, batch_size in enumerate(self.batch_sizes):
-            if self.prompt_choice_level == "episode":
-                metadata = {
-                    k: v[i]
-                    for k, v in self.batch_metadata.items()
-                    if k != utils.BatchMetadataKeys.PROMPT_TYPES
-                }
-                metadata[utils.BatchMetadataKeys.PROMPT_TYPES] = self.batch_metadata[
-                    utils.BatchMetadataKeys.PROMPT_TYPES
-                ]
-                metadata[utils.BatchMetadataKeys.PROMPT_CHOICE_LEVEL] = "episode"
-            else:
-                metadata = {k: v[i] for k, v in self.batch_metadata.items()}
-                metadata[utils.BatchMetadataKeys.PROMPT_CHOICE_LEVEL] = "batch"
+            metadata = batch_metadata_at(
+                self.batch_metadata, i, self.prompt_choice_level
+            )
+            if self.batches is not None:
+                yield [(idx, metadata) for idx in self.batches[i]]
+                continue
             batch = []
             while len(batch) < batch_size and indices:
                 batch.append((next(indices), metadata))
@@ -0,0 +1,378 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+
+from label_anything.data.embedding_store import SHARD_ALIGNMENT, TORCH_DTYPES
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+MAGIC = 0x4C41454D42434143
+PAGE_SIZE = 4096
+# header of the segment, as int64 values
+HEADER_MAGIC, HEADER_SLOT_SIZE, HEADER_NUM_SLOTS, HEADER_CLOCK = 0, 1, 2, 3
+HEADER_HITS, HEADER_LOADS = 4, 5
+HEADER_LENGTH = 8
+ENTRY_DTYPE = np.dtype(
+    [
+        ("key_hi", "<u8"),
+        ("key_lo", "<u8"),
+        ("state", "<i8"),
+        ("last_used", "<i8"),
+        ("loading_since", "<f8"),
+    ]
+)
+# slot states
+EMPTY, LOADING, READY = 0, 1, 2
+DEFAULT_SLOT_HEADROOM = 1.25
+
+
+def _align(n: int, alignment: int) -> int:
+    return n + (-n % alignment)
+
+
+def _key_hash(key: str) -> (int, int):
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+def _encode(tensors: dict[str, torch.Tensor]) -> bytes:
+    """Pack tensors as an 8 bytes header length, a json header mapping each name to its
+    (offset, dtype, shape) and the aligned data, as in the sharded embedding store."""
+    header, chunks, offset = {}, [], 0
+    for name, tensor in tensors.items():
+        tensor = tensor.contiguous()
+        data = tensor.view(-1).view(torch.uint8).numpy().tobytes()
+        padding = -offset % SHARD_ALIGNMENT
+        chunks.append(b"\0" * padding + data)
+        offset += padding
+        header[name] = [offset, str(tensor.dtype).split(".")[-1], list(tensor.shape)]
+        offset += len(data)
+    header = json.dumps(header).encode()
+    prefix = len(header).to_bytes(8, "little") + header
+    prefix += b"\0" * (-len(prefix) % SHARD_ALIGNMENT)
+    return prefix + b"".join(chunks)
+
+
+def _decode(buffer, offset: int) -> dict[str, torch.Tensor]:
+    """Copy the tensors packed by _encode at offset in buffer."""
+    header_length = int.from_bytes(buffer[offset : offset + 8], "little")
+    header = json.loads(bytes(buffer[offset + 8 : offset + 8 + header_length]))
+    data_offset = offset + _align(8 + header_length, SHARD_ALIGNMENT)
+    out = {}
+    for name, (tensor_offset, dtype, shape) in header.items():
+        count = int(np.prod(shape, dtype=np.int64))
+        out[name] = (
+            torch.frombuffer(
+                buffer,
+                dtype=TORCH_DTYPES[dtype],
+                count=count,
+                offset=data_offset + tensor_offset,
+            )
+            .view(shape)
+            .clone()
+        )
+    return out
+
+
+def embedding_cache_name(
+    emb_dir: str,
+    backend: str,
+    fingerprint: str,
+    slot_headroom: float = DEFAULT_SLOT_HEADROOM,
+) -> str:
+    """The name of the node-level cache of an embedding store, the same for every process
+    of the user reading it. The fingerprint of the store (see the fingerprint method of the
+    stores) gives a new cache when the embeddings are regenerated or quantized again, and
+    slot_headroom a new one when the slots would have another size."""
+    key = f"{os.path.abspath(emb_dir)}:{backend}:{fingerprint}:{slot_headroom}"
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return f"la-emb-{os.getuid()}-{digest[:16]}"
+
+
+class SharedEmbeddingCache:
+    """Node-level cache of an embedding store in POSIX shared memory (a file in /dev/shm
+    mapped by every process), shared by all the processes of the node that read the store
+    (DDP ranks and their DataLoader workers).
+
+    The shared segment is an array of fixed-size slots with an index of the cached keys.
+    A miss reserves a slot, so that the other processes wait for the entry instead of
+    reading it too, reads the entry from the store and copies it into the slot. Hits copy
+    the tensors out of the segment. When all the slots are used, the least recently used
+    one is evicted. The index is protected by a lock file, hits only take a shared lock.
+
+    The segment is created by the first miss, with slots large enough for that entry (times
+    slot_headroom); larger entries are not cached. It outlives the processes: the training
+    run unlinks it when it ends (see release), unless keep is set, so that the next runs
+    start warm.
+
+    Args:
+        store: The embedding store to read from on a miss.
+        name (str): Name of the shared memory segment (see embedding_cache_name).
+        max_bytes (int): Byte budget of the cached entries.
+        slot_headroom (float, optional): Slot size relative to the first cached entry. Defaults to 1.25.
+        keep (bool, optional): Keep the segment when released. Defaults to False.
+        timeout (float, optional): Seconds to wait for an entry loaded by another process, before reading it from the store. Defaults to 30.
+        report_every (int, optional): Log the statistics every report_every lookups (0 to disable). Defaults to 10000.
+    """
+
+    def __init__(
+        self,
+        store,
+        name: str,
+        max_bytes: int,
+        slot_headroom: float = DEFAULT_SLOT_HEADROOM,
+        timeout: float = 30.0,
+        report_every: int = 10000,
+        keep: bool = False,
+    ):
+        self.store = store
+        self.name = name
+        self.max_bytes = max_bytes
+        self.slot_headroom = slot_headroom
+        self.keep = keep
+        self.timeout = timeout
+        self.report_every = report_every
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.path = os.path.join(shm_dir, name)
+        self.lock_path = f"{self.path}.lock"
+        self.lookups = 0
+        self._mmap = None
+        self._lock_file = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        state["_lock_file"] = None
+        state["_pid"] = None
+        return state
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # the mapping and the lock are never shared with forked workers
+            self._mmap = None
+            self._lock_file = open(self.lock_path, "a+")
+            self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive: bool):
+        self._check_pid()
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _map(self):
+        with open(self.path, "r+b") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+        self._header = np.ndarray(
+            (HEADER_LENGTH,), dtype=np.int64, buffer=self._mmap, offset=0
+        )
+        if self._header[HEADER_MAGIC] != MAGIC:
+            raise ValueError(f"{self.path} has an unknown layout, unlink it.")
+        num_slots = int(self._header[HEADER_NUM_SLOTS])
+        self.slot_size = int(self._header[HEADER_SLOT_SIZE])
+        self._entries = np.ndarray(
+            (num_slots,),
+            dtype=ENTRY_DTYPE,
+            buffer=self._mmap,
+            offset=HEADER_LENGTH * 8,
+        )
+        self._data_offset = _align(
+            HEADER_LENGTH * 8 + num_slots * ENTRY_DTYPE.itemsize, PAGE_SIZE
+        )
+
+    def _open(self) -> bool:
+        """Map the segment if it exists, with the lock held."""
+        if self._mmap is None:
+            if not os.path.exists(self.path):
+                return False
+            self._map()
+        return True
+
+    def _create(self, entry_size: int):
+        """Create the segment with slots for entries of entry_size, with the exclusive lock held."""
+        slot_size = _align(int(entry_size * self.slot_headroom), PAGE_SIZE)
+        num_slots = self.max_bytes // slot_size
+        size = _align(HEADER_LENGTH * 8 + num_slots * ENTRY_DTYPE.itemsize, PAGE_SIZE)
+        header = np.zeros(HEADER_LENGTH, dtype=np.int64)
+        header[HEADER_MAGIC] = MAGIC
+        header[HEADER_SLOT_SIZE] = slot_size
+        header[HEADER_NUM_SLOTS] = num_slots
+        # the file is sparse, its pages are only allocated when written
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.truncate(size + num_slots * slot_size)
+            f.write(header.tobytes())
+        os.replace(tmp_path, self.path)
+        self._map()
+        logger.info(
+            f"Created embedding cache {self.path} with {num_slots} slots of {slot_size} bytes"
+        )
+
+    def _find(self, key_hash: (int, int)) -> Optional[int]:
+        slots = np.flatnonzero(
+            (self._entries["key_hi"] == key_hash[0])
+            & (self._entries["key_lo"] == key_hash[1])
+            & (self._entries["state"] != EMPTY)
+        )
+        return int(slots[0]) if len(slots) > 0 else None
+
+    def _is_stale(self, slot: int) -> bool:
+        return (
+            self._entries["state"][slot] == LOADING
+            and time.time() - self._entries["loading_since"][slot] > self.timeout
+        )
+
+    def _reserve(self, key_hash: (int, int)) -> Optional[int]:
+        """Reserve the slot of a missing key, with the exclusive lock held: an empty slot,
+        or the least recently used one, or a slot whose loading process died."""
+        states = self._entries["state"]
+        candidates = np.flatnonzero(states == EMPTY)
+        if len(candidates) == 0:
+            last_used = np.where(
+                states == READY, self._entries["last_used"], np.iinfo(np.int64).max
+            )
+            if len(last_used) > 0 and last_used.min() < np.iinfo(np.int64).max:
+                candidates = [int(last_used.argmin())]
+            else:
+                candidates = [i for i in range(len(states)) if self._is_stale(i)]
+        if len(candidates) == 0:
+            return None
+        slot = int(candidates[0])
+        self._entries[slot] = (key_hash[0], key_hash[1], LOADING, 0, time.time())
+        return slot
+
+    def _touch(self, slot: int):
+        # with the shared lock held, concurrent updates may be lost, which only makes the
+        # eviction order approximate
+        self._header[HEADER_CLOCK] += 1
+        self._entries["last_used"][slot] = self._header[HEADER_CLOCK]
+
+    def _lookup(self, key: str, key_hash: (int, int)):
+        """Returns (tensors, None) on a hit, (None, slot) when the key was reserved for
+        this process, (None, None) when it can not be cached, or None to look it up again
+        (e.g. while another process loads it)."""
+        with self._locked(exclusive=False):
+            if self._open():
+                slot = self._find(key_hash)
+                if slot is not None and self._entries["state"][slot] == READY:
+                    self._header[HEADER_HITS] += 1
+                    self._touch(slot)
+                    return _decode(self._mmap, self._slot_offset(slot)), None
+        with self._locked(exclusive=True):
+            if not self._open():
+                # the first entry gives the size of the slots, it is read with the lock
+                # held so that the other processes wait for the segment
+                tensors = self.store[key]
+                data = _encode(tensors)
+                self._create(len(data))
+                self._write(key_hash, self._reserve(key_hash), data)
+                return tensors, None
+            slot = self._find(key_hash)
+            if slot is None:
+                return None, self._reserve(key_hash)
+            if self._entries["state"][slot] == READY:
+                self._header[HEADER_HITS] += 1
+                self._touch(slot)
+                return _decode(self._mmap, self._slot_offset(slot)), None
+            if self._is_stale(slot):
+                self._entries["loading_since"][slot] = time.time()
+                return None, slot
+            return None
+
+    def _slot_offset(self, slot: int) -> int:
+        return self._data_offset + slot * self.slot_size
+
+    def _write(self, key_hash: (int, int), slot: Optional[int], data: bytes):
+        """Copy an entry read from the store to its reserved slot, with the exclusive lock held."""
+        self._header[HEADER_LOADS] += 1
+        if slot is None:
+            return
+        entry = self._entries[slot]
+        if (
+            entry["state"] != LOADING
+            or entry["key_hi"] != key_hash[0]
+            or entry["key_lo"] != key_hash[1]
+        ):
+            # taken over by another process after a timeout
+            return
+        if len(data) > self.slot_size:
+            self._entries["state"][slot] = EMPTY
+            return
+        offset = self._slot_offset(slot)
+        self._mmap[offset : offset + len(data)] = data
+        self._entries["state"][slot] = READY
+        self._touch(slot)
+
+    def __getitem__(self, key: str) -> dict[str, torch.Tensor]:
+        key_hash = _key_hash(key)
+        self.lookups += 1
+        if self.report_every and self.lookups % self.report_every == 0:
+            logger.info(f"Embedding cache (pid {os.getpid()}): {self.stats()}")
+
+        deadline = time.time() + self.timeout
+        while True:
+            result = self._lookup(key, key_hash)
+            if result is not None:
+                break
+            if time.time() > deadline:
+                return self.store[key]
+            time.sleep(0.001)
+        tensors, slot = result
+        if tensors is not None:
+            return tensors
+        tensors = self.store[key]
+        data = _encode(tensors)
+        with self._locked(exclusive=True):
+            self._write(key_hash, slot, data)
+        return tensors
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def stats(self) -> dict:
+        """Statistics of the cache, shared by all the processes of the node."""
+        with self._locked(exclusive=False):
+            if not self._open():
+                return {"hits": 0, "loads": 0, "entries": 0}
+            hits = int(self._header[HEADER_HITS])
+            loads = int(self._header[HEADER_LOADS])
+            return {
+                "hits": hits,
+                "loads": loads,
+                "hit_rate": hits / max(hits + loads, 1),
+                "entries": int((self._entries["state"] == READY).sum()),
+                "num_slots": len(self._entries),
+                "slot_size": self.slot_size,
+            }
+
+    def unlink(self):
+        """Remove the segment from the node. Processes that mapped it keep their mapping."""
+        with self._locked(exclusive=True):
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._mmap = None
+
+    def release(self):
+        """Unlink the segment at the end of a run, unless it is kept for the next ones."""
+        if self.keep:
+            logger.info(f"Keeping embedding cache {self.path}: {self.stats()}")
+            return
+        logger.info(f"Removing embedding cache {self.path}: {self.stats()}")
+        # the lock file is left, processes of other runs may still hold it
+        self.unlink()
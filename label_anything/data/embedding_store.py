@@ -0,0 +1,262 @@
+import hashlib
+import json
+import mmap
+import os
+import uuid
+from typing import Optional
+
+import torch
+from safetensors.torch import load_file
+from tqdm import tqdm
+
+from label_anything.data.utils import StrEnum
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+INDEX_FILENAME = "index.json"
+VERSION_FILENAME = "embeddings_version"
+SHARD_ALIGNMENT = 64
+
+TORCH_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "float64": torch.float64,
+    "int64": torch.int64,
+    "int32": torch.int32,
+    "int16": torch.int16,
+    "int8": torch.int8,
+    "uint8": torch.uint8,
+    "bool": torch.bool,
+}
+
+
+class EmbeddingsBackend(StrEnum):
+    SAFETENSORS = "safetensors"
+    SHARDED = "sharded"
+
+
+class SafetensorsEmbeddingStore:
+    """Embedding store reading one safetensors file per image (``{emb_dir}/{key}.safetensors``)."""
+
+    def __init__(self, emb_dir: str):
+        self.emb_dir = emb_dir
+
+    def __getitem__(self, key: str) -> dict[str, torch.Tensor]:
+        return load_file(f"{self.emb_dir}/{key}.safetensors")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(f"{self.emb_dir}/{key}.safetensors")
+
+    def fingerprint(self) -> str:
+        """Hash of the modification time of the directory, which changes when files are
+        added or removed, and of its version file (see mark_embeddings_updated), which
+        changes when the embeddings are regenerated or quantized in place. The files
+        themselves are not listed, as there is one per image."""
+        h = hashlib.sha1()
+        h.update(f"{os.stat(self.emb_dir).st_mtime_ns};".encode())
+        version_path = os.path.join(self.emb_dir, VERSION_FILENAME)
+        if os.path.exists(version_path):
+            with open(version_path, "r") as f:
+                h.update(f.read().encode())
+        return h.hexdigest()
+
+
+class ShardedEmbeddingStore:
+    """Embedding store packing all the tensors in a few large shard files.
+
+    The store directory contains the shards (``shard-00000.bin``, ...) and an ``index.json``
+    mapping each key to its shard and, for each tensor name, to its (offset, dtype, shape).
+    Shards are memory-mapped lazily, once per process, so that every DataLoader worker opens
+    its own mappings, and tensors are returned as zero-copy views over the mapping.
+    """
+
+    def __init__(self, emb_dir: str):
+        self.emb_dir = emb_dir
+        with open(os.path.join(emb_dir, INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.entries = index["entries"]
+        self._mmaps = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mmaps"] = None
+        state["_pid"] = None
+        return state
+
+    def _get_shard(self, shard_idx: int) -> mmap.mmap:
+        if self._pid != os.getpid():
+            # mappings are never shared with forked workers, each process opens its own
+            self._mmaps = [None] * len(self.shards)
+            self._pid = os.getpid()
+        if self._mmaps[shard_idx] is None:
+            with open(os.path.join(self.emb_dir, self.shards[shard_idx]), "rb") as f:
+                # ACCESS_COPY gives a writable (copy-on-write) buffer, so torch.frombuffer
+                # does not complain, while the pages stay shared with the page cache
+                self._mmaps[shard_idx] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_COPY
+                )
+        return self._mmaps[shard_idx]
+
+    def __getitem__(self, key: str) -> dict[str, torch.Tensor]:
+        shard_idx, tensors = self.entries[key]
+        buffer = self._get_shard(shard_idx)
+        out = {}
+        for name, (offset, dtype, shape) in tensors.items():
+            count = 1
+            for dim in shape:
+                count *= dim
+            out[name] = torch.frombuffer(
+                buffer, dtype=TORCH_DTYPES[dtype], count=count, offset=offset
+            ).view(shape)
+        return out
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fingerprint(self) -> str:
+        """Hash of the sizes and modification times of the index and of the shards."""
+        h = hashlib.sha1()
+        for name in [INDEX_FILENAME, *self.shards]:
+            stat = os.stat(os.path.join(self.emb_dir, name))
+            h.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return h.hexdigest()
+
+
+class ShardedEmbeddingStoreWriter:
+    """Writes tensors to a ShardedEmbeddingStore directory.
+
+    Args:
+        outfolder (str): Directory of the store.
+        shard_size (int, optional): Size in bytes after which a new shard is started. Defaults to 4 GiB.
+    """
+
+    def __init__(self, outfolder: str, shard_size: int = 4 * 1024**3):
+        os.makedirs(outfolder, exist_ok=True)
+        self.outfolder = outfolder
+        self.shard_size = shard_size
+        self.shards = []
+        self.entries = {}
+        self._file = None
+        self._offset = 0
+
+    def _new_shard(self):
+        if self._file is not None:
+            self._file.close()
+        shard_name = f"shard-{len(self.shards):05d}.bin"
+        self.shards.append(shard_name)
+        self._file = open(os.path.join(self.outfolder, shard_name), "wb")
+        self._offset = 0
+
+    def add(self, key: str, tensors: dict[str, torch.Tensor]):
+        if self._file is None or self._offset >= self.shard_size:
+            self._new_shard()
+        entry = {}
+        for name, tensor in tensors.items():
+            padding = -self._offset % SHARD_ALIGNMENT
+            if padding:
+                self._file.write(b"\0" * padding)
+                self._offset += padding
+            tensor = tensor.contiguous()
+            data = tensor.view(-1).view(torch.uint8).numpy().tobytes()
+            self._file.write(data)
+            entry[name] = [
+                self._offset,
+                str(tensor.dtype).split(".")[-1],
+                list(tensor.shape),
+            ]
+            self._offset += len(data)
+        self.entries[key] = [len(self.shards) - 1, entry]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with open(os.path.join(self.outfolder, INDEX_FILENAME), "w") as f:
+            json.dump({"shards": self.shards, "entries": self.entries}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def mark_embeddings_updated(emb_dir: str):
+    """Write a new version file in emb_dir once its embeddings have been written, so that
+    the caches of the previous embeddings are not reused (see
+    SafetensorsEmbeddingStore.fingerprint).
+
+    Args:
+        emb_dir (str): Directory of the per-image safetensors files.
+    """
+    tmp_path = os.path.join(emb_dir, f"{VERSION_FILENAME}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, os.path.join(emb_dir, VERSION_FILENAME))
+
+
+def open_embedding_store(
+    emb_dir: Optional[str],
+    backend: EmbeddingsBackend = EmbeddingsBackend.SAFETENSORS,
+    cache_bytes: int = 0,
+    keep_cache: bool = False,
+):
+    """Open the embedding store in emb_dir with the given backend.
+
+    Args:
+        emb_dir (Optional[str]): Directory of the embeddings (or of the packed store).
+        backend (EmbeddingsBackend, optional): Either "safetensors" (one file per image) or "sharded". Defaults to "safetensors".
+        cache_bytes (int, optional): Byte budget of the node-level shared memory cache in front of the store. Defaults to 0 (no cache).
+        keep_cache (bool, optional): Keep the shared memory cache after training, for the next runs on the node. Defaults to False.
+
+    Returns:
+        The embedding store, or None if emb_dir is None.
+    """
+    if emb_dir is None:
+        return None
+    if backend == EmbeddingsBackend.SAFETENSORS:
+        store = SafetensorsEmbeddingStore(emb_dir)
+    elif backend == EmbeddingsBackend.SHARDED:
+        store = ShardedEmbeddingStore(emb_dir)
+    else:
+        raise ValueError(f"Unknown embeddings backend {backend}.")
+    if cache_bytes > 0:
+        from label_anything.data.embedding_cache import (
+            SharedEmbeddingCache,
+            embedding_cache_name,
+        )
+
+        store = SharedEmbeddingCache(
+            store,
+            embedding_cache_name(emb_dir, backend, store.fingerprint()),
+            cache_bytes,
+            keep=keep_cache,
+        )
+    return store
+
+
+def pack_embeddings(emb_dir: str, outfolder: str, shard_size: int = 4 * 1024**3):
+    """Convert a directory of per-image safetensors files (as created by
+    create_image_embeddings) to a ShardedEmbeddingStore.
+
+    Args:
+        emb_dir (str): Directory containing the per-image safetensors files.
+        outfolder (str): Directory of the packed store.
+        shard_size (int, optional): Size in bytes after which a new shard is started. Defaults to 4 GiB.
+    """
+    filenames = sorted(f for f in os.listdir(emb_dir) if f.endswith(".safetensors"))
+    with ShardedEmbeddingStoreWriter(outfolder, shard_size=shard_size) as writer:
+        for filename in tqdm(filenames, desc="Packing embeddings"):
+            key, _ = os.path.splitext(filename)
+            writer.add(key, load_file(os.path.join(emb_dir, filename)))
+    logger.info(
+        f"Packed {len(filenames)} embeddings in {len(writer.shards)} shards in {outfolder}"
+    )
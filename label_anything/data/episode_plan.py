@@ -0,0 +1,337 @@
+import json
+import multiprocessing
+import os
+import random
+from enum import Enum
+from typing import Iterator, Optional
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from label_anything.data.utils import BatchMetadataKeys, PromptType
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def episode_plan_path(plan_dir: str, epoch: int) -> str:
+    return os.path.join(plan_dir, f"epoch-{epoch:05d}.npz")
+
+
+def _encode_metadata(metadata: dict) -> dict:
+    def encode(value):
+        if isinstance(value, Enum):
+            return value.value
+        if isinstance(value, (list, tuple)):
+            return [encode(x) for x in value]
+        return value
+
+    return {encode(k): encode(v) for k, v in metadata.items()}
+
+
+def _decode_metadata(metadata: dict) -> dict:
+    metadata = {BatchMetadataKeys(k): v for k, v in metadata.items()}
+    prompt_types = metadata[BatchMetadataKeys.PROMPT_TYPES]
+    if metadata.get(BatchMetadataKeys.PROMPT_CHOICE_LEVEL) == "episode":
+        # one combination is chosen for each episode
+        prompt_types = [tuple(PromptType(x) for x in comb) for comb in prompt_types]
+    else:
+        prompt_types = tuple(PromptType(x) for x in prompt_types)
+    metadata[BatchMetadataKeys.PROMPT_TYPES] = prompt_types
+    return metadata
+
+
+class EpisodePlan:
+    """The batches of an epoch with, for each sample, the images (query first) and the
+    categories of its episode, so that DataLoader workers only load the data.
+
+    Episodes are stored as CSR arrays: the images of the i-th sample are
+    ``image_ids[image_offsets[i]:image_offsets[i + 1]]``, and the same for the categories.
+    Samples whose dataset can not plan its episodes have no images, and their episode
+    is still chosen by the worker.
+
+    Args:
+        indices (np.ndarray): The dataset index of each sample.
+        batch_offsets (np.ndarray): Offsets of the batches in the samples.
+        batch_metadata (list[dict]): The metadata of each batch, as given by the sampler.
+        image_offsets (np.ndarray): Offsets of the episodes in image_ids.
+        image_ids (np.ndarray): The image ids of the episodes.
+        category_offsets (np.ndarray): Offsets of the episodes in category_ids.
+        category_ids (np.ndarray): The category ids of the episodes.
+    """
+
+    def __init__(
+        self,
+        indices: np.ndarray,
+        batch_offsets: np.ndarray,
+        batch_metadata: list[dict],
+        image_offsets: np.ndarray,
+        image_ids: np.ndarray,
+        category_offsets: np.ndarray,
+        category_ids: np.ndarray,
+    ):
+        self.indices = indices
+        self.batch_offsets = batch_offsets
+        self.batch_metadata = batch_metadata
+        self.image_offsets = image_offsets
+        self.image_ids = image_ids
+        self.category_offsets = category_offsets
+        self.category_ids = category_ids
+
+    def __len__(self):
+        """The number of batches."""
+        return len(self.batch_offsets) - 1
+
+    def episode(self, i: int) -> Optional[tuple[list[int], list[int]]]:
+        """The image ids and the category ids of the episode of the i-th sample."""
+        start, end = self.image_offsets[i], self.image_offsets[i + 1]
+        if start == end:
+            return None
+        cat_start, cat_end = self.category_offsets[i], self.category_offsets[i + 1]
+        return (
+            self.image_ids[start:end].tolist(),
+            self.category_ids[cat_start:cat_end].tolist(),
+        )
+
+    def batches(self) -> Iterator[list[tuple[int, dict]]]:
+        """Yields the batches as VariableBatchSampler does, with the planned episodes."""
+        for b, metadata in enumerate(self.batch_metadata):
+            batch = []
+            for i in range(self.batch_offsets[b], self.batch_offsets[b + 1]):
+                sample_metadata = dict(metadata)
+                episode = self.episode(i)
+                if episode is not None:
+                    sample_metadata[BatchMetadataKeys.EPISODE] = episode
+                batch.append((int(self.indices[i]), sample_metadata))
+            yield batch
+
+    def statistics(self) -> dict:
+        """Summary of the episodes, to inspect an epoch offline."""
+        num_images = np.diff(self.image_offsets)
+        num_categories = np.diff(self.category_offsets)[num_images > 0]
+        batch_sizes = np.diff(self.batch_offsets)
+        num_images = num_images[num_images > 0]
+
+        def summary(x):
+            if len(x) == 0:
+                return {}
+            return {
+                "mean": float(x.mean()),
+                "min": int(x.min()),
+                "max": int(x.max()),
+            }
+
+        return {
+            "num_batches": len(self),
+            "num_samples": len(self.indices),
+            "num_planned": len(num_images),
+            "batch_size": summary(batch_sizes),
+            "num_images": summary(num_images),
+            "num_categories": summary(num_categories),
+            "num_unique_images": int(len(np.unique(self.image_ids))),
+        }
+
+    def save(self, path: str):
+        """Save the plan atomically, so that an interrupted run leaves no partial file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                indices=self.indices,
+                batch_offsets=self.batch_offsets,
+                image_offsets=self.image_offsets,
+                image_ids=self.image_ids,
+                category_offsets=self.category_offsets,
+                category_ids=self.category_ids,
+                batch_metadata=np.array(
+                    json.dumps([_encode_metadata(x) for x in self.batch_metadata])
+                ),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "EpisodePlan":
+        with np.load(path) as data:
+            batch_metadata = json.loads(str(data["batch_metadata"]))
+            return cls(
+                indices=data["indices"],
+                batch_offsets=data["batch_offsets"],
+                batch_metadata=[_decode_metadata(x) for x in batch_metadata],
+                image_offsets=data["image_offsets"],
+                image_ids=data["image_ids"],
+                category_offsets=data["category_offsets"],
+                category_ids=data["category_ids"],
+            )
+
+
+# the dataset is inherited by the forked planning processes instead of being pickled, so
+# they are always forked, whatever the default start method of the platform
+_planning_dataset = None
+
+
+def _seed(*entropy: int):
+    seed = int(np.random.SeedSequence(list(entropy)).generate_state(1)[0])
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def _plan_episodes(args) -> list:
+    seed, epoch, samples = args
+    episodes = []
+    for position, idx, metadata in samples:
+        # each episode has its own seed, so that the plan does not depend on the number
+        # of processes or on the order in which the episodes are planned
+        _seed(seed, epoch, position)
+        episodes.append(_planning_dataset.plan_episode(idx, metadata))
+    return episodes
+
+
+def plan_epoch(
+    dataset,
+    batch_sampler,
+    seed: int,
+    epoch: int,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 256,
+) -> EpisodePlan:
+    """Draw the batches of an epoch from the sampler and choose the episode of every sample.
+    The plan only depends on the seed and the epoch, not on the epochs planned before.
+
+    Args:
+        dataset (LabelAnythingDataset): The dataset, which chooses the episodes.
+        batch_sampler (VariableBatchSampler): The sampler of the training batches.
+        seed (int): The seed of the run.
+        epoch (int): The epoch.
+        num_workers (Optional[int], optional): Number of processes. Defaults to the number of CPUs.
+        chunk_size (int, optional): Number of episodes planned at once by a process. Defaults to 256.
+
+    Returns:
+        EpisodePlan: The plan of the epoch.
+    """
+    global _planning_dataset
+
+    _seed(seed, epoch)
+    batch_sampler.set_epoch(epoch)
+    batches = list(iter(batch_sampler))
+    samples = [
+        (position, idx, metadata)
+        for position, (idx, metadata) in enumerate(
+            sample for batch in batches for sample in batch
+        )
+    ]
+    chunks = [
+        (seed, epoch, samples[start : start + chunk_size])
+        for start in range(0, len(samples), chunk_size)
+    ]
+    _planning_dataset = dataset
+    try:
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            episodes = [
+                episode
+                for chunk in tqdm(
+                    pool.imap(_plan_episodes, chunks),
+                    total=len(chunks),
+                    desc=f"Planning epoch {epoch}",
+                )
+                for episode in chunk
+            ]
+    finally:
+        _planning_dataset = None
+
+    image_counts = [0 if x is None else len(x[0]) for x in episodes]
+    category_counts = [0 if x is None else len(x[1]) for x in episodes]
+    planned = [x for x in episodes if x is not None]
+    return EpisodePlan(
+        indices=np.array([idx for _, idx, _ in samples], dtype=np.int64),
+        batch_offsets=np.cumsum([0] + [len(batch) for batch in batches]),
+        batch_metadata=[batch[0][1] if batch else {} for batch in batches],
+        image_offsets=np.cumsum([0] + image_counts),
+        image_ids=np.array(
+            [img for image_ids, _ in planned for img in image_ids], dtype=np.int64
+        ),
+        category_offsets=np.cumsum([0] + category_counts),
+        category_ids=np.array(
+            [cat for _, cat_ids in planned for cat in cat_ids], dtype=np.int64
+        ),
+    )
+
+
+def plan_epochs(
+    dataset,
+    batch_sampler,
+    plan_dir: str,
+    seed: int,
+    num_epochs: int,
+    num_workers: Optional[int] = None,
+):
+    """Write the episode plans of the first num_epochs epochs to plan_dir, skipping the
+    epochs already planned, so that an interrupted run can be resumed.
+
+    Args:
+        dataset (LabelAnythingDataset): The training dataset.
+        batch_sampler (VariableBatchSampler): The sampler of the training batches.
+        plan_dir (str): Directory of the plans.
+        seed (int): The seed of the run.
+        num_epochs (int): Number of epochs to plan.
+        num_workers (Optional[int], optional): Number of processes. Defaults to the number of CPUs.
+    """
+    os.makedirs(plan_dir, exist_ok=True)
+    for epoch in range(num_epochs):
+        path = episode_plan_path(plan_dir, epoch)
+        if os.path.exists(path):
+            logger.info(f"Epoch {epoch} already planned in {path}")
+            continue
+        plan = plan_epoch(dataset, batch_sampler, seed, epoch, num_workers)
+        plan.save(path)
+        logger.info(f"Planned epoch {epoch}: {plan.statistics()}")
+
+
+def plan_episodes_from_parameters(
+    param_path: str,
+    plan_dir: str,
+    num_epochs: Optional[int] = None,
+    num_processes: int = 1,
+    num_workers: Optional[int] = None,
+):
+    """Plan the epochs of a run from its parameters file, with the training dataset and
+    sampler of the run. Set ``episode_plan_dir`` in the dataloader parameters of the run
+    to train on the plans.
+
+    Args:
+        param_path (str): Path to the parameters file of the run.
+        plan_dir (str): Directory of the plans.
+        num_epochs (Optional[int], optional): Number of epochs to plan. Defaults to max_epochs.
+        num_processes (int, optional): Number of training processes. Defaults to 1.
+        num_workers (Optional[int], optional): Number of processes. Defaults to the number of CPUs.
+    """
+    import copy
+
+    from label_anything.data import get_dataloaders
+    from label_anything.utils.utils import load_yaml
+
+    params = load_yaml(param_path)
+    # the initial batches of the sampler are drawn when it is built
+    _seed(params["seed"])
+    dataset_params = copy.deepcopy(params["dataset"])
+    dataset_params["datasets"] = {
+        k: v
+        for k, v in dataset_params["datasets"].items()
+        if not k.startswith(("val_", "test_"))
+    }
+    dataloader_params = copy.deepcopy(params["dataloader"])
+    dataloader_params.pop("episode_plan_dir", None)
+    train_loader, _, _ = get_dataloaders(
+        dataset_params, dataloader_params, num_processes
+    )
+    if num_epochs is None:
+        num_epochs = params["train_params"]["max_epochs"]
+    plan_epochs(
+        train_loader.dataset,
+        train_loader.batch_sampler,
+        plan_dir,
+        params["seed"],
+        num_epochs,
+        num_workers,
+    )
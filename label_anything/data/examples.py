@@ -1,7 +1,8 @@
-from functools import partial
-
 import torch
 
+from label_anything.data.class_sampling import PowerLawSampler, sample_class_subset
+from label_anything.data.image_bitsets import CategoryImageBitsets, ImageBitset
+
 
 class SamplingFailureException(Exception):
     """
@@ -33,6 +34,8 @@ def sample_power_law(N, alpha, num_samples=1):
 
 
 def uniform_sampling(elem_set, sampled_elems, *args, **kwargs):
+    if isinstance(elem_set, ImageBitset):
+        return elem_set.sample(sampled_elems)
     to_sample_from = [c for c in elem_set if c not in sampled_elems]
     return to_sample_from[torch.randint(0, len(to_sample_from), (1,)).item()]
 
@@ -62,6 +65,7 @@ class ExampleGenerator:
         class_sample_function (function): function to use to sample the classes
         image_sample_function (function): function to use to select the image from the set of images containing the classes
         num_examples (int): number of examples to generate
+        use_bitsets (bool): whether to index categories_to_imgs with packed bit vectors (see CategoryImageBitsets)
     """
 
     def __init__(
@@ -72,6 +76,7 @@ class ExampleGenerator:
         class_sample_function,
         image_sample_function,
         min_size,
+        use_bitsets=True,
     ) -> None:
         self.image_sample_function = image_sample_function
         self.class_sample_function = class_sample_function
@@ -79,6 +84,11 @@ class ExampleGenerator:
         self.min_size = min_size
         self.categories_to_imgs = categories_to_imgs
         self.images_to_categories = images_to_categories
+        self.image_bitsets = (
+            CategoryImageBitsets(categories_to_imgs)
+            if use_bitsets and categories_to_imgs is not None
+            else None
+        )
 
     def sample_classes_from_query(self, class_list, sample_function, frequencies=None):
         """
@@ -99,6 +109,17 @@ class ExampleGenerator:
         sampled_classes = []
         if n_elements == len(class_list):
             return class_list
+        if sample_function in (uniform_sampling, sample_over_inverse_frequency):
+            # same distribution, with a single call for the whole subset
+            return torch.tensor(
+                sample_class_subset(
+                    torch.as_tensor(class_list).tolist(),
+                    n_elements,
+                    frequencies
+                    if sample_function is sample_over_inverse_frequency
+                    else None,
+                )
+            )
         if n_elements > len(class_list) // 2:
             for _ in range(len(class_list) - n_elements):
                 sampled_class = sample_function(
@@ -123,6 +144,11 @@ class ExampleGenerator:
         Returns the set of image ids that contain all categories in the sublist
         except for the query image id.
         """
+        if self.image_bitsets is not None:
+            return self.image_bitsets.intersection(sublist, excluded_ids)
+        if hasattr(self.categories_to_imgs, "intersection"):
+            # array-backed index (see AnnotationIndex)
+            return self.categories_to_imgs.intersection(sublist, excluded_ids)
         intersection = set.intersection(
             *[self.categories_to_imgs[cat] for cat in sublist]
         )
@@ -131,7 +157,7 @@ class ExampleGenerator:
     def backup_sampling(self, class_set, frequencies):
         for cls in class_set:
             images_containing = self.get_image_ids_intersection([cls], [])
-            if len(images_containing) > 0:
+            if images_containing:
                 if cls not in frequencies:
                     frequencies[cls] = 0
                 return images_containing, [cls], frequencies
@@ -151,12 +177,12 @@ class ExampleGenerator:
         if random_class:
             query_classes = [classes[torch.randint(len(classes), size=(1,)).item()]]
             query_image_id = self.image_sample_function(
-                self.categories_to_imgs[query_classes[0]], []
+                self.get_image_ids_intersection(query_classes, []), []
             )
         else:
             while True:
                 images_containing = self.get_image_ids_intersection(query_classes, [])
-                if len(images_containing) > 0:
+                if images_containing:
                     query_image_id = self.image_sample_function(
                         images_containing,
                         [],
@@ -173,7 +199,7 @@ class ExampleGenerator:
         example_sampled_classes = [total_query_classes]
         for i in range(num_examples):
             for cls in classes:
-                example_image_ids = self.categories_to_imgs[cls]
+                example_image_ids = self.get_image_ids_intersection([cls], [])
                 example_id = self.image_sample_function(
                     example_image_ids,
                     image_ids,
@@ -240,7 +266,7 @@ class ExampleGenerator:
                     example_sampled_classes, image_ids
                 )
                 if (
-                    len(images_containing) > 0
+                    images_containing
                 ):  # We found at least one image, we can take one of them and stop
                     found = True
                     example_id = self.image_sample_function(
@@ -293,10 +319,11 @@ class NWayExampleGenerator(ExampleGenerator):
         min_size=1,
         alpha=-2.0,
         sample_function="power_law",
+        use_bitsets=True,
     ) -> None:
         if n_ways == "max":
             if sample_function == "power_law":
-                n_classes_sample_function = partial(sample_power_law, alpha=alpha)
+                n_classes_sample_function = PowerLawSampler(alpha)
             elif sample_function == "uniform":
                 n_classes_sample_function = sample_uniform
             else:
@@ -311,6 +338,7 @@ class NWayExampleGenerator(ExampleGenerator):
             sample_over_inverse_frequency,
             uniform_sampling,
             min_size,
+            use_bitsets=use_bitsets,
         )
 
 
@@ -319,7 +347,9 @@ class MaxWayMinShotsExampleGenerator(ExampleGenerator):
     Generate examples with a power law distribution over the number of classes and selecting an image uniformly among the eligible ones.
     """
 
-    def __init__(self, images_to_categories, categories_to_imgs, min_size=1) -> None:
+    def __init__(
+        self, images_to_categories, categories_to_imgs, min_size=1, use_bitsets=True
+    ) -> None:
         super().__init__(
             images_to_categories,
             categories_to_imgs,
@@ -327,6 +357,7 @@ class MaxWayMinShotsExampleGenerator(ExampleGenerator):
             None,
             uniform_sampling,
             min_size,
+            use_bitsets=use_bitsets,
         )
 
     def generate_examples(
@@ -366,7 +397,7 @@ class MaxWayMinShotsExampleGenerator(ExampleGenerator):
                         included_classes, image_ids
                     )
                     if (
-                        len(images_containing) > 0
+                        images_containing
                     ):  # We found at least one image, we can take one of them and stop
                         example_id = self.image_sample_function(
                             images_containing,
@@ -394,10 +425,11 @@ def build_example_generator(
     min_size=1,
     alpha=-2.0,
     sample_function="power_law",
+    use_bitsets=True,
 ):
     if n_shots == "min":
         return MaxWayMinShotsExampleGenerator(
-            images_to_categories, categories_to_imgs, min_size
+            images_to_categories, categories_to_imgs, min_size, use_bitsets=use_bitsets
         )
     else:
         return NWayExampleGenerator(
@@ -407,4 +439,5 @@ def build_example_generator(
             min_size,
             alpha,
             sample_function=sample_function,
+            use_bitsets=use_bitsets,
         )
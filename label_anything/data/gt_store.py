@@ -0,0 +1,158 @@
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+from pycocotools import mask as mask_utils
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from label_anything.data.utils import AnnFileKeys
+
+META_FILENAME = "meta.json"
+
+
+def label_map_dtype(max_category_id: int) -> np.dtype:
+    """Smallest dtype able to store the category ids (torch has no uint16)."""
+    if max_category_id <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if max_category_id <= np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+
+def rasterize_label_map(
+    image: dict, annotations: list[dict], dtype: np.dtype = np.int16
+) -> np.ndarray:
+    """Rasterize the annotations of an image to a label map of category ids.
+
+    Where annotations overlap, the highest category id wins, as in the label maps
+    previously stored in the embedding files.
+
+    Args:
+        image (dict): The image data, as in the instances file.
+        annotations (list[dict]): The annotations of the image.
+        dtype (np.dtype, optional): The dtype of the label map. Defaults to np.int16.
+
+    Returns:
+        np.ndarray: The (height, width) label map, 0 is the background.
+    """
+    h, w = image["height"], image["width"]
+    label_map = np.zeros((h, w), dtype=dtype)
+    for ann in annotations:
+        segm = ann[AnnFileKeys.SEGMENTATION]
+        if isinstance(segm, list):
+            rle = mask_utils.merge(mask_utils.frPyObjects(segm, h, w))
+        elif isinstance(segm["counts"], list):
+            rle = mask_utils.frPyObjects(segm, h, w)
+        else:
+            rle = segm
+        mask = mask_utils.decode(rle).astype(bool)
+        if not mask.any():
+            # same fallback as PromptsProcessor.convert_mask
+            if isinstance(segm, list):
+                x, y = int(segm[0][0]), int(segm[0][1])
+                mask[min(max(y, 0), h - 1), min(max(x, 0), w - 1)] = True
+            else:
+                mask[0, 0] = True
+        np.maximum(label_map, ann[AnnFileKeys.CATEGORY_ID], out=label_map, where=mask)
+    return label_map
+
+
+def shard_name(dataset_name: str, shard_idx: int) -> str:
+    return f"{dataset_name}_gt-{shard_idx:05d}.safetensors"
+
+
+def write_gt_shard(
+    outfolder: str,
+    dataset_name: str,
+    shard_idx: int,
+    images: list[dict],
+    annotations: dict[int, list[dict]],
+    dtype: np.dtype,
+):
+    """Rasterize the label maps of a shard of images and write them atomically, so that an
+    interrupted run never leaves a partial shard behind.
+
+    Args:
+        outfolder (str): Directory of the ground truth store.
+        dataset_name (str): Name of the dataset.
+        shard_idx (int): Index of the shard.
+        images (list[dict]): The images of the shard.
+        annotations (dict[int, list[dict]]): Mapping from image ids to their annotations.
+        dtype (np.dtype): The dtype of the label maps.
+    """
+    tensors = {
+        str(image[AnnFileKeys.ID]): torch.from_numpy(
+            rasterize_label_map(
+                image, annotations.get(image[AnnFileKeys.ID], []), dtype=dtype
+            )
+        )
+        for image in images
+    }
+    path = os.path.join(outfolder, shard_name(dataset_name, shard_idx))
+    save_file(tensors, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+class GroundTruthStore:
+    """Read-only store of the label maps written by generate_ground_truths.
+
+    The store directory contains a ``meta.json`` and shards of label maps
+    (``{name}_gt-00000.safetensors``, ...) keyed by image id. Shards are opened lazily,
+    once per process, and only the requested label map is read.
+    """
+
+    def __init__(self, gt_dir: str):
+        self.gt_dir = gt_dir
+        with open(os.path.join(gt_dir, META_FILENAME), "r") as f:
+            self.meta = json.load(f)
+        self.shards = [
+            shard_name(self.meta["dataset_name"], i)
+            for i in range(self.meta["num_shards"])
+        ]
+        self.entries = {}
+        for shard_idx, shard in enumerate(self.shards):
+            path = os.path.join(gt_dir, shard)
+            if not os.path.exists(path):
+                raise FileNotFoundError(
+                    f"Missing ground truth shard {path}, run generate_gt again to complete the store."
+                )
+            with safe_open(path, framework="pt") as f:
+                for key in f.keys():
+                    self.entries[key] = shard_idx
+        self._handles = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_handles"] = None
+        state["_pid"] = None
+        return state
+
+    def _get_shard(self, shard_idx: int):
+        if self._pid != os.getpid():
+            self._handles = [None] * len(self.shards)
+            self._pid = os.getpid()
+        if self._handles[shard_idx] is None:
+            self._handles[shard_idx] = safe_open(
+                os.path.join(self.gt_dir, self.shards[shard_idx]), framework="pt"
+            )
+        return self._handles[shard_idx]
+
+    def __getitem__(self, image_id) -> torch.Tensor:
+        key = str(image_id)
+        return self._get_shard(self.entries[key]).get_tensor(key)
+
+    def __contains__(self, image_id) -> bool:
+        return str(image_id) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def open_gt_store(gt_dir: Optional[str]) -> Optional[GroundTruthStore]:
+    if gt_dir is None:
+        return None
+    return GroundTruthStore(gt_dir)
@@ -0,0 +1,112 @@
+from itertools import chain
+
+import numpy as np
+import torch
+
+from label_anything.data.annotation_index import CategoryImagesView
+
+# number of set bits of each byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+class CategoryImageBitsets:
+    """Category -> image membership stored as packed bit vectors over dense image indices.
+
+    Row c of ``bits`` has bit i set if the i-th image contains the c-th category, so that
+    intersections, exclusions and "any image containing" queries are bitwise ops on
+    ceil(n_images / 8) bytes, regardless of how many images contain each category.
+
+    Args:
+        categories_to_imgs (Mapping): Mapping from category ids to collections of image ids.
+    """
+
+    def __init__(self, categories_to_imgs):
+        self.category_ids = list(categories_to_imgs.keys())
+        self.category_rows = {cat: i for i, cat in enumerate(self.category_ids)}
+        if isinstance(categories_to_imgs, CategoryImagesView):
+            # the annotation index already has dense image indices
+            index = categories_to_imgs.index
+            self.image_ids = index.image_ids.tolist()
+            members = [index.category_image_idxs(cat) for cat in self.category_ids]
+            self.image_idxs = {img: i for i, img in enumerate(self.image_ids)}
+        else:
+            self.image_ids = list(
+                dict.fromkeys(chain.from_iterable(categories_to_imgs.values()))
+            )
+            self.image_idxs = {img: i for i, img in enumerate(self.image_ids)}
+            members = [
+                np.fromiter(
+                    (self.image_idxs[img] for img in categories_to_imgs[cat]),
+                    dtype=np.int64,
+                )
+                for cat in self.category_ids
+            ]
+
+        n_bytes = (len(self.image_ids) + 7) // 8
+        self.bits = np.zeros((len(self.category_ids), n_bytes), dtype=np.uint8)
+        row_bits = np.zeros(n_bytes * 8, dtype=bool)
+        for row, idxs in enumerate(members):
+            row_bits[:] = False
+            row_bits[idxs] = True
+            self.bits[row] = np.packbits(row_bits)
+
+    def _clear(self, bits: np.ndarray, image_ids) -> np.ndarray:
+        idxs = np.array(
+            [self.image_idxs[x] for x in image_ids if x in self.image_idxs],
+            dtype=np.int64,
+        )
+        if len(idxs) > 0:
+            masks = np.invert(np.right_shift(0x80, idxs & 7).astype(np.uint8))
+            np.bitwise_and.at(bits, idxs >> 3, masks)
+        return bits
+
+    def intersection(self, cat_ids: list, excluded_ids: list = ()) -> "ImageBitset":
+        """Images containing all the categories, except the excluded ones.
+
+        Args:
+            cat_ids (list): Category ids.
+            excluded_ids (list, optional): Image ids to exclude. Defaults to ().
+
+        Returns:
+            ImageBitset: The resulting set of images.
+        """
+        rows = [self.category_rows[cat] for cat in cat_ids]
+        # fancy indexing copies, so the result can be modified in place
+        bits = np.bitwise_and.reduce(self.bits[rows], axis=0)
+        return ImageBitset(self, self._clear(bits, excluded_ids))
+
+
+class ImageBitset:
+    """A set of images of a CategoryImageBitsets, as a packed bit vector. Supports the
+    read-only set protocol used by the example generators, plus uniform sampling."""
+
+    def __init__(self, bitsets: CategoryImageBitsets, bits: np.ndarray):
+        self.bitsets = bitsets
+        self.bits = bits
+
+    def __len__(self):
+        return int(_POPCOUNT[self.bits].sum())
+
+    def __bool__(self):
+        return bool(self.bits.any())
+
+    def __contains__(self, image_id):
+        i = self.bitsets.image_idxs.get(image_id)
+        return i is not None and bool(self.bits[i >> 3] & (0x80 >> (i & 7)))
+
+    def __iter__(self):
+        return (self.bitsets.image_ids[i] for i in self.indices())
+
+    def indices(self) -> np.ndarray:
+        """Dense indices of the images in the set."""
+        return np.flatnonzero(
+            np.unpackbits(self.bits, count=len(self.bitsets.image_ids))
+        )
+
+    def difference(self, image_ids) -> "ImageBitset":
+        return ImageBitset(self.bitsets, self.bitsets._clear(self.bits.copy(), image_ids))
+
+    def sample(self, excluded_ids=()):
+        """Sample an image uniformly, except the excluded ones."""
+        idxs = self.difference(excluded_ids).indices()
+        return self.bitsets.image_ids[idxs[torch.randint(0, len(idxs), (1,)).item()]]
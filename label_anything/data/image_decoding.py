@@ -0,0 +1,123 @@
+from io import BytesIO
+from typing import Optional, Union
+
+from PIL import Image
+from torchvision.transforms import Compose, Resize
+
+from label_anything.data.transforms import CustomResize
+from label_anything.data.utils import get_preprocess_shape
+
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+except ImportError:  # PyTurboJPEG is optional, PIL draft mode is used instead
+    TurboJPEG = None
+
+JPEG_MAGIC = b"\xff\xd8"
+# scaling factors of the IDCT supported by libjpeg(-turbo), from the smallest image
+TURBO_SCALING_FACTORS = [(1, 8), (1, 4), (3, 8), (1, 2), (5, 8), (3, 4), (7, 8)]
+
+_turbo_jpeg = None
+
+
+def _get_turbo_jpeg() -> Optional["TurboJPEG"]:
+    global _turbo_jpeg
+    if _turbo_jpeg is None and TurboJPEG is not None:
+        try:
+            _turbo_jpeg = TurboJPEG()
+        except OSError:
+            # the binding is installed but libturbojpeg is not
+            _turbo_jpeg = False
+    return _turbo_jpeg or None
+
+
+def resize_target(preprocess, height: int, width: int) -> Optional[tuple[int, int]]:
+    """The size (height, width) an image is resized to by the first transform of
+    preprocess, or None if it does not start with a resize.
+
+    Args:
+        preprocess: The preprocessing of the images (a Compose, or a single transform).
+        height (int): The height of the image.
+        width (int): The width of the image.
+
+    Returns:
+        Optional[tuple[int, int]]: The resized height and width.
+    """
+    transforms = (
+        preprocess.transforms if isinstance(preprocess, Compose) else [preprocess]
+    )
+    if not transforms:
+        return None
+    resize = transforms[0]
+    if isinstance(resize, CustomResize):
+        return get_preprocess_shape(height, width, resize.long_side_length)
+    if isinstance(resize, Resize) and resize.max_size is None:
+        size = resize.size
+        if isinstance(size, (list, tuple)) and len(size) == 2:
+            return tuple(size)
+        # the short side is resized to size, as in torchvision
+        size = size if isinstance(size, int) else size[0]
+        short, long = (width, height) if width <= height else (height, width)
+        new_short, new_long = size, int(size * long / short)
+        return (new_long, new_short) if width <= height else (new_short, new_long)
+    return None
+
+
+def _decode_turbo(
+    data: bytes, height: int, width: int, target: tuple[int, int]
+) -> Image.Image:
+    turbo_jpeg = _get_turbo_jpeg()
+    scaling_factor = (1, 1)
+    for num, den in TURBO_SCALING_FACTORS:
+        if -(-height * num // den) >= target[0] and -(-width * num // den) >= target[1]:
+            scaling_factor = (num, den)
+            break
+    return Image.fromarray(
+        turbo_jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+    )
+
+
+def decode_image(source: Union[str, bytes], preprocess=None) -> Image.Image:
+    """Decode an RGB image, from a path or from its encoded bytes.
+
+    If preprocess starts with a resize (CustomResize or Resize) and the image is a JPEG,
+    it is decoded at the smallest DCT scale at or above the resized size, with
+    libjpeg-turbo if PyTurboJPEG is installed, with PIL draft mode otherwise, and
+    resized to the exact size the preprocessing would give, so that its resize does
+    nothing and the geometry of the image is unchanged. Decoding at a lower scale skips
+    most of the work of the full decode, at the cost of slightly different pixels.
+
+    Args:
+        source (Union[str, bytes]): The path of the image, or its encoded bytes.
+        preprocess (optional): The preprocessing applied to the image afterwards. Defaults to None (full decode).
+
+    Returns:
+        Image.Image: The image.
+    """
+    image = Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+    target = (
+        resize_target(preprocess, image.height, image.width)
+        if preprocess is not None and image.format == "JPEG"
+        else None
+    )
+    if target is None:
+        return image.convert("RGB")
+
+    height, width = image.height, image.width
+    decoded = None
+    if _get_turbo_jpeg() is not None:
+        if not isinstance(source, bytes):
+            with open(source, "rb") as f:
+                source = f.read()
+        if source[:2] == JPEG_MAGIC:
+            try:
+                decoded = _decode_turbo(source, height, width, target)
+            except OSError:
+                # e.g. CMYK images, left to PIL
+                decoded = None
+    if decoded is None:
+        image.draft("RGB", (target[1], target[0]))
+        decoded = image.convert("RGB")
+    if decoded.size == (width, height):
+        # not reduced, the preprocessing resizes it as usual
+        return decoded
+    return decoded.resize((target[1], target[0]), Image.BILINEAR)
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+BLOBS_DIR = "blobs"
+URLS_DIR = "urls"
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ImageFetcher:
+    """Downloads images by url through a pooled session with retries, caching them on
+    disk and optionally prefetching them in background threads.
+
+    The cache is content-addressed: an image is stored once in
+    ``{cache_dir}/blobs/{sha256[:2]}/{sha256}``, and ``{cache_dir}/urls/{sha1(url)}``
+    holds the sha256 of the content of each url. Writes are atomic, so that the cache
+    can be shared by all the processes of a node. The session and the threads are
+    created lazily, once per process.
+
+    Args:
+        cache_dir (Optional[str], optional): Directory of the cache. Defaults to None (no cache, prefetching does nothing).
+        max_connections (int, optional): Maximum number of concurrent connections (and prefetching threads) of a process. Defaults to 8.
+        retries (int, optional): Number of retries of a failed request, on connection errors and 429/5xx responses. Defaults to 3.
+        backoff_factor (float, optional): Exponential backoff between retries, in seconds. Defaults to 0.5.
+        timeout (float, optional): Timeout of a request, in seconds. Defaults to 30.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_connections: int = 8,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: float = 30,
+    ):
+        self.cache_dir = cache_dir
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self._session = None
+        self._executor = None
+        self._in_flight = {}
+        self._lock = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_session"] = None
+        state["_executor"] = None
+        state["_in_flight"] = {}
+        state["_lock"] = None
+        state["_pid"] = None
+        return state
+
+    def _init_process(self):
+        if self._pid == os.getpid():
+            return
+        # sessions, threads and locks are never shared with forked workers
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.max_connections,
+            pool_maxsize=self.max_connections,
+            pool_block=True,
+            max_retries=Retry(
+                total=self.retries,
+                backoff_factor=self.backoff_factor,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=["GET"],
+            ),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self._session = session
+        self._executor = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(
+            self.cache_dir, URLS_DIR, hashlib.sha1(url.encode()).hexdigest()
+        )
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, BLOBS_DIR, digest[:2], digest)
+
+    def _read_cache(self, url: str) -> Optional[bytes]:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._url_path(url), "r") as f:
+                digest = f.read()
+            with open(self._blob_path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def is_cached(self, url: str) -> bool:
+        if self.cache_dir is None:
+            return False
+        try:
+            with open(self._url_path(url), "r") as f:
+                return os.path.exists(self._blob_path(f.read()))
+        except FileNotFoundError:
+            return False
+
+    def _download(self, url: str) -> bytes:
+        response = self._session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.content
+        if self.cache_dir is not None:
+            digest = _sha256(data)
+            if not os.path.exists(self._blob_path(digest)):
+                _write_atomic(self._blob_path(digest), data)
+            # the content is written before the url points to it
+            _write_atomic(self._url_path(url), digest.encode())
+        return data
+
+    def get(self, url: str) -> bytes:
+        """Return the content of url, from the cache, from a prefetch in flight, or
+        downloaded (and cached).
+
+        Args:
+            url (str): The url of the image.
+
+        Returns:
+            bytes: The encoded image.
+        """
+        self._init_process()
+        data = self._read_cache(url)
+        if data is not None:
+            return data
+        with self._lock:
+            future = self._in_flight.get(url)
+        if future is None:
+            # a prefetch may have completed since the cache was read
+            data = self._read_cache(url)
+            if data is not None:
+                return data
+        else:
+            try:
+                return future.result()
+            except Exception:
+                # downloaded again below, so that the error is raised here
+                pass
+        return self._download(url)
+
+    def _prefetch_done(self, url: str, future: Future):
+        with self._lock:
+            self._in_flight.pop(url, None)
+        if future.exception() is not None:
+            logger.warning(f"Prefetching {url} failed: {future.exception()}")
+
+    def prefetch(self, urls: Iterable[str]):
+        """Start downloading the urls that are not cached yet in background threads,
+        without waiting for them. Only useful with a cache, as the downloads of a process
+        are then available to all the others.
+
+        Args:
+            urls (Iterable[str]): The urls of the images.
+        """
+        if self.cache_dir is None:
+            return
+        self._init_process()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_connections, thread_name_prefix="image-fetcher"
+            )
+        for url in urls:
+            if self.is_cached(url):
+                continue
+            with self._lock:
+                if url in self._in_flight:
+                    continue
+                future = self._executor.submit(self._download, url)
+                self._in_flight[url] = future
+            future.add_done_callback(lambda f, url=url: self._prefetch_done(url, f))
@@ -0,0 +1,322 @@
+import functools
+import glob
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional
+
+import numpy as np
+from pycocotools import mask as mask_utils
+
+import label_anything.data.utils as utils
+from label_anything.data.utils import AnnFileKeys
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+CACHE_VERSION = 1
+META_FILENAME = "meta.json"
+SMALL_ANNOTATION_AREA = 2 * 32 * 32
+
+
+@functools.lru_cache(maxsize=None)
+def _hash_file(path: str, size: int, mtime: float) -> str:
+    # size and mtime are only part of the lru_cache key, to rehash modified files
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_instances(instances_path: str) -> str:
+    """Hash the content of the instances file(s) (instances_path can be a glob pattern)."""
+    if "*" in str(instances_path):
+        files = sorted(glob.glob(instances_path))
+    else:
+        files = [instances_path]
+    h = hashlib.sha1()
+    for file in files:
+        stat = os.stat(file)
+        h.update(_hash_file(str(file), stat.st_size, stat.st_mtime).encode())
+    return h.hexdigest()
+
+
+def instances_cache_key(
+    instances_path: str,
+    remove_small_annotations: bool,
+    remove_crowd: bool = True,
+    category_ids: Optional[list[int]] = None,
+) -> str:
+    """Compute the cache key of the instances file and the filtering options."""
+    options = {
+        "version": CACHE_VERSION,
+        "instances": hash_instances(instances_path),
+        "remove_small_annotations": remove_small_annotations,
+        "remove_crowd": remove_crowd,
+        "category_ids": sorted(category_ids) if category_ids is not None else None,
+    }
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def encode_segmentation(segmentation, h: int, w: int) -> bytes:
+    """Encode a segmentation (polygons, uncompressed RLE or RLE) to compressed RLE counts.
+
+    Empty polygons are replaced by their first point, as done by PromptsProcessor.convert_mask.
+    """
+    if isinstance(segmentation, list):
+        rle = mask_utils.merge(mask_utils.frPyObjects(segmentation, h, w))
+        if mask_utils.area(rle) == 0:
+            matrix = mask_utils.decode(rle)
+            first_polygon = segmentation[0]
+            fp_x = max(min(int(first_polygon[0]), w - 1), 0)
+            fp_y = max(min(int(first_polygon[1]), h - 1), 0)
+            matrix[fp_y, fp_x] = 1
+            rle = mask_utils.encode(np.asfortranarray(matrix))
+    elif isinstance(segmentation["counts"], list):
+        rle = mask_utils.frPyObjects(segmentation, h, w)
+    else:
+        rle = segmentation
+    counts = rle["counts"]
+    return counts if isinstance(counts, bytes) else counts.encode()
+
+
+class PackedInstances:
+    """COCO/LVIS instances, already filtered, stored as flat numpy arrays.
+
+    Images and categories are kept as lists of dicts (in the order of the instances file), while
+    annotations are stored column-wise, with segmentations as compressed RLE counts packed in a
+    single byte buffer (segmentation i is segm_data[segm_offsets[i]:segm_offsets[i + 1]]).
+    """
+
+    ARRAYS = [
+        "ann_ids",
+        "ann_image_ids",
+        "ann_category_ids",
+        "ann_areas",
+        "ann_bboxes",
+        "ann_iscrowd",
+        "ann_sizes",
+        "segm_offsets",
+        "segm_data",
+    ]
+
+    def __init__(self, images: list[dict], categories: list[dict], **arrays):
+        self.images = images
+        self.categories = categories
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.ann_ids)
+
+    @classmethod
+    def from_instances(
+        cls,
+        instances: dict,
+        remove_small_annotations: bool = False,
+        remove_crowd: bool = True,
+        category_ids: Optional[list[int]] = None,
+    ) -> "PackedInstances":
+        """Filter and pack the instances (as loaded from the json file).
+
+        Args:
+            instances (dict): The instances dict.
+            remove_small_annotations (bool, optional): Remove annotations smaller than 2*32*32 pixels. Defaults to False.
+            remove_crowd (bool, optional): Remove crowd annotations. Defaults to True.
+            category_ids (Optional[list[int]], optional): Keep only these categories. Defaults to None (all).
+
+        Returns:
+            PackedInstances: The packed instances.
+        """
+        categories = [
+            x
+            for x in instances[AnnFileKeys.CATEGORIES]
+            if category_ids is None or x[AnnFileKeys.ID] in category_ids
+        ]
+        category_set = {x[AnnFileKeys.ID] for x in categories}
+        image_sizes = {
+            x[AnnFileKeys.ID]: (x["height"], x["width"])
+            for x in instances[AnnFileKeys.IMAGES]
+        }
+
+        annotations = []
+        for ann in instances[AnnFileKeys.ANNOTATIONS]:
+            if remove_small_annotations and ann["area"] < SMALL_ANNOTATION_AREA:
+                continue
+            if remove_crowd and ann.get(AnnFileKeys.ISCROWD, 0) == 1:
+                continue
+            if ann[AnnFileKeys.CATEGORY_ID] not in category_set:
+                continue
+            annotations.append(ann)
+
+        image_set = {ann[AnnFileKeys.IMAGE_ID] for ann in annotations}
+        images = [
+            x for x in instances[AnnFileKeys.IMAGES] if x[AnnFileKeys.ID] in image_set
+        ]
+
+        segmentations = [
+            encode_segmentation(
+                ann[AnnFileKeys.SEGMENTATION], *image_sizes[ann[AnnFileKeys.IMAGE_ID]]
+            )
+            for ann in annotations
+        ]
+        segm_offsets = np.zeros(len(annotations) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in segmentations], out=segm_offsets[1:])
+
+        return cls(
+            images=images,
+            categories=categories,
+            ann_ids=np.array([x[AnnFileKeys.ID] for x in annotations], dtype=np.int64),
+            ann_image_ids=np.array(
+                [x[AnnFileKeys.IMAGE_ID] for x in annotations], dtype=np.int64
+            ),
+            ann_category_ids=np.array(
+                [x[AnnFileKeys.CATEGORY_ID] for x in annotations], dtype=np.int64
+            ),
+            ann_areas=np.array([x["area"] for x in annotations], dtype=np.float64),
+            ann_bboxes=np.array(
+                [x["bbox"] for x in annotations], dtype=np.float64
+            ).reshape(-1, 4),
+            ann_iscrowd=np.array(
+                [x.get(AnnFileKeys.ISCROWD, 0) for x in annotations], dtype=np.uint8
+            ),
+            ann_sizes=np.array(
+                [image_sizes[x[AnnFileKeys.IMAGE_ID]] for x in annotations],
+                dtype=np.int32,
+            ).reshape(-1, 2),
+            segm_offsets=segm_offsets,
+            segm_data=np.frombuffer(b"".join(segmentations), dtype=np.uint8),
+        )
+
+    def filter_categories(self, category_ids: list[int]) -> "PackedInstances":
+        """Return the packed instances restricted to the given categories."""
+        keep = np.isin(self.ann_category_ids, list(category_ids))
+        kept_idxs = np.flatnonzero(keep)
+        lengths = np.diff(self.segm_offsets)[kept_idxs]
+        segm_offsets = np.zeros(len(kept_idxs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=segm_offsets[1:])
+        segm_data = np.concatenate(
+            [np.zeros(0, dtype=np.uint8)]
+            + [
+                self.segm_data[self.segm_offsets[i] : self.segm_offsets[i + 1]]
+                for i in kept_idxs
+            ]
+        )
+        image_set = set(self.ann_image_ids[kept_idxs].tolist())
+        category_set = set(category_ids)
+        return PackedInstances(
+            images=[x for x in self.images if x[AnnFileKeys.ID] in image_set],
+            categories=[x for x in self.categories if x[AnnFileKeys.ID] in category_set],
+            ann_ids=self.ann_ids[kept_idxs],
+            ann_image_ids=self.ann_image_ids[kept_idxs],
+            ann_category_ids=self.ann_category_ids[kept_idxs],
+            ann_areas=self.ann_areas[kept_idxs],
+            ann_bboxes=self.ann_bboxes[kept_idxs],
+            ann_iscrowd=self.ann_iscrowd[kept_idxs],
+            ann_sizes=self.ann_sizes[kept_idxs],
+            segm_offsets=segm_offsets,
+            segm_data=segm_data,
+        )
+
+    def segmentation(self, i: int) -> dict:
+        """Return the i-th segmentation as a compressed RLE dict (as accepted by pycocotools)."""
+        h, w = self.ann_sizes[i].tolist()
+        counts = self.segm_data[self.segm_offsets[i] : self.segm_offsets[i + 1]]
+        return {"size": [h, w], "counts": counts.tobytes()}
+
+    def annotation(self, i: int) -> dict:
+        """Return the i-th annotation as a dict, as in the instances file."""
+        return {
+            AnnFileKeys.ID: int(self.ann_ids[i]),
+            AnnFileKeys.IMAGE_ID: int(self.ann_image_ids[i]),
+            AnnFileKeys.CATEGORY_ID: int(self.ann_category_ids[i]),
+            AnnFileKeys.ISCROWD: int(self.ann_iscrowd[i]),
+            AnnFileKeys.SEGMENTATION: self.segmentation(i),
+            "area": float(self.ann_areas[i]),
+            "bbox": self.ann_bboxes[i].tolist(),
+        }
+
+    def annotations(self) -> list[dict]:
+        return [self.annotation(i) for i in range(len(self))]
+
+    def save(self, path: str):
+        """Save the packed instances to the directory path (written atomically)."""
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_path, META_FILENAME), "w") as f:
+            json.dump(
+                {
+                    "version": CACHE_VERSION,
+                    "images": self.images,
+                    "categories": self.categories,
+                },
+                f,
+            )
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process already wrote the same cache entry
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "PackedInstances":
+        """Load the packed instances from the directory path.
+
+        Arrays are memory-mapped by default, so that they are shared among processes.
+        """
+        with open(os.path.join(path, META_FILENAME), "r") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in cls.ARRAYS
+        }
+        return cls(images=meta["images"], categories=meta["categories"], **arrays)
+
+
+def load_packed_instances(
+    instances_path: str,
+    cache_dir: str,
+    remove_small_annotations: bool = False,
+    remove_crowd: bool = True,
+    category_ids: Optional[list[int]] = None,
+) -> PackedInstances:
+    """Load the filtered instances from the cache, parsing and caching them on a miss.
+
+    Args:
+        instances_path (str): Path to the instances json file.
+        cache_dir (str): Directory of the cache.
+        remove_small_annotations (bool, optional): Remove annotations smaller than 2*32*32 pixels. Defaults to False.
+        remove_crowd (bool, optional): Remove crowd annotations. Defaults to True.
+        category_ids (Optional[list[int]], optional): Keep only these categories. Defaults to None (all).
+
+    Returns:
+        PackedInstances: The packed instances.
+    """
+    key = instances_cache_key(
+        instances_path, remove_small_annotations, remove_crowd, category_ids
+    )
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, META_FILENAME)):
+        logger.info(f"Loading cached instances from {path}")
+        return PackedInstances.load(path)
+
+    if category_ids is not None:
+        # a category subset is obtained from the full (possibly cached) instances
+        packed = load_packed_instances(
+            instances_path, cache_dir, remove_small_annotations, remove_crowd
+        ).filter_categories(category_ids)
+    else:
+        logger.info(f"Instances cache miss, parsing {instances_path}")
+        packed = PackedInstances.from_instances(
+            utils.load_instances(instances_path),
+            remove_small_annotations=remove_small_annotations,
+            remove_crowd=remove_crowd,
+        )
+    os.makedirs(cache_dir, exist_ok=True)
+    packed.save(path)
+    return PackedInstances.load(path)
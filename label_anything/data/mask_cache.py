@@ -0,0 +1,104 @@
+import os
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+import numpy as np
+
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class MaskCache:
+    """LRU cache of decoded annotation masks, bounded by a byte budget.
+
+    The cache lives in the dataset, so every DataLoader worker fills its own copy. Cached masks
+    are made read-only, since the same array is returned to every caller.
+
+    Args:
+        max_bytes (int): Maximum total size of the cached masks in bytes.
+        report_every (int, optional): Log the statistics every report_every lookups (0 to disable). Defaults to 10000.
+    """
+
+    def __init__(self, max_bytes: int, report_every: int = 10000):
+        self.max_bytes = max_bytes
+        self.report_every = report_every
+        self._masks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._masks
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        mask = self._masks.get(key)
+        if mask is not None:
+            self._masks.move_to_end(key)
+        return mask
+
+    def put(self, key: Hashable, mask: np.ndarray):
+        if mask.nbytes > self.max_bytes or key in self._masks:
+            return
+        mask.flags.writeable = False
+        self._masks[key] = mask
+        self.nbytes += mask.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._masks.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def lookup(self, key: Hashable) -> Optional[np.ndarray]:
+        """Return the cached mask or None, counting the lookup in the statistics.
+
+        Args:
+            key (Hashable): The key of the mask (e.g. the annotation id).
+
+        Returns:
+            Optional[np.ndarray]: The (read-only) mask, None on a miss.
+        """
+        mask = self.get(key)
+        if mask is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.report_every and (self.hits + self.misses) % self.report_every == 0:
+            logger.info(f"Mask cache (pid {os.getpid()}): {self.stats()}")
+        return mask
+
+    def get_or_decode(self, key: Hashable, decode: Callable[[], np.ndarray]) -> np.ndarray:
+        """Return the cached mask, or decode and cache it.
+
+        Args:
+            key (Hashable): The key of the mask (e.g. the annotation id).
+            decode (Callable[[], np.ndarray]): Decodes the mask on a miss.
+
+        Returns:
+            np.ndarray: The (read-only) mask.
+        """
+        mask = self.lookup(key)
+        if mask is None:
+            mask = decode()
+            self.put(key, mask)
+        return mask
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4),
+            "entries": len(self._masks),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def clear(self):
+        self._masks.clear()
+        self.nbytes = 0
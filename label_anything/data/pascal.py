@@ -8,8 +8,8 @@ from torch.nn.functional import one_hot
 import numpy as np
 import torch
 from scipy.ndimage import label, binary_dilation
+from pycocotools import mask as mask_utils
 from label_anything.data.coco20i import Coco20iDataset
-from safetensors.torch import load_file
 import itertools
 from torchvision.transforms import PILToTensor, ToTensor
 from tqdm import tqdm
@@ -22,6 +22,9 @@ from label_anything.data.utils import (
     PromptType,
     flags_merge,
 )
+from label_anything.data.embedding_store import EmbeddingsBackend, open_embedding_store
+from label_anything.data.image_decoding import decode_image
+from label_anything.data.quantization import dequantize_tensors
 from label_anything.data.transforms import PromptsProcessor
 from label_anything.data.test import LabelAnythingTestDataset
 from label_anything.data.examples import build_example_generator, uniform_sampling
@@ -52,6 +55,8 @@ class PascalDataset(Dataset):
         custom_preprocess: bool = True,
         load_annotation_dicts: bool = True,
         is_pyramids: bool = False,
+        embeddings_backend: str = EmbeddingsBackend.SAFETENSORS,
+        fast_decode: bool = False,
     ):
         super().__init__()
         print(f"Loading image filenames from {split}...")
@@ -83,6 +88,9 @@ class PascalDataset(Dataset):
         self.remove_small_annotations = remove_small_annotations
         self.sample_function = sample_function
         self.is_pyramids = is_pyramids
+        # decode JPEGs at the scale they are resized to by preprocess (see decode_image)
+        self.fast_decode = fast_decode
+        self.embedding_store = open_embedding_store(self.emb_dir, embeddings_backend)
 
         self.masks_dir_list = set(os.listdir(self.masks_dir))
         self.aug_masks_dir_list = set(os.listdir(self.masks_dir + "Aug"))
@@ -259,15 +267,90 @@ class PascalDataset(Dataset):
     def __len__(self):
         return len(self.image_data)
 
+    def label_map(self, image_data: tuple[str, str]) -> np.ndarray:
+        """Return the segmentation of an image as a label map of category ids.
+
+        Args:
+            image_data (tuple[str, str]): The image name and the mask path.
+
+        Returns:
+            np.ndarray: The label map (0 for the background, 255 for the ignored pixels).
+        """
+        return self.__get_seg(image_data, with_random_choice=False)
+
+    def export_sample(self, idx: int) -> dict:
+        """Gather everything stored for the image idx, to be packed in a shard (see
+        label_anything.data.shards). The label map is converted to COCO annotations, one
+        per connected component of each category, and the image gets idx as its id.
+
+        Args:
+            idx (int): The index of the image.
+
+        Returns:
+            dict: A dictionary with:
+                - key: The key of the image in the shard.
+                - json: The image data and its annotations, as in a COCO instances file.
+                - jpg: The encoded image.
+                - safetensors: The stored tensors (embeddings and ground truths), if emb_dir is set.
+        """
+        image_name, _ = self.image_data[idx]
+        seg = self.label_map(self.image_data[idx])
+        image_data = {
+            AnnFileKeys.ID: idx,
+            "file_name": f"{image_name}.jpg",
+            "height": seg.shape[0],
+            "width": seg.shape[1],
+        }
+        annotations = []
+        for cat_id in np.unique(seg).tolist():
+            if cat_id not in self.categories:
+                continue
+            components, num_components = label(seg == cat_id)
+            for i in range(1, num_components + 1):
+                rle = mask_utils.encode(
+                    np.asfortranarray((components == i).astype(np.uint8))
+                )
+                annotations.append(
+                    {
+                        # unique as long as an image has less than 2**20 components
+                        AnnFileKeys.ID: idx * 2**20 + len(annotations),
+                        AnnFileKeys.IMAGE_ID: idx,
+                        AnnFileKeys.CATEGORY_ID: cat_id,
+                        AnnFileKeys.ISCROWD: 0,
+                        AnnFileKeys.SEGMENTATION: {
+                            "size": rle["size"],
+                            "counts": rle["counts"].decode(),
+                        },
+                        "area": float(mask_utils.area(rle)),
+                        "bbox": mask_utils.toBbox(rle).tolist(),
+                    }
+                )
+
+        with open(f"{self.img_dir}/{image_name}.jpg", "rb") as f:
+            image = f.read()
+        tensors = None
+        if self.embedding_store is not None:
+            tensors = dict(self.embedding_store[image_name])
+        return {
+            "key": str(idx).zfill(12),
+            "json": {"image": image_data, "annotations": annotations},
+            "jpg": image,
+            "safetensors": tensors,
+        }
+
     def load_and_preprocess_images(self, image_names: list[str]) -> torch.Tensor:
         image_names = [x[0] if isinstance(x, tuple) else x for x in image_names]
-        images = [
-            Image.open(f"{self.img_dir}/{image_name}.jpg") for image_name in image_names
-        ]
+        images = [self._load_image(image_name) for image_name in image_names]
         if self.preprocess is not None:
             images = [self.preprocess(image) for image in images]
         return images
 
+    def _load_image(self, image_name: str) -> Image:
+        return decode_image(
+            f"{self.img_dir}/{image_name}.jpg",
+            self.preprocess if self.fast_decode else None,
+        )
+
     def _extract_examples(
         self, image_name: str, num_examples: int, num_classes: int
     ) -> (list[int], list[int]):
@@ -308,12 +391,13 @@ class PascalDataset(Dataset):
         assert self.emb_dir is not None, "emb_dir must be provided."
         gt = None
 
-        f = load_file(f"{self.emb_dir}/{img_name}.safetensors")
+        f = self.embedding_store[img_name]
+        # quantized stores (see generate_embeddings --precision) are dequantized here
         if not self.is_pyramids:
-            embedding = f["embedding"]
+            embedding = dequantize_tensors(f)["embedding"]
         else:
             embedding = {
-                k: v for k, v in f.items() if k.startswith("stage")
+                k: v for k, v in dequantize_tensors(f).items() if k.startswith("stage")
             }
         if self.load_gts:
             gt = f[f"{self.name}_gt"]
@@ -344,10 +428,7 @@ class PascalDataset(Dataset):
                 }
             return embeddings, BatchKeys.EMBEDDINGS, gts
         else:
-            images = [
-                Image.open(f"{self.img_dir}/{image_name}.jpg")
-                for image_name in image_names
-            ]
+            images = [self._load_image(image_name) for image_name in image_names]
             if self.preprocess is not None:
                 images = [self.preprocess(image) for image in images]
             gts = None
@@ -0,0 +1,199 @@
+import json
+import multiprocessing
+import os
+from typing import Optional
+
+import numpy as np
+from tqdm import tqdm
+
+import label_anything.data.utils as utils
+from label_anything.data.annotation_index import AnnotationIndex
+from label_anything.data.instances_cache import PackedInstances
+from label_anything.data.transforms import PromptsProcessor
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+META_FILENAME = "meta.json"
+ANN_IDS_FILENAME = "ann_ids.npy"
+ANN_MASKS_FILENAME = "ann_masks.npy"
+PAIR_IMAGE_IDS_FILENAME = "pair_image_ids.npy"
+PAIR_CATEGORY_IDS_FILENAME = "pair_category_ids.npy"
+PAIR_MASKS_FILENAME = "pair_masks.npy"
+
+
+class PromptMaskStore:
+    """Read-only store of prompt masks already resized by PromptsProcessor.apply_masks.
+
+    Masks are stored as packed bits (masks_side_length**2 / 8 bytes each), in memory-mapped
+    arrays: one mask per annotation, sorted by annotation id, and the union mask of every
+    (image, category) pair, sorted by image and category id. Since nearest neighbour resizing
+    only selects pixels, the union of resized masks is exactly the resized union mask.
+    """
+
+    def __init__(self, mask_dir: str):
+        self.mask_dir = mask_dir
+        with open(os.path.join(mask_dir, META_FILENAME), "r") as f:
+            self.meta = json.load(f)
+        self.masks_side_length = self.meta["masks_side_length"]
+        self.long_side_length = self.meta["long_side_length"]
+        self.custom_preprocess = self.meta["custom_preprocess"]
+
+        def load(filename):
+            return np.load(os.path.join(mask_dir, filename), mmap_mode="r")
+
+        self.ann_ids = load(ANN_IDS_FILENAME)
+        self.ann_masks = load(ANN_MASKS_FILENAME)
+        self.pair_image_ids = load(PAIR_IMAGE_IDS_FILENAME)
+        self.pair_category_ids = load(PAIR_CATEGORY_IDS_FILENAME)
+        self.pair_masks = load(PAIR_MASKS_FILENAME)
+
+    def _unpack(self, bits: np.ndarray) -> np.ndarray:
+        side = self.masks_side_length
+        return np.unpackbits(bits, count=side * side).reshape(side, side)
+
+    def annotation_mask(self, ann_id: int) -> np.ndarray:
+        """The resized mask of the annotation, as a (side, side) uint8 array."""
+        idx = np.searchsorted(self.ann_ids, ann_id)
+        if idx == len(self.ann_ids) or self.ann_ids[idx] != ann_id:
+            raise KeyError(ann_id)
+        return self._unpack(self.ann_masks[idx])
+
+    def pair_mask(self, image_id: int, cat_id: int) -> np.ndarray:
+        """The resized union mask of the annotations of the category in the image."""
+        start = np.searchsorted(self.pair_image_ids, image_id, side="left")
+        end = np.searchsorted(self.pair_image_ids, image_id, side="right")
+        idx = start + np.searchsorted(self.pair_category_ids[start:end], cat_id)
+        if idx == end or self.pair_category_ids[idx] != cat_id:
+            raise KeyError((image_id, cat_id))
+        return self._unpack(self.pair_masks[idx])
+
+
+def open_prompt_mask_store(mask_dir: Optional[str]) -> Optional[PromptMaskStore]:
+    if mask_dir is None:
+        return None
+    return PromptMaskStore(mask_dir)
+
+
+def _rasterize_prompt_masks(args) -> int:
+    (
+        path,
+        start,
+        segmentations,
+        masks_side_length,
+        long_side_length,
+        custom_preprocess,
+    ) = args
+    prompts_processor = PromptsProcessor(
+        long_side_length=long_side_length,
+        masks_side_length=masks_side_length,
+        custom_preprocess=custom_preprocess,
+    )
+    out = np.load(path, mmap_mode="r+")
+    for k, segmentation in enumerate(segmentations):
+        h, w = segmentation["size"]
+        mask = prompts_processor.apply_masks(
+            [prompts_processor.convert_mask(segmentation, h, w)]
+        )
+        out[start + k] = np.packbits(mask.numpy().reshape(-1))
+    out.flush()
+    return len(segmentations)
+
+
+def precompute_prompt_masks(
+    instances_path: str,
+    outfolder: str,
+    masks_side_length: int = 256,
+    long_side_length: int = 1024,
+    custom_preprocess: bool = True,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 1000,
+):
+    """Resize the mask of every (non crowd) annotation of the instances file as
+    PromptsProcessor.apply_masks does, and store them, and the union mask of every
+    (image, category) pair, in a PromptMaskStore.
+
+    Args:
+        instances_path (str): Path to the instances json file.
+        outfolder (str): Directory of the store.
+        masks_side_length (int, optional): Side of the resized masks. Defaults to 256.
+        long_side_length (int, optional): Long side of the preprocessed images. Defaults to 1024.
+        custom_preprocess (bool, optional): Whether the images are resized keeping the aspect ratio and padded. Defaults to True.
+        num_workers (Optional[int], optional): Number of processes. Defaults to the number of CPUs.
+        chunk_size (int, optional): Number of annotations (or pairs) processed at once. Defaults to 1000.
+    """
+    packed = PackedInstances.from_instances(utils.load_instances(instances_path))
+    order = np.argsort(packed.ann_ids, kind="stable")
+    n_bytes = (masks_side_length * masks_side_length + 7) // 8
+    os.makedirs(outfolder, exist_ok=True)
+
+    # per-annotation masks, written in place by the workers
+    ann_masks_path = os.path.join(outfolder, ANN_MASKS_FILENAME)
+    np.lib.format.open_memmap(
+        ann_masks_path, mode="w+", dtype=np.uint8, shape=(len(order), n_bytes)
+    ).flush()
+    tasks = (
+        (
+            ann_masks_path,
+            start,
+            [packed.segmentation(row) for row in order[start : start + chunk_size]],
+            masks_side_length,
+            long_side_length,
+            custom_preprocess,
+        )
+        for start in range(0, len(order), chunk_size)
+    )
+    with tqdm(total=len(order), desc="Resizing prompt masks") as pbar:
+        with multiprocessing.Pool(num_workers) as pool:
+            for n_masks in pool.imap_unordered(_rasterize_prompt_masks, tasks):
+                pbar.update(n_masks)
+    np.save(os.path.join(outfolder, ANN_IDS_FILENAME), packed.ann_ids[order])
+
+    # union masks of the (image, category) pairs
+    index = AnnotationIndex(packed)
+    positions = np.empty_like(order)
+    positions[order] = np.arange(len(order))
+    n_pairs = len(index.img_cats)
+    pair_images = np.repeat(
+        np.arange(len(index.image_ids)), np.diff(index.img_cat_offsets)
+    )
+    np.save(
+        os.path.join(outfolder, PAIR_IMAGE_IDS_FILENAME), index.image_ids[pair_images]
+    )
+    np.save(
+        os.path.join(outfolder, PAIR_CATEGORY_IDS_FILENAME),
+        index.category_ids[index.img_cats],
+    )
+    ann_masks = np.load(ann_masks_path, mmap_mode="r")
+    pair_masks = np.lib.format.open_memmap(
+        os.path.join(outfolder, PAIR_MASKS_FILENAME),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(n_pairs, n_bytes),
+    )
+    for start in tqdm(range(0, n_pairs, chunk_size), desc="Merging prompt masks"):
+        end = min(start + chunk_size, n_pairs)
+        offsets = index.pair_ann_offsets[start : end + 1]
+        rows = positions[index.pair_anns[offsets[0] : offsets[-1]]]
+        pair_masks[start:end] = np.bitwise_or.reduceat(
+            ann_masks[rows],
+            offsets[:-1] - offsets[0],
+            axis=0,
+        )
+    pair_masks.flush()
+
+    # the meta file is written last, it marks the store as complete
+    with open(os.path.join(outfolder, META_FILENAME), "w") as f:
+        json.dump(
+            {
+                "masks_side_length": masks_side_length,
+                "long_side_length": long_side_length,
+                "custom_preprocess": custom_preprocess,
+                "num_annotations": len(order),
+                "num_pairs": n_pairs,
+            },
+            f,
+        )
+    logger.info(
+        f"Stored {len(order)} annotation masks and {n_pairs} union masks in {outfolder}"
+    )
@@ -0,0 +1,156 @@
+import torch
+
+from label_anything.data.utils import StrEnum
+
+# per-channel scales of an int8 tensor are stored next to it, as f"{name}{SCALE_SUFFIX}"
+SCALE_SUFFIX = "_scale"
+INT8_MAX = 127
+
+
+class StoragePrecision(StrEnum):
+    FP32 = "fp32"
+    FP16 = "fp16"
+    BF16 = "bf16"
+    INT8 = "int8"
+
+
+STORAGE_DTYPES = {
+    StoragePrecision.FP32: torch.float32,
+    StoragePrecision.FP16: torch.float16,
+    StoragePrecision.BF16: torch.bfloat16,
+    StoragePrecision.INT8: torch.int8,
+}
+
+
+def is_embedding_key(name: str) -> bool:
+    """Whether name is an embedding ("embedding") or a feature pyramid stage ("stage*")
+    tensor, as opposed to scales or to ground truths stored in the same file."""
+    return (name == "embedding" or name.startswith("stage")) and not name.endswith(
+        SCALE_SUFFIX
+    )
+
+
+def quantize(
+    tensor: torch.Tensor, precision: StoragePrecision = StoragePrecision.FP32
+) -> (torch.Tensor, torch.Tensor):
+    """Convert an embedding of shape C x H x W to the storage precision.
+
+    int8 uses symmetric per-channel quantization: each channel is divided by its
+    absolute maximum over 127 and rounded.
+
+    Args:
+        tensor (torch.Tensor): The embedding, channels first.
+        precision (StoragePrecision, optional): The storage precision. Defaults to "fp32".
+
+    Returns:
+        (torch.Tensor, Optional[torch.Tensor]): The stored tensor and, for int8, the float32 scales of shape C.
+    """
+    precision = StoragePrecision(precision)
+    if precision != StoragePrecision.INT8:
+        return tensor.to(STORAGE_DTYPES[precision]), None
+    tensor = tensor.float()
+    scale = tensor.abs().flatten(1).amax(dim=1) / INT8_MAX
+    scale = scale.clamp(min=torch.finfo(torch.float32).tiny)
+    scale_view = scale.view(-1, *[1] * (tensor.dim() - 1))
+    values = torch.round(tensor / scale_view).clamp(-INT8_MAX, INT8_MAX)
+    return values.to(torch.int8), scale
+
+
+def dequantize(
+    values: torch.Tensor,
+    scale: torch.Tensor = None,
+    dtype: torch.dtype = torch.float32,
+) -> torch.Tensor:
+    """Inverse of quantize. Also works on batches, as scale only needs to match the
+    leading dimensions of values (e.g. B x M x C scales of B x M x C x H x W embeddings).
+
+    Args:
+        values (torch.Tensor): The stored tensor.
+        scale (torch.Tensor, optional): The int8 scales. Defaults to None.
+        dtype (torch.dtype, optional): The output dtype. Defaults to torch.float32.
+
+    Returns:
+        torch.Tensor: The embedding.
+    """
+    values = values.to(dtype)
+    if scale is not None:
+        values = values * scale.to(dtype).view(
+            *scale.shape, *[1] * (values.dim() - scale.dim())
+        )
+    return values
+
+
+def quantize_tensors(
+    tensors: dict[str, torch.Tensor],
+    precision: StoragePrecision = StoragePrecision.FP32,
+) -> dict[str, torch.Tensor]:
+    """Quantize the embedding tensors of a file (see is_embedding_key), adding the scales
+    of int8 tensors. Other tensors are left untouched.
+
+    Args:
+        tensors (dict[str, torch.Tensor]): The tensors of a file.
+        precision (StoragePrecision, optional): The storage precision. Defaults to "fp32".
+
+    Returns:
+        dict[str, torch.Tensor]: The tensors to store.
+    """
+    out = {}
+    for name, tensor in tensors.items():
+        if not is_embedding_key(name):
+            out[name] = tensor
+            continue
+        values, scale = quantize(tensor, precision)
+        out[name] = values.contiguous()
+        if scale is not None:
+            out[f"{name}{SCALE_SUFFIX}"] = scale
+    return out
+
+
+def dequantize_tensors(
+    tensors: dict[str, torch.Tensor], dtype: torch.dtype = torch.float32
+) -> dict[str, torch.Tensor]:
+    """Inverse of quantize_tensors, dropping the scales.
+
+    Args:
+        tensors (dict[str, torch.Tensor]): The stored tensors, of one file or collated.
+        dtype (torch.dtype, optional): The dtype of the embeddings. Defaults to torch.float32.
+
+    Returns:
+        dict[str, torch.Tensor]: The tensors, with the embeddings in dtype.
+    """
+    return {
+        name: (
+            dequantize(tensor, tensors.get(f"{name}{SCALE_SUFFIX}"), dtype)
+            if is_embedding_key(name)
+            else tensor
+        )
+        for name, tensor in tensors.items()
+        if not name.endswith(SCALE_SUFFIX)
+    }
+
+
+def dequantize_embeddings(
+    data_dict: dict, dtype: torch.dtype = torch.float32
+) -> dict:
+    """Dequantize the embeddings of a batch loaded with lazy_dequantization, in place.
+    Call it after the batch is moved to the device, so that the transfer is done at the
+    storage precision. Batches of dequantized embeddings are left as they are.
+
+    Args:
+        data_dict (dict): The batch dictionary.
+        dtype (torch.dtype, optional): The dtype of the embeddings. Defaults to torch.float32.
+
+    Returns:
+        dict: The batch dictionary, with the embeddings as the model expects them.
+    """
+    embeddings = data_dict.get("embeddings")
+    if embeddings is None:
+        return data_dict
+    if isinstance(embeddings, dict):
+        embeddings = dequantize_tensors(embeddings, dtype)
+        # a single embedding is collated as {"embedding": ...} to keep its scales
+        embeddings = embeddings.get("embedding", embeddings)
+    else:
+        embeddings = embeddings.to(dtype)
+    data_dict["embeddings"] = embeddings
+    return data_dict
@@ -0,0 +1,515 @@
+import inspect
+import json
+import math
+import multiprocessing
+import os
+import random
+import tarfile
+from io import BytesIO
+from typing import Iterator, Optional, Tuple
+
+import torch
+from PIL import Image
+from safetensors.torch import load as load_tensors
+from safetensors.torch import save as save_tensors
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+from label_anything.data.coco import CocoLVISDataset
+from label_anything.data.dataset import (
+    LabelAnythingDataset,
+    batch_metadata_at,
+    get_batch_metadata,
+)
+from label_anything.data.embedding_store import INDEX_FILENAME
+from label_anything.data.image_decoding import decode_image
+from label_anything.data.instances_cache import PackedInstances
+from label_anything.data.utils import AnnFileKeys, PromptType
+from label_anything.logger.text_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+# shards are read front to back, in large chunks
+READ_BUFFER_SIZE = 16 * 1024**2
+
+# parameters of the source dataset that do not apply to the samples of a shard
+_SOURCE_PARAMS = {
+    "name",
+    "instances_path",
+    "img_dir",
+    "emb_dir",
+    "embeddings_backend",
+    "embedding_cache_bytes",
+    "keep_embedding_cache",
+    "annotations_cache_dir",
+    "gt_dir",
+    "prompt_masks_dir",
+    "remove_small_annotations",
+}
+
+
+def shard_name(shard_idx: int) -> str:
+    return f"shard-{shard_idx:05d}.tar"
+
+
+def sample_key(image_id: int) -> str:
+    return str(image_id).zfill(12)
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0
+    tar.addfile(info, BytesIO(data))
+
+
+def _scan_shard(path: str) -> Tuple[int, dict]:
+    """Count the samples of a shard and locate its images, without reading them."""
+    keys = set()
+    images = {}
+    with tarfile.open(path, "r:") as tar:
+        for member in tar:
+            key, ext = member.name.split(".", 1)
+            keys.add(key)
+            if ext == "jpg":
+                images[key] = [member.offset_data, member.size]
+    return len(keys), images
+
+
+def read_shard(path: str) -> Iterator[dict]:
+    """Stream the samples of a shard, in order, with a single sequential read.
+
+    Args:
+        path (str): Path to the shard.
+
+    Yields:
+        dict: The sample, with its key ("__key__"), its record ("json") and, if
+            exported, the encoded image ("jpg") and the serialized tensors ("safetensors").
+    """
+    sample = None
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        with tarfile.open(fileobj=f, mode="r|") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, ext = member.name.split(".", 1)
+                if sample is not None and sample["__key__"] != key:
+                    yield sample
+                    sample = None
+                if sample is None:
+                    sample = {"__key__": key}
+                data = tar.extractfile(member).read()
+                sample[ext] = json.loads(data) if ext == "json" else data
+    if sample is not None:
+        yield sample
+
+
+# the dataset is inherited by the forked export processes instead of being pickled, so
+# they are always forked, whatever the default start method of the platform
+_exporting_dataset = None
+
+
+def _export_shard(args) -> Tuple[int, dict]:
+    path, start, stop = args
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with tarfile.open(tmp_path, "w") as tar:
+            for idx in range(start, stop):
+                sample = _exporting_dataset.export_sample(idx)
+                if not sample["json"]["annotations"]:
+                    # images without annotations are never sampled as queries
+                    continue
+                key = sample["key"]
+                _add_member(tar, f"{key}.json", json.dumps(sample["json"]).encode())
+                if sample["jpg"] is not None:
+                    _add_member(tar, f"{key}.jpg", sample["jpg"])
+                if sample["safetensors"] is not None:
+                    _add_member(
+                        tar,
+                        f"{key}.safetensors",
+                        save_tensors(
+                            {
+                                k: v.contiguous()
+                                for k, v in sample["safetensors"].items()
+                            }
+                        ),
+                    )
+        os.replace(tmp_path, path)
+    return _scan_shard(path)
+
+
+def export_shards(
+    dataset,
+    outfolder: str,
+    shard_size: int = 1000,
+    num_workers: Optional[int] = None,
+):
+    """Pack the images, embeddings, ground truths and annotations of a dataset in tar
+    shards of shard_size images, to be streamed by ShardedEpisodeDataset. Shards already
+    written are skipped, so that an interrupted export can be resumed.
+
+    The folder contains the shards (``shard-00000.tar``, ...), each holding a
+    ``{key}.json`` record (the image data and its annotations, as in a COCO instances
+    file), ``{key}.jpg`` and ``{key}.safetensors`` per image, and an ``index.json`` with
+    the categories, the number of samples of each shard and the location of the images.
+
+    Args:
+        dataset (CocoLVISDataset | PascalDataset): The dataset to export.
+        outfolder (str): Folder of the shards.
+        shard_size (int, optional): Number of images per shard. Defaults to 1000.
+        num_workers (Optional[int], optional): Number of processes. Defaults to the number of CPUs.
+    """
+    global _exporting_dataset
+
+    os.makedirs(outfolder, exist_ok=True)
+    shards = [
+        (
+            os.path.join(outfolder, shard_name(i)),
+            start,
+            min(start + shard_size, len(dataset)),
+        )
+        for i, start in enumerate(range(0, len(dataset), shard_size))
+    ]
+    _exporting_dataset = dataset
+    try:
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            scans = list(
+                tqdm(
+                    pool.imap(_export_shard, shards),
+                    total=len(shards),
+                    desc=f"Exporting {dataset.name}",
+                )
+            )
+    finally:
+        _exporting_dataset = None
+
+    index = {
+        "name": dataset.name,
+        "categories": [
+            {**category, AnnFileKeys.ID: cat_id}
+            for cat_id, category in dataset.categories.items()
+        ],
+        "remove_small_annotations": dataset.remove_small_annotations,
+        "has_images": dataset.img_dir is not None,
+        "has_embeddings": dataset.emb_dir is not None,
+        "shards": [
+            {"name": os.path.basename(path), "num_samples": num_samples}
+            for (path, _, _), (num_samples, _) in zip(shards, scans)
+        ],
+        "images": {
+            key: [shard_idx, *location]
+            for shard_idx, (_, images) in enumerate(scans)
+            for key, location in images.items()
+        },
+    }
+    tmp_path = os.path.join(outfolder, f"{INDEX_FILENAME}.tmp{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(outfolder, INDEX_FILENAME))
+    logger.info(
+        f"Exported {sum(x['num_samples'] for x in index['shards'])} images of {dataset.name} in {len(shards)} shards to {outfolder}"
+    )
+
+
+def export_shards_from_parameters(
+    param_path: str,
+    outfolder: str,
+    shard_size: int = 1000,
+    num_workers: Optional[int] = None,
+):
+    """Export the training datasets of a run from its parameters file, each to
+    ``{outfolder}/{dataset}``. Set ``streaming.shard_dir`` in the dataloader parameters
+    of the run to train on the shards.
+
+    Args:
+        param_path (str): Path to the parameters file of the run.
+        outfolder (str): Folder of the shards.
+        shard_size (int, optional): Number of images per shard. Defaults to 1000.
+        num_workers (Optional[int], optional): Number of processes. Defaults to the number of CPUs.
+    """
+    import copy
+
+    from label_anything.data import get_dataloaders
+    from label_anything.utils.utils import load_yaml
+
+    params = load_yaml(param_path)
+    dataset_params = copy.deepcopy(params["dataset"])
+    dataset_params["datasets"] = {
+        k: v
+        for k, v in dataset_params["datasets"].items()
+        if not k.startswith(("val_", "test_"))
+    }
+    dataloader_params = copy.deepcopy(params["dataloader"])
+    dataloader_params.pop("streaming", None)
+    train_loader, _, _ = get_dataloaders(dataset_params, dataloader_params, 1)
+    for name, dataset in train_loader.dataset.datasets.items():
+        export_shards(dataset, os.path.join(outfolder, name), shard_size, num_workers)
+
+
+class _SampleTensors:
+    """Embedding store over the serialized tensors of the samples of a window."""
+
+    def __init__(self, samples: dict[str, bytes]):
+        self.samples = samples
+
+    def __getitem__(self, key: str) -> dict[str, torch.Tensor]:
+        return load_tensors(self.samples[key])
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.samples
+
+
+class _ShardWindow(CocoLVISDataset):
+    """A CocoLVISDataset over the samples of a window, held in memory: queries and
+    examples are drawn from the window only."""
+
+    def __init__(
+        self,
+        samples: list[dict],
+        shard_dir: str,
+        name: str,
+        categories: list[dict],
+        has_images: bool,
+        has_embeddings: bool,
+        **dataset_params,
+    ):
+        self.samples = {
+            sample["json"]["image"][AnnFileKeys.ID]: sample for sample in samples
+        }
+        self.shard_categories = categories
+        super().__init__(
+            name=name,
+            instances_path=shard_dir,
+            img_dir=shard_dir if has_images else None,
+            emb_dir=shard_dir if has_embeddings else None,
+            **dataset_params,
+        )
+        self.embedding_store = _SampleTensors(
+            {
+                sample["__key__"]: sample["safetensors"]
+                for sample in samples
+                if "safetensors" in sample
+            }
+        )
+        # ground truths are stored with the embeddings
+        self.gt_store = None
+
+    def _load_packed_instances(
+        self, category_ids: Optional[list[int]] = None
+    ) -> PackedInstances:
+        return PackedInstances.from_instances(
+            {
+                AnnFileKeys.IMAGES: [
+                    x["json"]["image"] for x in self.samples.values()
+                ],
+                AnnFileKeys.ANNOTATIONS: [
+                    ann
+                    for x in self.samples.values()
+                    for ann in x["json"]["annotations"]
+                ],
+                AnnFileKeys.CATEGORIES: self.shard_categories,
+            },
+            category_ids=category_ids,
+        )
+
+    def _load_image(self, img_data: dict) -> Image:
+        return decode_image(
+            self.samples[img_data[AnnFileKeys.ID]]["jpg"],
+            self.preprocess if self.fast_decode else None,
+        )
+
+
+class ShardedEpisodeDataset(IterableDataset):
+    """Streams the shards written by export_shards and yields whole batches of episodes,
+    to be used with ``DataLoader(dataset, batch_size=None, collate_fn=dataset.collate_fn)``.
+
+    Shards are read sequentially, in a random order, and split among the processes and
+    their DataLoader workers. Their samples go through a shuffle buffer and are grouped
+    in windows of window_size images, kept in memory: the episodes of a window take both
+    their queries and their examples from it, as in CocoLVISDataset.
+
+    Every worker reads the same number of samples and workers with the same id draw the
+    same batch shapes on every process, so that all the processes run the same number of
+    steps, with the same shapes at each step, as with VariableBatchSampler.
+
+    Args:
+        dataset_name (str): The name of the dataset in the batches.
+        shard_dir (str): Folder of the shards.
+        possible_batch_example_nums (list): The possible batch shapes, as for VariableBatchSampler.
+        prompt_types (list[PromptType], optional): The types of prompts to use. Defaults to None (all).
+        prompt_choice_level (str, optional): "batch" or "episode". Defaults to "batch".
+        window_size (int, optional): Number of images of a window. Defaults to 512.
+        shuffle_buffer (int, optional): Number of images of the shuffle buffer. Defaults to 2048.
+        shuffle (bool, optional): Shuffle the shards and the samples. Defaults to True.
+        seed (int, optional): Seed of the shuffling, the same on all the processes. Defaults to 0.
+        num_processes (int, optional): Number of training processes. Defaults to 1.
+        process_index (Optional[int], optional): Index of this process. Defaults to the RANK environment variable.
+        pin_memory (bool, optional): Collate the batches in pinned memory. Defaults to False.
+        **dataset_params: Parameters of the episodes, as for CocoLVISDataset.
+    """
+
+    collate_fn = LabelAnythingDataset.collate_fn
+
+    def __init__(
+        self,
+        dataset_name: str,
+        shard_dir: str,
+        possible_batch_example_nums: list,
+        prompt_types: Optional[list[PromptType]] = None,
+        prompt_choice_level: str = "batch",
+        window_size: int = 512,
+        shuffle_buffer: int = 2048,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_processes: int = 1,
+        process_index: Optional[int] = None,
+        pin_memory: bool = False,
+        **dataset_params,
+    ):
+        super().__init__()
+        with open(os.path.join(shard_dir, INDEX_FILENAME), "r") as f:
+            index = json.load(f)
+        self.dataset_name = dataset_name
+        self.shard_dir = shard_dir
+        self.shards = index["shards"]
+        self.images = index["images"]
+        self.categories = {
+            dataset_name: {x[AnnFileKeys.ID]: x for x in index["categories"]}
+        }
+        self.possible_batch_example_nums = possible_batch_example_nums
+        self.prompt_types = prompt_types or [
+            PromptType.BBOX,
+            PromptType.MASK,
+            PromptType.POINT,
+        ]
+        self.prompt_choice_level = prompt_choice_level
+        self.window_size = window_size
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_processes = num_processes
+        self.process_index = (
+            int(os.environ.get("RANK", 0)) if process_index is None else process_index
+        )
+        self.pin_memory = pin_memory
+        self.epoch = 0
+
+        self.preprocess = dataset_params.get("preprocess")
+        dataset_params.setdefault("load_embeddings", index["has_embeddings"])
+        window_params = set(inspect.signature(CocoLVISDataset.__init__).parameters)
+        self.window_params = {
+            "shard_dir": shard_dir,
+            "name": index["name"],
+            "categories": index["categories"],
+            "has_images": index["has_images"],
+            "has_embeddings": index["has_embeddings"],
+            **{
+                k: v
+                for k, v in dataset_params.items()
+                if k in window_params and k not in _SOURCE_PARAMS
+            },
+        }
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        """An estimate of the number of batches of an epoch on each process, as batch
+        sizes are drawn at random."""
+        num_samples = sum(x["num_samples"] for x in self.shards) // self.num_processes
+        mean_batch_size = sum(x[0] for x in self.possible_batch_example_nums) / len(
+            self.possible_batch_example_nums
+        )
+        return math.ceil(num_samples / mean_batch_size)
+
+    def _assign_shards(self, num_workers: int) -> list[list[int]]:
+        """Split the shards of the epoch among all the workers of all the processes."""
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(f"{self.seed}-{self.epoch}").shuffle(order)
+        num_consumers = self.num_processes * num_workers
+        if len(order) < num_consumers:
+            raise ValueError(
+                f"{len(order)} shards can not be split among {num_consumers} workers, export them with a smaller shard_size."
+            )
+        return [order[i::num_consumers] for i in range(num_consumers)]
+
+    def _samples(
+        self, shards: list[int], budget: int, rng: random.Random
+    ) -> Iterator[dict]:
+        """Stream the samples of the shards through the shuffle buffer, up to budget."""
+        buffer = []
+        count = 0
+        for shard_idx in shards:
+            for sample in read_shard(
+                os.path.join(self.shard_dir, self.shards[shard_idx]["name"])
+            ):
+                if self.shuffle:
+                    if len(buffer) < self.shuffle_buffer:
+                        buffer.append(sample)
+                        continue
+                    i = rng.randrange(len(buffer))
+                    buffer[i], sample = sample, buffer[i]
+                yield sample
+                count += 1
+                if count == budget:
+                    return
+        rng.shuffle(buffer)
+        yield from buffer[: budget - count]
+
+    def _window_batches(self, window: list[dict], rng: random.Random) -> Iterator[list]:
+        dataset = _ShardWindow(window, **self.window_params)
+        batch_sizes, batch_metadata = get_batch_metadata(
+            len(dataset),
+            self.possible_batch_example_nums,
+            self.prompt_types,
+            self.prompt_choice_level,
+            rng=rng,
+        )
+        start = 0
+        for i, batch_size in enumerate(batch_sizes):
+            metadata = batch_metadata_at(batch_metadata, i, self.prompt_choice_level)
+            yield [
+                (dataset[(idx, metadata)], self.dataset_name)
+                for idx in range(start, start + batch_size)
+            ]
+            start += batch_size
+
+    def __iter__(self) -> Iterator[list]:
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        assignments = self._assign_shards(num_workers)
+        # every worker stops at the same number of samples
+        budget = min(
+            sum(self.shards[i]["num_samples"] for i in shards) for shards in assignments
+        )
+        consumer = self.process_index * num_workers + worker_id
+        sample_rng = random.Random(f"{self.seed}-{self.epoch}-{consumer}")
+        shape_rng = random.Random(f"{self.seed}-{self.epoch}-worker{worker_id}")
+
+        window = []
+        for sample in self._samples(assignments[consumer], budget, sample_rng):
+            window.append(sample)
+            if len(window) == self.window_size:
+                yield from self._window_batches(window, shape_rng)
+                window = []
+        if window:
+            yield from self._window_batches(window, shape_rng)
+
+    def load_and_preprocess_images(
+        self, dataset_name: str, image_ids: list[int]
+    ) -> list[torch.Tensor]:
+        """Read images from the shards, for logging."""
+        images = []
+        for image_id in image_ids:
+            shard_idx, offset, size = self.images[sample_key(image_id)]
+            with open(
+                os.path.join(self.shard_dir, self.shards[shard_idx]["name"]), "rb"
+            ) as f:
+                f.seek(offset)
+                image = decode_image(f.read(size))
+            images.append(image if not self.preprocess else self.preprocess(image))
+        return images
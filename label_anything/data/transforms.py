@@ -65,6 +65,42 @@ class Denormalize(object):
         return sample
 
 
+def rle_counts(counts) -> np.ndarray:
+    """Decode the run lengths of a compressed COCO RLE string (see rleFrString in the
+    COCO API).
+
+    Args:
+        counts (str | bytes): compressed counts of the RLE
+
+    Returns:
+        np.ndarray: run lengths, alternating between background and foreground.
+    """
+    if isinstance(counts, str):
+        counts = counts.encode("ascii")
+    runs = []
+    p = 0
+    while p < len(counts):
+        x, k, more = 0, 0, 1
+        while more:
+            c = counts[p] - 48
+            x |= (c & 0x1F) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(runs) > 2:
+            x += runs[-2]
+        runs.append(x)
+    return np.array(runs, dtype=np.int64)
+
+
+def runs_to_positions(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Expand runs (start, length) to the positions they cover."""
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
 class PromptsProcessor:
     def __init__(self, long_side_length: int = 1024, masks_side_length: int = 256, custom_preprocess=True):
         self.long_side_length = long_side_length
@@ -156,6 +192,57 @@ class PromptsProcessor:
         row, col = positive_coords[np.random.choice(len(positive_coords))]
         return col, row
 
+    def rle_runs(self, mask, h, w) -> (np.ndarray, np.ndarray):
+        """Foreground runs of an annotation in the column-major flattened mask, without
+        decoding the full mask. Empty masks get the same pixel as convert_mask.
+
+        Args:
+            mask: mask can be polygons, uncompressed RLE, or RLE
+            h (int): image height
+            w (int): image width
+
+        Returns:
+            (np.ndarray, np.ndarray): start positions and lengths of the foreground runs.
+        """
+        if isinstance(mask, dict) and isinstance(mask["counts"], list):
+            # uncompressed RLE, the runs are already there
+            counts = np.asarray(mask["counts"], dtype=np.int64)
+        else:
+            counts = rle_counts(self.__ann_to_rle(mask, h, w)["counts"])
+        # runs alternate between background and foreground, starting with background
+        run_starts = np.cumsum(counts) - counts
+        fg_starts, fg_lengths = run_starts[1::2], counts[1::2]
+        if fg_lengths.sum() == 0:
+            # empty mask, same fallback as convert_mask
+            if isinstance(mask, list):
+                x = min(max(int(mask[0][0]), 0), w - 1)
+                y = min(max(int(mask[0][1]), 0), h - 1)
+            else:
+                x, y = 0, 0
+            return np.array([x * h + y], dtype=np.int64), np.ones(1, dtype=np.int64)
+        return fg_starts, fg_lengths
+
+    def sample_points(self, mask, h, w, num_points: int = 1) -> np.ndarray:
+        """Sample num_points points uniformly (with replacement) from an annotation, straight
+        from its RLE runs, without decoding the full mask.
+
+        Args:
+            mask: mask can be polygons, uncompressed RLE, or RLE
+            h (int): image height
+            w (int): image width
+            num_points (int): number of points to sample
+
+        Returns:
+            np.ndarray: (num_points, 2) array of (x, y) coordinates, as sample_point.
+        """
+        fg_starts, fg_lengths = self.rle_runs(mask, h, w)
+        fg_ends = np.cumsum(fg_lengths)
+        offsets = np.random.randint(0, fg_ends[-1], size=num_points)
+        runs = np.searchsorted(fg_ends, offsets, side="right")
+        # position in the column-major flattened mask
+        positions = fg_starts[runs] + offsets - (fg_ends[runs] - fg_lengths[runs])
+        return np.stack([positions // h, positions % h], axis=1)
+
     def apply_coords(
         self, coords: np.ndarray, original_size: Tuple[int, ...]
     ) -> np.ndarray:
@@ -55,6 +55,7 @@ class BatchKeys(StrEnum):
     IMAGE_IDS = "image_ids"
     GROUND_TRUTHS = "ground_truths"
     CLIP_EMBEDDINGS = "clip_embeddings"
+    TARGET_SIZE = "target_size"
     
     
 class BatchMetadataKeys(StrEnum):
@@ -62,6 +63,7 @@ class BatchMetadataKeys(StrEnum):
     NUM_EXAMPLES = "num_examples"
     NUM_CLASSES = "num_classes"
     PROMPT_CHOICE_LEVEL = "prompt_choice_level"
+    EPISODE = "episode"
     
     
 def flags_merge(flag_masks: torch.Tensor = None, flag_points: torch.Tensor = None, flag_bboxes: torch.Tensor = None) -> torch.Tensor:
@@ -244,6 +246,33 @@ def annotations_to_tensor(
     return tensor, flag
 
 
+def resized_masks_to_tensor(
+    masks: list, masks_side_length: int = 256
+) -> (torch.Tensor, torch.Tensor):
+    """Convert a list of mask annotations, already resized by PromptsProcessor.apply_masks
+    (see PromptMaskStore), to a tensor, as annotations_to_tensor does for PromptType.MASK.
+
+    Args:
+        masks (list): A list of dicts mapping category ids to arrays of resized masks.
+        masks_side_length (int, optional): The side of the resized masks. Defaults to 256.
+
+    Returns:
+        (torch.Tensor, torch.Tensor): The tensor containing the masks and their flags.
+    """
+    n = len(masks)
+    c = len(masks[0])
+    tensor = torch.zeros((n, c, masks_side_length, masks_side_length))
+    flag = torch.zeros((n, c), dtype=torch.uint8)
+    for i, annotation in enumerate(masks):
+        for j, cat_id in enumerate(annotation):
+            if len(annotation[cat_id]) == 0:
+                continue
+            mask = torch.as_tensor(annotation[cat_id]).amax(dim=0)
+            tensor[i, j] = mask
+            flag[i, j] = 1 if mask.any() else 0
+    return tensor, flag
+
+
 def collate_gt(
     tensor: torch.Tensor, original_classes: Dict[int, int], new_classes: Dict[int, int]
 ) -> torch.Tensor:
@@ -384,14 +413,74 @@ def collate_example_flags(example_flags: torch.Tensor, num_classes: int) -> torc
     return out
 
 
+def pad_and_stack(
+    tensors: List[torch.Tensor],
+    shape: Tuple[int, ...] = None,
+    fill_value=0,
+    dtype: torch.dtype = None,
+    pin_memory: bool = False,
+) -> torch.Tensor:
+    """
+    Stacks tensors with the same number of dimensions, padding each of them at the end of every dimension, with a
+    single allocation of the output buffer.
+
+    Arguments:
+        tensors: list of tensors to stack.
+        shape: shape of each padded tensor, defaults to the largest size of every dimension.
+        fill_value: value of the padding.
+        dtype: dtype of the output, defaults to the dtype of the first tensor.
+        pin_memory: whether to allocate the output in pinned memory.
+
+    Returns:
+        torch.Tensor: tensor of shape len(tensors) x *shape.
+    """
+    if shape is None:
+        shape = torch.tensor([x.shape for x in tensors]).amax(dim=0).tolist()
+    shape = (len(tensors), *shape)
+    dtype = dtype or tensors[0].dtype
+    if all(x.shape == shape[1:] for x in tensors):
+        # every slot is overwritten, no padding to fill
+        out = torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+    else:
+        out = torch.full(shape, fill_value, dtype=dtype, pin_memory=pin_memory)
+    for i, x in enumerate(tensors):
+        out[(i, *(slice(0, d) for d in x.shape))] = x
+    return out
+
+
 def collate_gts(gt, dims):
-    """Collate ground truths for a single sample (query + support)."""
-    out = torch.zeros(dims)
+    """Collate ground truths for a single sample (query + support).
+
+    The ground truths keep their dtype (e.g. the compact label maps of
+    compute_ground_truths); the batch collate converts them to the training dtype.
+    """
+    out = torch.zeros(dims, dtype=gt.dtype)
     dim0, dim1 = gt.size()
     out[:dim0, :dim1] = gt
     return out
 
 
+def resize_gt(gt, target_size, custom_preprocess=True, fill_value=-100):
+    """Resize a ground truth to the (padded) input frame of the model, at target_size.
+
+    As for the images, the long side is resized to target_size and the rest of the frame
+    is padded (with fill_value, ignored by the losses and the metrics); without custom
+    preprocessing the whole frame is resized. Nearest neighbour keeps the labels valid.
+    """
+    h, w = gt.size()
+    if custom_preprocess:
+        new_h, new_w = get_preprocess_shape(h, w, target_size)
+    else:
+        new_h, new_w = target_size, target_size
+    # integer label maps stay integer, widened to a signed dtype for the fill_value
+    dtype = torch.int16 if gt.dtype == torch.uint8 else gt.dtype
+    out = torch.full((target_size, target_size), fill_value, dtype=dtype)
+    out[:new_h, :new_w] = torch.nn.functional.interpolate(
+        gt[None, None].float(), (new_h, new_w), mode="nearest"
+    )[0, 0]
+    return out
+
+
 def collate_batch_gts(gt, dims, fill_value=-100):
     """Collate ground truths for a batch of samples, here the fill_value must be -100."""
     out = torch.full(size=(gt.size(0), *dims), fill_value=fill_value, dtype=torch.long)
@@ -376,6 +376,98 @@ def validate(param_path: str = "parameters.yaml"):
         single_run.validate(epoch=epoch)
     
     
+def quantization_report(
+    param_path: str = "parameters.yaml",
+    outfolder: str = "data/processed/quantized",
+    precisions: tuple[str] = ("fp16", "bf16", "int8"),
+):
+    """Validate the model of a validation parameters file (as for validate) with its
+    embeddings stored at each precision, to measure the mIoU lost by quantization.
+
+    The embeddings of the validation datasets are converted once to
+    {outfolder}/{precision}/{dataset}, so a small validation split keeps this cheap.
+
+    Args:
+        param_path (str, optional): Path to the validation parameters file. Defaults to "parameters.yaml".
+        outfolder (str, optional): Directory of the converted embeddings and of the report. Defaults to "data/processed/quantized".
+        precisions (tuple[str], optional): Precisions to compare with fp32. Defaults to ("fp16", "bf16", "int8").
+
+    Returns:
+        list[dict]: For each precision, the validation metrics and the size of the embeddings.
+    """
+    import json
+
+    import torch
+
+    from label_anything.preprocess import quantize_embeddings
+
+    settings = load_yaml(param_path)
+    logger.info(f"Loaded parameters from {param_path}")
+    val_datasets = {
+        k: v for k, v in settings["dataset"]["datasets"].items() if k.startswith("val_")
+    }
+    for name, dataset_params in val_datasets.items():
+        if dataset_params.get("embeddings_backend", "safetensors") != "safetensors":
+            raise ValueError(
+                f"{name} must use per-image safetensors embeddings, pack them after quantizing."
+            )
+
+    def embeddings_size(emb_dir):
+        filenames = [f for f in os.listdir(emb_dir) if f.endswith(".safetensors")]
+        total = sum(os.path.getsize(os.path.join(emb_dir, f)) for f in filenames)
+        return total / max(len(filenames), 1)
+
+    report = []
+    for precision in ["fp32", *precisions]:
+        params = copy.deepcopy(settings)
+        sizes = []
+        for name, dataset_params in val_datasets.items():
+            emb_dir = dataset_params["emb_dir"]
+            if precision != "fp32":
+                emb_dir = os.path.join(outfolder, precision, name)
+                if not os.path.exists(emb_dir):
+                    # converted to a temporary directory, so that an interrupted run
+                    # does not leave a partial one
+                    quantize_embeddings(
+                        dataset_params["emb_dir"], f"{emb_dir}.tmp", precision
+                    )
+                    os.replace(f"{emb_dir}.tmp", emb_dir)
+                params["dataset"]["datasets"][name]["emb_dir"] = emb_dir
+            sizes.append(embeddings_size(emb_dir))
+
+        single_run = Run()
+        single_run.init(params)
+        with single_run.tracker.validate():
+            metrics = single_run.validate(epoch=0)
+        single_run.end()
+        report.append(
+            {
+                "precision": precision,
+                **{k: float(v) for k, v in metrics.items()},
+                "bytes_per_image": sum(sizes) / len(sizes),
+            }
+        )
+        del single_run
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    baseline = report[0]
+    lines = [
+        "| precision | mIoU | delta mIoU | FBIoU | KiB per image |",
+        "|---|---|---|---|---|",
+    ]
+    for x in report:
+        lines.append(
+            f"| {x['precision']} | {x['miou']:.4f} | {x['miou'] - baseline['miou']:+.4f} "
+            f"| {x['fbiou']:.4f} | {x['bytes_per_image'] / 1024:.1f} |"
+        )
+    logger.info("Embedding quantization report:\n" + "\n".join(lines))
+    os.makedirs(outfolder, exist_ok=True)
+    with open(os.path.join(outfolder, "quantization_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
 def test(param_path: str = "parameters.yaml"):
     logger.info("Running run")
     settings = load_yaml(param_path)
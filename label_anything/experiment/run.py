@@ -12,12 +12,14 @@ from copy import deepcopy
 import numpy as np
 import torch
 from accelerate import Accelerator, DistributedDataParallelKwargs
-from accelerate.utils import set_seed
+from accelerate.utils import send_to_device, set_seed
 from torch.optim import AdamW
+from torch.utils.data import IterableDataset
 from torchmetrics import F1Score, MetricCollection
 from tqdm import tqdm
 
 from label_anything.data import get_dataloaders
+from label_anything.data.quantization import dequantize_embeddings
 from label_anything.data.utils import BatchKeys, to_global_multiclass
 from label_anything.experiment.substitution import Substitutor
 from label_anything.experiment.utils import WrapperModule
@@ -193,9 +195,19 @@ class Run:
                 * len(self.train_loader),
             )
 
-        self.train_loader, self.optimizer, self.scheduler = self.accelerator.prepare(
-            self.train_loader, self.optimizer, self.scheduler
-        )
+        if isinstance(self.train_loader.dataset, IterableDataset):
+            # every process streams its own shards, accelerate would instead dispatch
+            # the batches of the main process: batches are moved to the device in
+            # train_epoch
+            self.optimizer, self.scheduler = self.accelerator.prepare(
+                self.optimizer, self.scheduler
+            )
+        else:
+            self.train_loader, self.optimizer, self.scheduler = (
+                self.accelerator.prepare(
+                    self.train_loader, self.optimizer, self.scheduler
+                )
+            )
 
     def _prep_for_validation(self):
         self.val_loaders = {
@@ -430,9 +442,7 @@ class Run:
             )
 
         # prepare metrics
-        dataset_categories = next(
-            iter(self.train_loader.dataset.datasets.values())
-        ).categories
+        dataset_categories = next(iter(self.train_loader.dataset.categories.values()))
         num_classes = len(dataset_categories)
         metrics = MetricCollection(
             {
@@ -463,6 +473,16 @@ class Run:
         )
         # allocate_memory(model, accelerator, optimizer, criterion, dataloader)
 
+        streaming = isinstance(self.train_loader.dataset, IterableDataset)
+        if streaming:
+            self.train_loader.dataset.set_epoch(epoch)
+        else:
+            # the batches (or the episode plan) of the epoch, and the epoch of the
+            # dataset; accelerate wraps the sampler in a BatchSamplerShard
+            batch_sampler = self.train_loader.batch_sampler
+            batch_sampler = getattr(batch_sampler, "batch_sampler", batch_sampler)
+            batch_sampler.set_epoch(epoch)
+
         # tqdm stuff
         bar = tqdm(
             enumerate(self.train_loader),
@@ -487,6 +507,9 @@ class Run:
 
         for batch_idx, batch_tuple in bar:
             batch_tuple, dataset_names = batch_tuple
+            if streaming:
+                batch_tuple = send_to_device(batch_tuple, self.accelerator.device)
+            dequantize_embeddings(batch_tuple[0])
             cur_batch_size = get_batch_size(batch_tuple)
             loss_normalizer = (
                 batch_tuple[1].shape[1] + 1
@@ -673,6 +696,7 @@ class Run:
         with torch.no_grad():
             for batch_idx, batch_tuple in bar:
                 batch_dict, dataset_names = batch_tuple
+                dequantize_embeddings(batch_dict[0])
                 substitutor.reset(batch=batch_dict)
                 batch_dict = next(iter(substitutor))
                 cur_batch_size = get_batch_size(batch_dict)
@@ -829,8 +853,28 @@ class Run:
                 logger.info(f"Test - {k}: {v}")
             self.tracker.add_image_sequence(dataset_name)
 
+    def _release_embedding_caches(self):
+        # the node-level caches of embeddings are removed by one process per node, once
+        # every rank is done with them
+        self.accelerator.wait_for_everyone()
+        if not self.accelerator.is_local_main_process:
+            return
+        loaders = [
+            self.train_loader,
+            *(self.val_loaders or {}).values(),
+            *(self.test_loaders or {}).values(),
+        ]
+        for loader in loaders:
+            dataset = getattr(loader, "dataset", None)
+            datasets = getattr(dataset, "datasets", None)
+            for d in datasets.values() if isinstance(datasets, dict) else [dataset]:
+                store = getattr(d, "embedding_store", None)
+                if hasattr(store, "release"):
+                    store.release()
+
     def end(self):
         logger.info("Ending run")
+        self._release_embedding_caches()
         self.tracker.end()
         logger.info("Run ended")
 
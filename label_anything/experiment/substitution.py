@@ -51,13 +51,14 @@ def generate_points_from_errors(
     classes, counts = torch.unique(
         coords[:, 0:2], dim=0, return_counts=True, sorted=True
     )
-    sampled_idxs = torch.cat(
-        [torch.randint(0, x, (num_points,), device=device) for x in counts]
-    ) + torch.cat([torch.tensor([0], device=device), counts.cumsum(dim=0)])[
-        :-1
-    ].repeat_interleave(
-        num_points
-    )
+    # draw num_points error pixels for every (batch, class) pair at once
+    repeated_counts = counts.repeat_interleave(num_points)
+    sampled_idxs = (
+        torch.rand(len(repeated_counts), device=device) * repeated_counts
+    ).long()
+    sampled_idxs = torch.minimum(sampled_idxs, repeated_counts - 1) + (
+        counts.cumsum(dim=0) - counts
+    ).repeat_interleave(num_points)
     sampled_points = coords[sampled_idxs]
     labels = errors[
         sampled_points[:, 0],
@@ -166,12 +167,21 @@ class Substitutor:
             sampled_points, labels = generate_points_from_errors(
                 prediction, ground_truth, self.num_points
             )
-            sampled_points = torch.stack(
-                [
-                    self.prompt_processor.torch_apply_coords(elem, dim[0])
-                    for dim, elem in zip(self.batch[BatchKeys.DIMS], sampled_points)
-                ]
-            )
+            if BatchKeys.TARGET_SIZE in self.batch:
+                # the errors are in the padded model input frame, at target_size
+                sampled_points = sampled_points * (
+                    self.prompt_processor.long_side_length
+                    / self.batch[BatchKeys.TARGET_SIZE]
+                )
+            else:
+                sampled_points = torch.stack(
+                    [
+                        self.prompt_processor.torch_apply_coords(elem, dim[0])
+                        for dim, elem in zip(
+                            self.batch[BatchKeys.DIMS], sampled_points
+                        )
+                    ]
+                )
             sampled_points = rearrange(sampled_points, "b c n xy -> b 1 c n xy")
             padding_points = torch.zeros(
                 sampled_points.shape[0],
@@ -10,7 +10,7 @@ import torch.nn as nn
 from huggingface_hub import PyTorchModelHubMixin
 from transformers.configuration_utils import PretrainedConfig
 
-from label_anything.models.common import LayerNorm2d
+from label_anything.models.common import LayerNorm2d, set_masked_attention
 from label_anything.models.common import SAM_EMBED_DIM
 from label_anything.models.hfhub import has_config
 from label_anything.models.lam import MultiLevelLam
@@ -120,11 +120,16 @@ def _build_lam(
     class_encoder=None,
     segment_example_logits=False,
     dropout: float = 0.0,
+    attention_backend="eager",  # "eager" or "sdpa"
+    class_batched_affinity=False,
+    sparse_prompt_pairs=False,
+    masked_attention=False,
     binary=False,
     custom_preprocess=True,
     is_pyramids=False,
     intermediate_channel_sizes=None,
 ):
+    _check_sparse_prompt_pairs(sparse_prompt_pairs, masked_attention)
 
     image_embedding_size = image_size // vit_patch_size
 
@@ -181,6 +186,8 @@ def _build_lam(
             example_class_attention=example_class_attention,
             class_embedding_dim=class_embedding_dim,
             dropout=dropout,
+            attention_backend=attention_backend,
+            sparse_pairs=sparse_prompt_pairs,
             use_support_features=use_support_features_in_prompt_encoder,
             transformer=TwoWayTransformer(
                 depth=2,
@@ -189,6 +196,7 @@ def _build_lam(
                 attention_downsample_rate=encoder_attention_downsample_rate,
                 num_heads=8,
                 dropout=dropout,
+                attention_backend=attention_backend,
             ),
             class_encoder=class_encoder,
         ),
@@ -204,9 +212,12 @@ def _build_lam(
             few_type=few_type,
             class_fusion=class_fusion,
             transformer_keys_are_images=transformer_keys_are_images,
+            attention_backend=attention_backend,
+            class_batched_affinity=class_batched_affinity,
         ),
         custom_preprocess=custom_preprocess,
     )
+    set_masked_attention(lam, masked_attention)
     lam.eval()
     if checkpoint is not None:
         state_dict = torch_dict_load(checkpoint)
@@ -218,6 +229,12 @@ def _build_lam(
     return lam
 
 
+def _check_sparse_prompt_pairs(sparse_prompt_pairs, masked_attention):
+    # padded pairs are zeros with sparse_prompt_pairs, so they must not be attended
+    if sparse_prompt_pairs and not masked_attention:
+        raise ValueError("sparse_prompt_pairs requires masked_attention.")
+
+
 def build_mask_decoder(
     embed_dim,
     decoder_attention_downsample_rate,
@@ -232,6 +249,8 @@ def build_mask_decoder(
     class_fusion="sum",
     prototype_merge=False,
     transformer_keys_are_images=True,
+    attention_backend="eager",
+    class_batched_affinity=False,
 ):
     if few_type == "Prototype":
         fusion_transformer = globals()[fusion_transformer](
@@ -241,6 +260,7 @@ def build_mask_decoder(
             num_heads=8,
             attention_downsample_rate=decoder_attention_downsample_rate,
             dropout=dropout,
+            attention_backend=attention_backend,
         )
 
         decoder = MaskDecoderLam(
@@ -260,6 +280,7 @@ def build_mask_decoder(
             num_heads=8,
             attention_downsample_rate=decoder_attention_downsample_rate,
             dropout=dropout,
+            attention_backend=attention_backend,
         )
         decoder = AffinityDecoder(
             transformer_dim=embed_dim,
@@ -270,6 +291,8 @@ def build_mask_decoder(
             class_fusion=class_fusion,
             prototype_merge=few_type == "PrototypeAffinity",
             transformer_keys_are_images=transformer_keys_are_images,
+            attention_backend=attention_backend,
+            class_batched=class_batched_affinity,
         )
     else:
         raise NotImplementedError(f"few_type {few_type} not implemented")
@@ -299,8 +322,13 @@ def build_multilevel_lam(
     class_encoder=None,
     segment_example_logits=False,
     dropout: float = 0.0,
+    attention_backend="eager",  # "eager" or "sdpa"
+    class_batched_affinity=False,
+    sparse_prompt_pairs=False,
+    masked_attention=False,
     binary=False,
 ):
+    _check_sparse_prompt_pairs(sparse_prompt_pairs, masked_attention)
     encoder = build_encoder(encoder)
     hidden_sizes = encoder.config.hidden_sizes
 
@@ -329,6 +357,8 @@ def build_multilevel_lam(
                 example_class_attention=example_class_attention,
                 class_embedding_dim=class_embedding_dim,
                 dropout=dropout,
+                attention_backend=attention_backend,
+                sparse_pairs=sparse_prompt_pairs,
                 use_support_features=use_support_features_in_prompt_encoder,
                 transformer=TwoWayTransformer(
                     depth=2,
@@ -337,6 +367,7 @@ def build_multilevel_lam(
                     attention_downsample_rate=encoder_attention_downsample_rate,
                     num_heads=8,
                     dropout=dropout,
+                    attention_backend=attention_backend,
                 ),
                 class_encoder=class_encoders[i],
             )
@@ -359,6 +390,8 @@ def build_multilevel_lam(
                 few_type=few_type,
                 class_fusion=class_fusion,
                 transformer_keys_are_images=transformer_keys_are_images,
+                attention_backend=attention_backend,
+                class_batched_affinity=class_batched_affinity,
             )
             for embed_dim in hidden_sizes
         ]
@@ -375,6 +408,7 @@ def build_multilevel_lam(
         mask_decoder=mask_decoder,
         neck=None,
     )
+    set_masked_attention(lam, masked_attention)
     return lam
 
 
@@ -407,6 +441,10 @@ class LabelAnythingConfig(PretrainedConfig):
         class_encoder=None,
         segment_example_logits=False,
         dropout: float = 0.0,
+        attention_backend="eager",  # "eager" or "sdpa"
+        class_batched_affinity=False,
+        sparse_prompt_pairs=False,
+        masked_attention=False,
         binary=False,
         custom_preprocess=True,
     ):
@@ -439,6 +477,10 @@ class LabelAnythingConfig(PretrainedConfig):
         self.class_encoder = class_encoder
         self.segment_example_logits = segment_example_logits
         self.dropout = dropout
+        self.attention_backend = attention_backend
+        self.class_batched_affinity = class_batched_affinity
+        self.sparse_prompt_pairs = sparse_prompt_pairs
+        self.masked_attention = masked_attention
         self.binary = binary
         self.custom_preprocess = custom_preprocess
 
@@ -473,6 +515,10 @@ class LabelAnything(nn.Module, PyTorchModelHubMixin):
         class_encoder=None,
         segment_example_logits=False,
         dropout: float = 0.0,
+        attention_backend="eager",  # "eager" or "sdpa"
+        class_batched_affinity=False,
+        sparse_prompt_pairs=False,
+        masked_attention=False,
         binary=False,
         custom_preprocess=True,
     ):
@@ -6,16 +6,23 @@
 # LICENSE file in the root directory of this source tree.
 
 import math
-from einops import repeat
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from typing import Type
+from typing import Optional, Type
+
+from label_anything.data.utils import StrEnum
 
 
 SAM_EMBED_DIM = 256
 
 
+class AttentionBackend(StrEnum):
+    EAGER = "eager"  # explicit scores, softmax and product with the values
+    SDPA = "sdpa"  # torch.nn.functional.scaled_dot_product_attention
+
+
 class MLPBlock(nn.Module):
     def __init__(
         self,
@@ -54,10 +61,39 @@ class LayerNorm2d(nn.Module):
         return x
 
 
+def masked_scores(
+    key_mask: Optional[torch.Tensor] = None, attn_mask: Optional[torch.Tensor] = None
+) -> Optional[torch.Tensor]:
+    """
+    Combines the key mask and the attention mask of Attention into the mask of
+    the scores to drop (true), broadcastable to
+    B x N_heads x N_queries x N_keys without expanding them. Queries that can
+    not attend any key attend all of them instead, so that softmax gives no
+    NaNs: their outputs are padding.
+    """
+    mask = None
+    if key_mask is not None:
+        mask = key_mask.logical_not()[:, None, None, :]
+    if attn_mask is not None:
+        attn_mask = attn_mask.logical_not()
+        mask = attn_mask if mask is None else mask.logical_or(attn_mask)
+    if mask is None:
+        return None
+    return mask.logical_and(mask.all(dim=-1, keepdim=True).logical_not())
+
+
 class Attention(nn.Module):
     """
     An attention layer that allows for downscaling the size of the embedding
     after projection to queries, keys, and values.
+
+    With the "sdpa" backend, attention goes through the fused
+    scaled_dot_product_attention kernels of PyTorch (flash or memory efficient
+    attention when available), which do not keep the full score matrix in memory.
+
+    Masks are only applied with masked_attention. Without it, key_mask and
+    attn_mask are ignored, as in the checkpoints trained before masking was
+    fixed, so that their outputs do not change.
     """
 
     def __init__(
@@ -66,11 +102,16 @@ class Attention(nn.Module):
         num_heads: int,
         downsample_rate: int = 1,
         dropout: float = 0.0,
+        backend: str = AttentionBackend.EAGER,
+        masked_attention: bool = False,
     ) -> None:
         super().__init__()
         self.embedding_dim = embedding_dim
         self.internal_dim = embedding_dim // downsample_rate
         self.num_heads = num_heads
+        self.backend = AttentionBackend(backend)
+        self.masked_attention = masked_attention
+        self.dropout = dropout
         if dropout > 0.0:
             self.drop = nn.Dropout(dropout)
         else:
@@ -99,11 +140,24 @@ class Attention(nn.Module):
         q: torch.Tensor,
         k: torch.Tensor,
         v: torch.Tensor,
-        key_mask=None,
-        attn_mask=None,
+        key_mask: Optional[torch.Tensor] = None,
+        attn_mask: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
-        bsz, src_len, _ = q.shape
-        
+        """
+        Args:
+          q (torch.Tensor): the queries, B x N_queries x C
+          k (torch.Tensor): the keys, B x N_keys x C
+          v (torch.Tensor): the values, B x N_keys x C
+          key_mask (torch.Tensor, optional): B x N_keys, true for the keys
+            that can be attended
+          attn_mask (torch.Tensor, optional): true where a query can attend a
+            key, broadcastable to B x N_heads x N_queries x N_keys (e.g.
+            B x 1 x 1 x N_keys), so that it can be shared by all the heads
+            and layers without being expanded
+
+        Returns:
+          torch.Tensor: the attention output, B x N_queries x C
+        """
         # Input projections
         q = self.q_proj(q)
         k = self.k_proj(k)
@@ -117,26 +171,31 @@ class Attention(nn.Module):
         # Masks
         _, _, _, c_per_head = q.shape
         score_mask = None
-        if key_mask is not None:
-            key_mask = repeat(key_mask, 'b n -> b h s n', h=self.num_heads, s=src_len)
-            score_mask = torch.zeros_like(
-                key_mask, device=key_mask.device, dtype=torch.bool
-            )
-        if attn_mask is not None:
-            # Put 0 in attn_mask where is 1 and -inf where is 0
-            mask = torch.zeros_like(
-                attn_mask, device=attn_mask.device, dtype=torch.bool
+        if self.masked_attention:
+            score_mask = masked_scores(key_mask, attn_mask)
+
+        if self.backend == AttentionBackend.SDPA:
+            # masked scores are set to -inf by an equivalent additive mask
+            additive_mask = None
+            if score_mask is not None:
+                additive_mask = torch.zeros(
+                    score_mask.shape, dtype=q.dtype, device=q.device
+                ).masked_fill(score_mask, float("-inf"))
+            out = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=additive_mask,
+                dropout_p=self.dropout if self.training else 0.0,
             )
-            if score_mask is None:
-                score_mask = mask
-            else:
-                score_mask = score_mask.bitwise_or(mask).logical_not()
-            
+            out = self._recombine_heads(out)
+            return self.out_proj(out)
+
         # Attention
         attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
         attn = attn / math.sqrt(c_per_head)
         if score_mask is not None:
-            attn[score_mask] = float("-inf")
+            attn = attn.masked_fill(score_mask, float("-inf"))
         attn = torch.softmax(attn, dim=-1)
         attn = self.drop(attn)
 
@@ -147,6 +206,67 @@ class Attention(nn.Module):
 
         return out
 
+    def forward_class_batched(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        key_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Attention of the queries of several classes, with keys shared by all the
+        classes, which are projected once and never replicated per class. Scores
+        are computed explicitly, whatever the backend.
+
+        Args:
+          q (torch.Tensor): the queries, B x C x N_queries x C_in, or
+            B x 1 x N_queries x C_in if they are the same for all the classes
+          k (torch.Tensor): the keys, B x N_keys x C_in if shared by all the
+            classes, B x C x N_keys x C_in otherwise
+          v (torch.Tensor): the values, B x C x N_keys x C_in
+          key_mask (torch.Tensor, optional): B x C x N_keys, true for the keys
+            that can be attended by the queries of each class
+
+        Returns:
+          torch.Tensor: the attention output, B x C x N_queries x C_in
+        """
+        q = self.q_proj(q)
+        k = self.k_proj(k)
+        v = self.v_proj(v)
+
+        # B x N_heads x C x N_tokens x C_per_head, keys without the class dimension
+        b, c, n, _ = q.shape
+        q = q.reshape(b, c, n, self.num_heads, -1).permute(0, 3, 1, 2, 4)
+        k = k.unflatten(-1, (self.num_heads, -1)).movedim(-2, 1)
+        v = v.unflatten(-1, (self.num_heads, -1)).movedim(-2, 1)
+        c_per_head = q.shape[-1]
+
+        if k.dim() == 4:
+            # classes are folded in the queries, so that the keys are not expanded
+            attn = (q.flatten(2, 3) @ k.transpose(-1, -2)).unflatten(2, (c, n))
+        else:
+            attn = q @ k.transpose(-1, -2)
+        attn = attn / math.sqrt(c_per_head)
+        if key_mask is not None and self.masked_attention:
+            score_mask = masked_scores(attn_mask=key_mask[:, None, :, None, :])
+            attn = attn.masked_fill(score_mask, float("-inf"))
+        attn = torch.softmax(attn, dim=-1)
+        attn = self.drop(attn)
+
+        out = attn @ v  # B x N_heads x C x N_queries x C_per_head
+        out = out.permute(0, 2, 3, 1, 4).flatten(3)
+        return self.out_proj(out)
+
+
+def set_masked_attention(module: nn.Module, masked_attention: bool) -> nn.Module:
+    """
+    Sets whether the Attention layers of a module apply their masks, see Attention.
+    """
+    for submodule in module.modules():
+        if isinstance(submodule, Attention):
+            submodule.masked_attention = masked_attention
+    return module
+
 
 class AttentionMLPBlock(nn.Module):
     def __init__(
@@ -157,6 +277,7 @@ class AttentionMLPBlock(nn.Module):
         num_heads: int,
         act: Type[nn.Module] = nn.GELU,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
     ) -> None:
         super().__init__()
         self.norm = nn.LayerNorm(embed_dim)
@@ -166,6 +287,7 @@ class AttentionMLPBlock(nn.Module):
             num_heads=num_heads,
             downsample_rate=downsample_rate,
             dropout=dropout,
+            backend=attention_backend,
         )
 
     def forward(
@@ -182,3 +304,14 @@ class AttentionMLPBlock(nn.Module):
             v = q
         attn_out = self.norm(self.attn(q, k, v, key_mask, attn_mask) + q)
         return self.norm(self.mlp(attn_out) + attn_out)
+
+    def forward_class_batched(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        key_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # see Attention.forward_class_batched
+        attn_out = self.norm(self.attn.forward_class_batched(q, k, v, key_mask) + q)
+        return self.norm(self.mlp(attn_out) + attn_out)
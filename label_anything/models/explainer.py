@@ -102,7 +102,10 @@ class LamExplainer(nn.Module):
         mask_decoder: MaskDecoderLam = self.model.mask_decoder
         class_embeddings = mask_decoder._get_class_embeddings(pe_result)
         class_embeddings, self.query_embeddings = mask_decoder.transformer(
-            self.query_embeddings, self.model.get_dense_pe(), class_embeddings
+            self.query_embeddings,
+            self.model.get_dense_pe(),
+            class_embeddings,
+            token_mask=mask_decoder._get_class_mask(flag_examples),
         )
         self.query_embeddings = rearrange(self.query_embeddings, "b (h w) c -> b c h w", h=h, w=w)
 
@@ -4,7 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
 from einops import rearrange
@@ -88,7 +88,9 @@ class Lam(nn.Module):
                 original size of the image.
         """
         seg, pe_result = self._forward(batched_input)
-        seg = self.postprocess_masks(seg, batched_input["dims"])
+        seg = self.postprocess_masks(
+            seg, batched_input["dims"], batched_input.get(BatchKeys.TARGET_SIZE)
+        )
         if "flag_gts" in batched_input:
             seg[batched_input["flag_gts"].logical_not()] = -1 * torch.inf
         return {
@@ -381,6 +383,7 @@ class Lam(nn.Module):
         self,
         masks: torch.Tensor,
         original_sizes: torch.Tensor,
+        target_size: Optional[int] = None,
     ) -> torch.Tensor:
         """
         Remove padding and upscale masks to the original image size.
@@ -390,11 +393,22 @@ class Lam(nn.Module):
             in BxCxHxW format.
           original_size (torch.Tensor): The original size of the image
             before resizing for input to the model, in (H, W) format.
+          target_size (int, optional): If given, the masks are only resized
+            to target_size x target_size, keeping the padding of the model
+            input frame, as the ground truths of the low-resolution
+            training mode.
 
         Returns:
           (torch.Tensor): Batched masks in BxCxHxW format, where (H, W)
-            is given by original_size.
+            is given by original_size (or target_size).
         """
+        if target_size is not None:
+            return F.interpolate(
+                masks,
+                (target_size, target_size),
+                mode="bilinear",
+                align_corners=False,
+            )
         max_original_size = torch.max(original_sizes.view(-1, 2), 0).values.tolist()
         original_sizes = original_sizes[:, 0, :]  # get real sizes of the query images
         input_sizes = [
@@ -516,7 +530,9 @@ class BinaryLam(Lam):
         bg_logits = torch.gather(bg_logits, 1, bg_positions.unsqueeze(1))
         logits = torch.cat([bg_logits, fg_logits], dim=1)
 
-        logits = self.postprocess_masks(logits, x["dims"])
+        logits = self.postprocess_masks(
+            logits, x["dims"], x.get(BatchKeys.TARGET_SIZE)
+        )
         logits[x["flag_gts"].logical_not()] = -1 * torch.inf
 
         return {
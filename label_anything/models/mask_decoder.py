@@ -15,7 +15,7 @@ from einops import rearrange, repeat
 
 from label_anything.utils.utils import ResultDict
 
-from .common import AttentionMLPBlock, LayerNorm2d, MLPBlock
+from .common import AttentionBackend, AttentionMLPBlock, LayerNorm2d, MLPBlock
 
 
 class MaskDecoder(nn.Module):
@@ -257,6 +257,14 @@ class MaskDecoderLam(nn.Module):
             class_embeddings = class_embeddings[ResultDict.CLASS_EMBS]
         return class_embeddings
 
+    def _get_class_mask(self, flag_examples):
+        # Classes (or examples) that are padding, not attended by the transformer
+        if flag_examples is None:
+            return None
+        if self.segment_example_logits:
+            return rearrange(flag_examples, "b n c -> b (n c)").bool()
+        return flag_examples.any(dim=1)
+
     def _upscale(self, query_embeddings, class_embeddings):
         class_embeddings = self.class_mlp(class_embeddings)
         upscaled_embeddings = self.output_upscaling(query_embeddings)
@@ -303,7 +311,10 @@ class MaskDecoderLam(nn.Module):
         class_embeddings = self._get_class_embeddings(class_embeddings)
 
         class_embeddings, query_embeddings = self.transformer(
-            query_embeddings, image_pe, class_embeddings
+            query_embeddings,
+            image_pe,
+            class_embeddings,
+            token_mask=self._get_class_mask(flag_examples),
         )
         query_embeddings = rearrange(query_embeddings, "b (h w) c -> b c h w", h=h)
 
@@ -327,6 +338,8 @@ class AffinityDecoder(nn.Module):
         class_fusion: str = "sum",
         prototype_merge: bool = False,
         transformer_keys_are_images: bool = True,
+        attention_backend: str = AttentionBackend.EAGER,
+        class_batched: bool = False,
     ) -> None:
         """
         Predicts masks given an image and prompt embeddings, using a
@@ -337,12 +350,16 @@ class AffinityDecoder(nn.Module):
           transformer (nn.Module): the transformer used to predict masks
           activation (nn.Module): the type of activation to use when
             upscaling masks
+          class_batched (bool): run the transformer with the classes in their
+            own dimension (see AffinityTransformer.forward_class_batched),
+            instead of replicating the query and support features per class
         """
         super().__init__()
         self.attention_dim = transformer_dim
         self.transformer_feature_size = None
         self.class_fusion = class_fusion
         self.transformer_keys_are_images = transformer_keys_are_images
+        self.class_batched = class_batched
         if transformer_feature_size is not None:
             self.transformer_feature_size = (
                 transformer_feature_size,
@@ -404,6 +421,7 @@ class AffinityDecoder(nn.Module):
                 num_heads=8,
                 act=activation,
                 dropout=0.0,
+                attention_backend=attention_backend,
             )
         self.transformer = transformer
         self.transformer_feature_size = transformer_feature_size
@@ -504,6 +522,34 @@ class AffinityDecoder(nn.Module):
         logits = self.output_upscaling[-1](class_features)
         return logits
 
+    def _class_batched_transformer(
+        self,
+        query_embeddings,
+        support_embeddings,
+        support_masks,
+        image_pe,
+        flag_examples,
+        batch_mask,
+    ):
+        # The query and support features are shared by the classes of an episode
+        query_embeddings = rearrange(query_embeddings, "b d h w -> b (h w) d")
+        support_masks = rearrange(support_masks, "b n c d h w -> b c (n h w) d")
+        if support_embeddings is not None:
+            support_embeddings = rearrange(
+                support_embeddings, "b n d h w -> b (n h w) d"
+            )
+        else:
+            support_embeddings = support_masks
+        query_embeddings = self.transformer.forward_class_batched(
+            query_embeddings,
+            support_embeddings,
+            support_masks,
+            image_pe,
+            flag_examples,
+        )
+        # Remove padding classes
+        return rearrange(query_embeddings, "b c hw d -> (b c) hw d")[batch_mask]
+
     def forward(
         self,
         query_embeddings: torch.Tensor,
@@ -545,29 +591,41 @@ class AffinityDecoder(nn.Module):
                 query_embeddings, support_embeddings, support_masks
             )
         )
-        query_embeddings = repeat(query_embeddings, "b d h w -> (b c) (h w) d", c=c)
-        support_masks = rearrange(support_masks, "b n c d h w -> (b c) (n h w) d")
-        if support_embeddings is not None:
-            support_embeddings = repeat(
-                support_embeddings, "b n d h w -> (b c) (n h w) d", c=c
+        batch_mask = rearrange(flag_examples, "b n c -> (b c) n").any(dim=-1)
+        if self.class_batched:
+            query_embeddings = self._class_batched_transformer(
+                query_embeddings,
+                support_embeddings,
+                support_masks,
+                image_pe,
+                flag_examples,
+                batch_mask,
             )
         else:
-            support_embeddings = support_masks
+            query_embeddings = repeat(
+                query_embeddings, "b d h w -> (b c) (h w) d", c=c
+            )
+            support_masks = rearrange(support_masks, "b n c d h w -> (b c) (n h w) d")
+            if support_embeddings is not None:
+                support_embeddings = repeat(
+                    support_embeddings, "b n d h w -> (b c) (n h w) d", c=c
+                )
+            else:
+                support_embeddings = support_masks
 
-        # Remove padding classes
-        batch_mask = rearrange(flag_examples, "b n c -> (b c) n").any(dim=-1)
-        query_embeddings = query_embeddings[batch_mask]
-        support_embeddings = support_embeddings[batch_mask]
-        support_masks = support_masks[batch_mask]
+            # Remove padding classes
+            query_embeddings = query_embeddings[batch_mask]
+            support_embeddings = support_embeddings[batch_mask]
+            support_masks = support_masks[batch_mask]
 
-        query_embeddings = self.transformer(
-            query_embeddings,
-            support_embeddings,
-            support_masks,
-            image_pe,
-            flag_examples,
-            batch_mask,
-        )
+            query_embeddings = self.transformer(
+                query_embeddings,
+                support_embeddings,
+                support_masks,
+                image_pe,
+                flag_examples,
+                batch_mask,
+            )
         query_embeddings = rearrange(query_embeddings, "bc (h w) d -> bc d h w", h=h)
         query_embeddings = self.rescale_for_transformer(
             query_embeddings, None, None, size=cur_feature_size
@@ -671,7 +729,10 @@ class MultiLevelMaskDecoder(nn.Module):
             lv_class_embeddings = mask_decoder._get_class_embeddings(lv_class_embeddings)
 
             lv_class_embeddings, lv_query_embeddings = mask_decoder.transformer(
-                lv_query_embeddings, lv_image_pe, lv_class_embeddings
+                lv_query_embeddings,
+                lv_image_pe,
+                lv_class_embeddings,
+                token_mask=mask_decoder._get_class_mask(flag_examples),
             )
             lv_query_embeddings = rearrange(lv_query_embeddings, "b (h w) c -> b c h w", h=h)
 
@@ -11,7 +11,13 @@ from einops import rearrange, repeat
 
 from typing import Any, Optional, Tuple, Type
 
-from .common import Attention, LayerNorm2d, MLPBlock, AttentionMLPBlock
+from .common import (
+    Attention,
+    AttentionBackend,
+    LayerNorm2d,
+    MLPBlock,
+    AttentionMLPBlock,
+)
 from .transformer import TwoWayTransformer
 
 from label_anything.data.utils import Label
@@ -263,6 +269,24 @@ class RandomMatrixEncoder(nn.Module):
 
         return dense_embeddings, sparse_embeddings
 
+    def forward_packed(
+        self, dense_embeddings, sparse_embeddings, class_indices, num_classes
+    ):
+        """Adds random class embedding to packed (example, class) pairs
+
+        Args:
+            dense_embeddings (torch.Tensor): Dense embeddings with shape P x D x H x W
+            sparse_embeddings (torch.Tensor): Sparse embeddings with shape P x N x D
+            class_indices (torch.Tensor): Class index of each pair, with shape P
+            num_classes (int): Number of classes C of the batch
+        """
+        selected_rows = self.sample_rows(num_classes, device=sparse_embeddings.device)
+        class_encoding = self.pos_embedding[0, 0, selected_rows[class_indices]]
+        return (
+            dense_embeddings + class_encoding[:, :, None, None],
+            sparse_embeddings + class_encoding[:, None, :],
+        )
+
     def forward(self, dense_embeddings, sparse_embeddings):
         """Adds random class embedding
 
@@ -293,6 +317,8 @@ class PromptImageEncoder(PromptEncoder):
         activation: Type[nn.Module] = nn.GELU,
         use_support_features: bool = True,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
+        sparse_pairs: bool = False,
     ) -> None:
         """
         Encodes prompts for input to LAM's mask decoder.
@@ -307,6 +333,12 @@ class PromptImageEncoder(PromptEncoder):
             encoding input masks.
           activation (nn.Module): The activation to use when encoding
             input masks.
+          sparse_pairs (bool): Embed the masks and run the transformer only on
+            the (example, class) pairs flagged in flag_examples, instead of on
+            all the padded B x M x C pairs. The class embeddings are the same.
+            Padded pairs are zeros instead of embeddings of empty prompts, so
+            the class and example attention layers must be masked (see
+            set_masked_attention), otherwise forward raises a ValueError.
         """
         super().__init__(
             embed_dim, image_embedding_size, input_image_size, mask_in_chans, activation
@@ -320,6 +352,7 @@ class PromptImageEncoder(PromptEncoder):
         self.transformer = transformer
         self.class_encoder = class_encoder
         self.use_support_features = use_support_features
+        self.sparse_pairs = sparse_pairs
 
         self.sparse_embedding_attention = AttentionMLPBlock(
             embed_dim=embed_dim,
@@ -328,6 +361,7 @@ class PromptImageEncoder(PromptEncoder):
             mlp_dim=mlp_dim,
             act=activation,
             dropout=dropout,
+            attention_backend=attention_backend,
         )
         self.no_sparse_embedding = nn.Embedding(
             1, embed_dim
@@ -352,6 +386,7 @@ class PromptImageEncoder(PromptEncoder):
                 mlp_dim=mlp_dim,
                 act=activation,
                 dropout=dropout,
+                attention_backend=attention_backend,
             )
 
         self.class_example_attention = None
@@ -363,6 +398,7 @@ class PromptImageEncoder(PromptEncoder):
                 mlp_dim=mlp_dim,
                 act=activation,
                 dropout=dropout,
+                attention_backend=attention_backend,
             )
 
         self.example_attention = None
@@ -374,6 +410,7 @@ class PromptImageEncoder(PromptEncoder):
                 mlp_dim=mlp_dim,
                 act=activation,
                 dropout=dropout,
+                attention_backend=attention_backend,
             )
 
         self.not_a_mask_embed = nn.Embedding(
@@ -434,6 +471,7 @@ class PromptImageEncoder(PromptEncoder):
         boxes: Optional[Tuple[torch.Tensor, torch.Tensor]],
         masks: Optional[Tuple[torch.Tensor, torch.Tensor]],
         chunk_size: Optional[int] = None,
+        pairs: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Embeds different types of prompts, returning both sparse and dense
@@ -445,6 +483,9 @@ class PromptImageEncoder(PromptEncoder):
             and labels to embed.
           boxes (tuple(torch.Tensor, torch.Tensor) or none): boxes to embed and padding
           masks (tuple(torch.Tensor, torch.Tensor) or none): masks to embed and padding
+          pairs (torch.Tensor or none): B x M x C boolean mask of the
+            (example, class) pairs whose dense embeddings are computed, packed
+            as 1 x 1 x P x (embed_dim) x (embed_H) x (embed_W)
 
         Returns:
           torch.Tensor: sparse embeddings for the points and boxes, with shape
@@ -495,8 +536,13 @@ class PromptImageEncoder(PromptEncoder):
             c=n_classes,
         )
 
+        if pairs is not None:
+            B, n_examples, n_classes = 1, 1, int(pairs.sum())
         if masks is not None:
             mask_inputs, mask_flags = masks
+            if pairs is not None:
+                mask_inputs = mask_inputs[pairs][None, None]
+                mask_flags = mask_flags[pairs][None, None]
             dense_embeddings = self._embed_masks(mask_inputs, mask_flags, chunk_size)
         else:
             dense_embeddings = self.no_mask_embed.weight.reshape(
@@ -610,46 +656,115 @@ class PromptImageEncoder(PromptEncoder):
           torch.Tensor: dense embeddings for the masks, in the shape
             Bx(embed_dim)x(embed_H)x(embed_W)
         """
+        if self.sparse_pairs and flag_examples is not None:
+            if not self._merge_is_masked():
+                raise ValueError(
+                    "sparse_pairs needs masked attention, otherwise the class and "
+                    "example attention layers attend the padded pairs, which are "
+                    "zeros instead of the embeddings of empty prompts."
+                )
+            return self._forward_sparse_pairs(
+                image_embeddings, points, boxes, masks, flag_examples, chunk_size
+            )
         sparse_embeddings, dense_embeddings = self.embed_points_masks(
             points, boxes, masks, chunk_size=chunk_size
         )
-        sparse_embeddings = rearrange(sparse_embeddings, "b m c n d -> (b m c) n d")
 
         b, m, c, d, h, w = dense_embeddings.shape
-        dense_embeddings = rearrange(dense_embeddings, "b m c d h w -> (b m c) d h w")
-
         if image_embeddings.shape[-2:] != dense_embeddings.shape[-2:]:
+            dense_embeddings = rearrange(
+                dense_embeddings, "b m c d h w -> (b m c) d h w"
+            )
             dense_embeddings = nn.functional.interpolate(
                 dense_embeddings,
                 size=image_embeddings.shape[-2:],
                 mode="bilinear",
                 align_corners=False,
             )
+            dense_embeddings = rearrange(
+                dense_embeddings, "(b m c) d h w -> b m c d h w", b=b, m=m, c=c
+            )
 
+        # The support features of an example and the positional encoding are
+        # broadcast over its classes, not copied: the sum is the only B x M x C
+        # dense tensor
         if self.use_support_features:
-            src = rearrange(image_embeddings, "b m d h w -> b m 1 d h w").repeat(
-                1, 1, c, 1, 1, 1
-            )
-            src = rearrange(src, "b m c d h w -> (b m c) d h w")
+            src = rearrange(image_embeddings, "b m d h w -> b m 1 d h w")
             src = src + dense_embeddings
         else:
             src = dense_embeddings
-        pos_src = torch.repeat_interleave(
-            self.get_dense_pe(), sparse_embeddings.shape[0], dim=0
-        )
+        pos_src = self.get_dense_pe().expand(b * m * c, -1, -1, -1)
 
         # Run the transformer to fuse the dense embeddings and sparse embeddings
-        src = rearrange(src, "(b m c) d h w -> b m c d h w", b=b, m=m, c=c)
-        sparse_embeddings = rearrange(
-            sparse_embeddings, "(b m c) n d -> b m c n d", b=b, m=m, c=c
-        )
         src = self.sparse_dense_fusion(
             src, pos_src, sparse_embeddings, chunk_size=chunk_size
         )
         src = rearrange(src, "b d h w -> b d (h w)")
         embeddings = nn.functional.adaptive_avg_pool1d(src, (1)).squeeze(2)  # (BMC, D)
         embeddings = rearrange(embeddings, "(b m c) d -> b m c d", b=b, m=m, c=c)
+        return self._merge_examples(embeddings, src, flag_examples)
+
+    def _merge_is_masked(self):
+        # Whether the layers of prompt_class_information_merge leave the padded
+        # pairs out of the attention
+        layers = [
+            self.class_attention,
+            self.example_attention,
+            self.class_example_attention,
+        ]
+        return all(layer.attn.masked_attention for layer in layers if layer is not None)
+
+    def _forward_sparse_pairs(
+        self, image_embeddings, points, boxes, masks, flag_examples, chunk_size=None
+    ):
+        # Only the flagged (example, class) pairs are embedded and fused, packed in
+        # a P dimension, then scattered back to B x M x C
+        b, m, c = flag_examples.shape
+        pairs = flag_examples.bool()
+        batch_idx, example_idx, class_idx = pairs.nonzero(as_tuple=True)
+        sparse_embeddings, dense_embeddings = self.embed_points_masks(
+            points, boxes, masks, chunk_size=chunk_size, pairs=pairs
+        )
+        sparse_embeddings = sparse_embeddings[pairs]  # P n d
+        dense_embeddings = dense_embeddings[0, 0]  # P d h w
+
+        if image_embeddings.shape[-2:] != dense_embeddings.shape[-2:]:
+            dense_embeddings = nn.functional.interpolate(
+                dense_embeddings,
+                size=image_embeddings.shape[-2:],
+                mode="bilinear",
+                align_corners=False,
+            )
 
+        if self.use_support_features:
+            src = image_embeddings[batch_idx, example_idx] + dense_embeddings
+        else:
+            src = dense_embeddings
+        pos_src = self.get_dense_pe().expand(sparse_embeddings.shape[0], -1, -1, -1)
+
+        # Inject class awareness (class encoders without forward_packed, as the
+        # identity, are applied as is), then fuse the dense and sparse embeddings
+        if hasattr(self.class_encoder, "forward_packed"):
+            src, sparse_embeddings = self.class_encoder.forward_packed(
+                src, sparse_embeddings, class_idx, c
+            )
+            src, sparse_embeddings = src[None, None], sparse_embeddings[None, None]
+        else:
+            src, sparse_embeddings = self.class_encoder(
+                src[None, None], sparse_embeddings[None, None]
+            )
+        packed_src = self.apply_transformer(src, pos_src, sparse_embeddings, chunk_size)
+        packed_src = rearrange(packed_src, "p d h w -> p d (h w)")
+
+        # Padding pairs are zeros, their embeddings are masked by the merge
+        src = packed_src.new_zeros(b * m * c, *packed_src.shape[1:])
+        src[pairs.flatten()] = packed_src
+        pooled = nn.functional.adaptive_avg_pool1d(packed_src, (1)).squeeze(2)  # (P, D)
+        embeddings = pooled.new_zeros(b, m, c, pooled.shape[1])
+        embeddings[pairs] = pooled
+        return self._merge_examples(embeddings, src, flag_examples)
+
+    def _merge_examples(self, embeddings, src, flag_examples):
         embeddings = self.prompt_class_information_merge(embeddings, flag_examples)
 
         # Average over examples removing padding embeddings
@@ -7,18 +7,32 @@
 from einops import rearrange, repeat
 from torch import Tensor, nn
 
-from typing import Tuple, Type
+from typing import Optional, Tuple, Type
 
-from label_anything.models.common import Attention
+from label_anything.models.common import Attention, AttentionBackend
 
 from .common import AttentionMLPBlock, MLPBlock
 
 
+def token_attention_mask(token_mask: Optional[Tensor]) -> Optional[Tensor]:
+    """B x N_tokens token mask to an attention mask of the tokens as keys,
+    B x 1 x 1 x N_tokens, broadcast to all the heads and queries."""
+    if token_mask is None:
+        return None
+    return token_mask[:, None, None, :]
+
+
 class IdentityTransformer(nn.Module):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__()
         
-    def forward(self, image_embedding: Tensor, image_pe: Tensor, token_embedding: Tensor) -> Tensor:
+    def forward(
+        self,
+        image_embedding: Tensor,
+        image_pe: Tensor,
+        token_embedding: Tensor,
+        token_mask: Optional[Tensor] = None,
+    ) -> Tensor:
         image_embedding = rearrange(image_embedding, "b c h w -> b (h w) c")
         return token_embedding, image_embedding
 
@@ -33,6 +47,7 @@ class OneWayTransformer(nn.Module):
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
     ) -> None:
         """
         A transformer decoder that attends to an input image using
@@ -62,6 +77,7 @@ class OneWayTransformer(nn.Module):
                     activation=activation,
                     attention_downsample_rate=attention_downsample_rate,
                     dropout=dropout,
+                    attention_backend=attention_backend,
                 )
             )
             
@@ -70,6 +86,7 @@ class OneWayTransformer(nn.Module):
         image_embedding: Tensor,
         image_pe: Tensor,
         token_embedding: Tensor,
+        token_mask: Optional[Tensor] = None,
     ) -> Tensor:
         """
         Args:
@@ -78,6 +95,8 @@ class OneWayTransformer(nn.Module):
           image_pe (torch.Tensor): the positional encoding to add to the image. Must
             have the same shape as image_embedding.
           token_embedding (torch.Tensor): the embedding to add to the query points.
+          token_mask (torch.Tensor, optional): B x N_tokens, true for the tokens
+            that are not padding. Padding tokens are not attended.
 
         Returns:
           torch.Tensor: the processed point_embedding
@@ -91,12 +110,16 @@ class OneWayTransformer(nn.Module):
         queries = image_embedding
         keys = token_embedding
 
+        # Mask of the padding tokens, shared by all the layers
+        token_attn_mask = token_attention_mask(token_mask)
+
         # Apply transformer blocks
         for layer in self.layers:
             queries = layer(
                 queries=queries,
                 keys=keys,
                 query_pe=image_pe,
+                token_attn_mask=token_attn_mask,
             )
 
         return keys, queries
@@ -111,6 +134,7 @@ class OneWayAttentionBlock(nn.Module):
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
     ) -> None:
         """
         A transformer block with four layers: (1) self-attention of sparse
@@ -128,7 +152,11 @@ class OneWayAttentionBlock(nn.Module):
         super().__init__()
 
         self.cross_attn_image_to_token = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, dropout=dropout
+            embedding_dim,
+            num_heads,
+            downsample_rate=attention_downsample_rate,
+            dropout=dropout,
+            backend=attention_backend,
         )
         self.norm1 = nn.LayerNorm(embedding_dim)
 
@@ -137,11 +165,17 @@ class OneWayAttentionBlock(nn.Module):
         self.norm3 = nn.LayerNorm(embedding_dim)
 
     def forward(
-        self, queries: Tensor, keys: Tensor, query_pe: Tensor
+        self,
+        queries: Tensor,
+        keys: Tensor,
+        query_pe: Tensor,
+        token_attn_mask: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         # Cross attention block, image embedding attending to tokens 
         q = queries + query_pe
-        attn_out = self.cross_attn_image_to_token(q=q, k=keys, v=keys)
+        attn_out = self.cross_attn_image_to_token(
+            q=q, k=keys, v=keys, attn_mask=token_attn_mask
+        )
         queries = queries + attn_out
         queries = self.norm1(queries)
 
@@ -163,6 +197,7 @@ class TwoWayTransformer(nn.Module):
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
     ) -> None:
         """
         A transformer decoder that attends to an input image using
@@ -194,11 +229,16 @@ class TwoWayTransformer(nn.Module):
                     attention_downsample_rate=attention_downsample_rate,
                     dropout=dropout,
                     skip_first_layer_pe=(i == 0),
+                    attention_backend=attention_backend,
                 )
             )
 
         self.final_attn_token_to_image = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, dropout=dropout
+            embedding_dim,
+            num_heads,
+            downsample_rate=attention_downsample_rate,
+            dropout=dropout,
+            backend=attention_backend,
         )
         self.norm_final_attn = nn.LayerNorm(embedding_dim)
 
@@ -207,6 +247,7 @@ class TwoWayTransformer(nn.Module):
         image_embedding: Tensor,
         image_pe: Tensor,
         point_embedding: Tensor,
+        token_mask: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         """
         Args:
@@ -216,6 +257,8 @@ class TwoWayTransformer(nn.Module):
             have the same shape as image_embedding.
           point_embedding (torch.Tensor): the embedding to add to the query points.
             Must have shape B x N_points x embedding_dim for any N_points.
+          token_mask (torch.Tensor, optional): B x N_points, true for the points
+            that are not padding. Padding points are not attended.
 
         Returns:
           torch.Tensor: the processed point_embedding
@@ -230,6 +273,9 @@ class TwoWayTransformer(nn.Module):
         queries = point_embedding
         keys = image_embedding
 
+        # Mask of the padding tokens, shared by all the layers
+        token_attn_mask = token_attention_mask(token_mask)
+
         # Apply transformer blocks and final layernorm
         for layer in self.layers:
             queries, keys = layer(
@@ -237,6 +283,7 @@ class TwoWayTransformer(nn.Module):
                 keys=keys,
                 query_pe=point_embedding,
                 key_pe=image_pe,
+                token_attn_mask=token_attn_mask,
             )
 
         # Apply the final attention layer from the points to the image
@@ -259,6 +306,7 @@ class TwoWayAttentionBlock(nn.Module):
         attention_downsample_rate: int = 2,
         skip_first_layer_pe: bool = False,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
     ) -> None:
         """
         A transformer block with four layers: (1) self-attention of sparse
@@ -274,11 +322,17 @@ class TwoWayAttentionBlock(nn.Module):
           skip_first_layer_pe (bool): skip the PE on the first layer
         """
         super().__init__()
-        self.self_attn = Attention(embedding_dim, num_heads, dropout=dropout)
+        self.self_attn = Attention(
+            embedding_dim, num_heads, dropout=dropout, backend=attention_backend
+        )
         self.norm1 = nn.LayerNorm(embedding_dim)
 
         self.cross_attn_token_to_image = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, dropout=dropout
+            embedding_dim,
+            num_heads,
+            downsample_rate=attention_downsample_rate,
+            dropout=dropout,
+            backend=attention_backend,
         )
         self.norm2 = nn.LayerNorm(embedding_dim)
 
@@ -287,20 +341,31 @@ class TwoWayAttentionBlock(nn.Module):
 
         self.norm4 = nn.LayerNorm(embedding_dim)
         self.cross_attn_image_to_token = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, dropout=dropout
+            embedding_dim,
+            num_heads,
+            downsample_rate=attention_downsample_rate,
+            dropout=dropout,
+            backend=attention_backend,
         )
 
         self.skip_first_layer_pe = skip_first_layer_pe
 
     def forward(
-        self, queries: Tensor, keys: Tensor, query_pe: Tensor, key_pe: Tensor
+        self,
+        queries: Tensor,
+        keys: Tensor,
+        query_pe: Tensor,
+        key_pe: Tensor,
+        token_attn_mask: Optional[Tensor] = None,
     ) -> Tuple[Tensor, Tensor]:
         # Self attention block
         if self.skip_first_layer_pe:
-            queries = self.self_attn(q=queries, k=queries, v=queries)
+            queries = self.self_attn(
+                q=queries, k=queries, v=queries, attn_mask=token_attn_mask
+            )
         else:
             q = queries + query_pe
-            attn_out = self.self_attn(q=q, k=q, v=queries)
+            attn_out = self.self_attn(q=q, k=q, v=queries, attn_mask=token_attn_mask)
             queries = queries + attn_out
         queries = self.norm1(queries)
 
@@ -319,7 +384,9 @@ class TwoWayAttentionBlock(nn.Module):
         # Cross attention block, image embedding attending to tokens
         q = queries + query_pe
         k = keys + key_pe
-        attn_out = self.cross_attn_image_to_token(q=k, k=q, v=queries)
+        attn_out = self.cross_attn_image_to_token(
+            q=k, k=q, v=queries, attn_mask=token_attn_mask
+        )
         keys = keys + attn_out
         keys = self.norm4(keys)
 
@@ -334,6 +401,7 @@ class AffinityBlock(nn.Module):
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
     ) -> None:
         super().__init__()
         self.attention = AttentionMLPBlock(
@@ -343,6 +411,7 @@ class AffinityBlock(nn.Module):
             act=activation,
             downsample_rate=attention_downsample_rate,
             dropout=dropout,
+            attention_backend=attention_backend,
         )
         
     def forward(self, image_features, support_features, support_masks, image_pe, attn_mask):
@@ -354,6 +423,22 @@ class AffinityBlock(nn.Module):
         keys = support_features + support_image_pe
         values = support_masks
         return self.attention(queries, keys, values, attn_mask=attn_mask) + image_features
+
+    def forward_class_batched(
+        self, image_features, support_features, support_masks, image_pe, key_mask
+    ):
+        # The positional encodings are broadcast instead of repeated, in the same
+        # (h w n) order as in forward
+        query_image_pe = rearrange(image_pe, "1 d h w -> 1 1 (h w) d")
+        shots = support_features.shape[-2] // image_features.shape[-2]
+        support_image_pe = repeat(image_pe, "1 d h w -> 1 (h w n) d", n=shots)
+        queries = image_features + query_image_pe
+        keys = support_features + support_image_pe
+        values = support_masks
+        return (
+            self.attention.forward_class_batched(queries, keys, values, key_mask)
+            + image_features
+        )
         
 
 class AffinityTransformer(nn.Module):
@@ -366,6 +451,7 @@ class AffinityTransformer(nn.Module):
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
         dropout: float = 0.0,
+        attention_backend: str = AttentionBackend.EAGER,
     ) -> None:
         super().__init__()
         self.layers = nn.ModuleList()
@@ -379,6 +465,7 @@ class AffinityTransformer(nn.Module):
                     activation=activation,
                     attention_downsample_rate=attention_downsample_rate,
                     dropout=dropout,
+                    attention_backend=attention_backend,
                 )
             )
 
@@ -392,10 +479,46 @@ class AffinityTransformer(nn.Module):
         batch_mask: Tensor,
     ) -> Tuple[Tensor, Tensor]:
         hw = image_embedding.shape[1]
-        attn_mask = repeat(flag_examples, "b n c -> (b c) (n hw)", hw=hw)
-        attn_mask = repeat(attn_mask, "b shots -> b hw shots", hw=hw)
-        attn_mask = repeat(attn_mask, "b hw shots -> b c hw shots ", c=self.num_heads)
+        # Mask of the padding examples, shared by all the queries, heads and layers
+        attn_mask = repeat(flag_examples, "b n c -> (b c) 1 1 (n hw)", hw=hw)
         attn_mask = attn_mask[batch_mask]
         for layer in self.layers:
             image_embedding = layer(image_embedding, support_features, support_masks, image_pe, attn_mask)
-        return image_embedding
\ No newline at end of file
+        return image_embedding
+
+    def forward_class_batched(
+        self,
+        image_embedding: Tensor,
+        support_features: Tensor,
+        support_masks: Tensor,
+        image_pe: Tensor,
+        flag_examples: Tensor,
+    ) -> Tensor:
+        """
+        Same as forward, with the classes in their own dimension instead of
+        replicating the query and support features of each image per class: only
+        the state that differs between classes (the support masks and the query
+        features after the first layer) is stored per class.
+
+        Args:
+          image_embedding (torch.Tensor): B x HW x D query features
+          support_features (torch.Tensor): B x NHW x D support features, shared by
+            the classes (or B x C x NHW x D)
+          support_masks (torch.Tensor): B x C x NHW x D class features of the
+            supports
+          image_pe (torch.Tensor): 1 x D x H x W positional encoding
+          flag_examples (torch.Tensor): B x N x C flags of the examples
+
+        Returns:
+          torch.Tensor: B x C x HW x D query features of each class
+        """
+        hw = image_embedding.shape[1]
+        c = support_masks.shape[1]
+        # Mask of the padding examples, shared by all the queries, heads and layers
+        key_mask = repeat(flag_examples, "b n c -> b c (n hw)", hw=hw)
+        image_embedding = image_embedding.unsqueeze(1)
+        for layer in self.layers:
+            image_embedding = layer.forward_class_batched(
+                image_embedding, support_features, support_masks, image_pe, key_mask
+            )
+        return image_embedding.expand(-1, c, -1, -1)
\ No newline at end of file
@@ -1,9 +1,9 @@
 import json
 import logging
+import multiprocessing
 import os
 
 import numpy as np
-import safetensors.torch as safetch
 import torch
 import torch.nn.functional as F
 from einops import rearrange
@@ -14,46 +14,113 @@ from transformers import ViTModel
 
 from label_anything.data import get_mean_std
 from label_anything.data.coco import LabelAnyThingOnlyImageDataset
+from label_anything.data.embedding_store import mark_embeddings_updated
+from label_anything.data.gt_store import META_FILENAME as GT_META_FILENAME
+from label_anything.data.gt_store import label_map_dtype, write_gt_shard
+from label_anything.data.gt_store import shard_name as gt_shard_name
+from label_anything.data.quantization import StoragePrecision, quantize_tensors
 from label_anything.data.transforms import (
     CustomNormalize,
     CustomResize,
     Normalize,
-    PromptsProcessor,
     Resize,
 )
 from label_anything.models import model_registry, build_encoder
 from label_anything.utils.utils import ResultDict
 
 
-def generate_ground_truths(dataset_name, anns_path, outfolder, custom_preprocess=True):
+def _write_gt_shard(args):
+    write_gt_shard(*args)
+    return len(args[3])
+
+
+def generate_ground_truths(
+    dataset_name,
+    anns_path,
+    outfolder,
+    num_workers=None,
+    shard_size=1000,
+):
+    """
+    Rasterize the label maps of all the images in anns_path to a GroundTruthStore in outfolder.
+    Annotations are grouped by image in a single pass, and shards of shard_size images are
+    rasterized in a process pool. Shards already written are skipped, so an interrupted run
+    can be resumed by running the same command again.
+
+    Args:
+        dataset_name (str): name of the dataset (e.g. "coco", "lvis")
+        anns_path (str): path to the instances file
+        outfolder (str): directory of the ground truth store
+        num_workers (int): number of processes, defaults to the number of CPUs
+        shard_size (int): number of images per shard
+    """
     with open(anns_path, "r") as f:
         anns = json.load(f)
-    pp = PromptsProcessor(custom_preprocess=custom_preprocess)
-    images = anns["images"]
-    annotations = anns["annotations"]
-
-    for image in tqdm(images):
-        image_anns = [ann for ann in annotations if ann["image_id"] == image["id"]]
-        image_mask = torch.zeros(image["height"], image["width"], dtype=torch.long)
-        for ann in image_anns:
-            mask = pp.convert_mask(
-                ann["segmentation"], image["height"], image["width"]
-            ).astype(np.int64)
-            mask[mask == 1] = ann["category_id"]
-            image_mask = torch.max(image_mask, torch.from_numpy(mask))
-        loaded = safetch.load_file(
-            os.path.join(outfolder, f"{str(image['id']).zfill(12)}.safetensors")
-        )
-        loaded[f"{dataset_name}_gt"] = image_mask
-        save_file(
-            loaded, os.path.join(outfolder, f"{str(image['id']).zfill(12)}.safetensors")
+    images = sorted(anns["images"], key=lambda x: x["id"])
+    image_annotations = {}
+    for ann in anns["annotations"]:
+        image_annotations.setdefault(ann["image_id"], []).append(ann)
+    max_category_id = max((x["id"] for x in anns["categories"]), default=0)
+    del anns
+
+    os.makedirs(outfolder, exist_ok=True)
+    meta = {
+        "dataset_name": dataset_name,
+        "num_images": len(images),
+        "shard_size": shard_size,
+        "num_shards": (len(images) + shard_size - 1) // shard_size,
+        "dtype": np.dtype(label_map_dtype(max_category_id)).name,
+    }
+    meta_path = os.path.join(outfolder, GT_META_FILENAME)
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            previous_meta = json.load(f)
+        if previous_meta != meta:
+            raise ValueError(
+                f"{outfolder} contains ground truths generated with different settings "
+                f"({previous_meta}), use another outfolder or remove it."
+            )
+    else:
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    tasks = []
+    for shard_idx in range(meta["num_shards"]):
+        if os.path.exists(
+            os.path.join(outfolder, gt_shard_name(dataset_name, shard_idx))
+        ):
+            continue
+        shard_images = images[shard_idx * shard_size : (shard_idx + 1) * shard_size]
+        shard_annotations = {
+            x["id"]: image_annotations.get(x["id"], []) for x in shard_images
+        }
+        tasks.append(
+            (
+                outfolder,
+                dataset_name,
+                shard_idx,
+                shard_images,
+                shard_annotations,
+                meta["dtype"],
+            )
         )
+    logging.info(
+        f"{meta['num_shards'] - len(tasks)}/{meta['num_shards']} shards already generated"
+    )
+
+    with tqdm(total=sum(len(task[3]) for task in tasks)) as pbar:
+        with multiprocessing.Pool(num_workers) as pool:
+            for n_images in pool.imap_unordered(_write_gt_shard, tasks):
+                pbar.update(n_images)
 
 
 @torch.no_grad()
-def create_image_embeddings(model, dataloader, outfolder, device="cuda"):
+def create_image_embeddings(
+    model, dataloader, outfolder, device="cuda", precision=StoragePrecision.FP32
+):
     """
-    Create image embeddings for all images in dataloader and save them to outfolder.
+    Create image embeddings for all images in dataloader and save them to outfolder,
+    stored at the given precision (fp32, fp16, bf16 or int8 with per-channel scales).
     """
     logging.basicConfig(
         level=logging.INFO,
@@ -68,11 +135,12 @@ def create_image_embeddings(model, dataloader, outfolder, device="cuda"):
         out = model(img).cpu()
         for i in range(out.shape[0]):
             save_file(
-                {"embedding": out[i]},
+                quantize_tensors({"embedding": out[i]}, precision),
                 os.path.join(outfolder, f"{image_id[i]}.safetensors"),
             )
         if idx % 10 == 0:
             logging.info(f"Step {idx}/{n_steps}")
+    mark_embeddings_updated(outfolder)
 
 
 def preprocess_images_to_embeddings(
@@ -87,6 +155,8 @@ def preprocess_images_to_embeddings(
     device="cuda",
     compile=False,
     custom_preprocess=True,
+    precision=StoragePrecision.FP32,
+    fast_decode=False,
 ):
     """
     Create image embeddings for all images in dataloader and save them to outfolder.
@@ -100,6 +170,8 @@ def preprocess_images_to_embeddings(
         batch_size (int): batch size for the dataloader
         num_workers (int): number of workers for the dataloader
         outfolder (str): folder to save the embeddings
+        precision (str): storage precision of the embeddings (fp32, fp16, bf16 or int8)
+        fast_decode (bool): decode the JPEGs at the scale they are resized to (see decode_image)
     """
     os.makedirs(outfolder, exist_ok=True)
     model = model_registry[encoder_name](
@@ -119,7 +191,7 @@ def preprocess_images_to_embeddings(
         else Compose([Resize(1024), ToTensor(), Normalize()])
     )
     dataset = LabelAnyThingOnlyImageDataset(
-        directory=directory, preprocess=preprocess_image
+        directory=directory, preprocess=preprocess_image, fast_decode=fast_decode
     )
     print("Dataset created")
     dataloader = torch.utils.data.DataLoader(
@@ -134,9 +206,12 @@ def preprocess_images_to_embeddings(
             last_hidden_dir=outfolder,
             last_block_dir=last_block_dir,
             device=device,
+            precision=precision,
         )
     else:
-        create_image_embeddings(model, dataloader, outfolder, device=device)
+        create_image_embeddings(
+            model, dataloader, outfolder, device=device, precision=precision
+        )
 
 
 @torch.no_grad()
@@ -146,6 +221,7 @@ def create_image_and_neck_embeddings(
     last_hidden_dir,
     last_block_dir,
     device="cuda",
+    precision=StoragePrecision.FP32,
 ):
     logging.basicConfig(
         level=logging.INFO,
@@ -162,22 +238,29 @@ def create_image_and_neck_embeddings(
         last_block_state = out[ResultDict.LAST_BLOCK_STATE].cpu()
         for i in range(last_hidden_state.shape[0]):
             save_file(
-                {"embedding": last_hidden_state[i]},
+                quantize_tensors({"embedding": last_hidden_state[i]}, precision),
                 os.path.join(last_hidden_dir, f"{image_id[i]}.safetensors"),
             )
 
             save_file(
-                {"embedding": last_block_state[i]},
+                quantize_tensors({"embedding": last_block_state[i]}, precision),
                 os.path.join(last_block_dir, f"{image_id[i]}.safetensors"),
             )
 
         if idx % 10 == 0:
             logging.info(f"Step {idx}/{n_steps}")
+    mark_embeddings_updated(last_hidden_dir)
+    mark_embeddings_updated(last_block_dir)
 
 
 @torch.no_grad()
 def create_image_embeddings_huggingface(
-    model, dataloader, outfolder, device="cuda", image_resolution=480
+    model,
+    dataloader,
+    outfolder,
+    device="cuda",
+    image_resolution=480,
+    precision=StoragePrecision.FP32,
 ):
     """
     Create image embeddings for all images in dataloader and save them to outfolder.
@@ -201,11 +284,12 @@ def create_image_embeddings_huggingface(
         ).contiguous()
         for i in range(out.shape[0]):
             save_file(
-                {"embedding": out[i]},
+                quantize_tensors({"embedding": out[i]}, precision),
                 os.path.join(outfolder, f"{image_id[i]}.safetensors"),
             )
         if idx % 10 == 0:
             logging.info(f"Step {idx}/{n_steps}")
+    mark_embeddings_updated(outfolder)
 
 
 @torch.no_grad
@@ -220,6 +304,8 @@ def preprocess_images_to_embeddings_huggingface(
     image_resolution=480,
     custom_preprocess=True,
     mean_std="default",
+    precision=StoragePrecision.FP32,
+    fast_decode=False,
 ):
     os.makedirs(outfolder, exist_ok=True)
     model = ViTModel.from_pretrained(model_name)
@@ -248,7 +334,7 @@ def preprocess_images_to_embeddings_huggingface(
         )
     )
     dataset = LabelAnyThingOnlyImageDataset(
-        directory=directory, preprocess=preprocess_image
+        directory=directory, preprocess=preprocess_image, fast_decode=fast_decode
     )
     print("Dataset created")
     dataloader = torch.utils.data.DataLoader(
@@ -256,7 +342,12 @@ def preprocess_images_to_embeddings_huggingface(
     )
     print("Dataloader created")
     create_image_embeddings_huggingface(
-        model, dataloader, outfolder, device=device, image_resolution=image_resolution
+        model,
+        dataloader,
+        outfolder,
+        device=device,
+        image_resolution=image_resolution,
+        precision=precision,
     )
 
 
@@ -273,6 +364,8 @@ def preprocess_images_to_feature_pyramids(
     custom_preprocess=True,
     out_features=["stage2", "stage3", "stage4"],
     mean_std="default",
+    precision=StoragePrecision.FP32,
+    fast_decode=False,
 ):
     os.makedirs(outfolder, exist_ok=True)
     encoder = build_encoder.build_encoder(encoder_name)
@@ -301,7 +394,7 @@ def preprocess_images_to_feature_pyramids(
         )
     )
     dataset = LabelAnyThingOnlyImageDataset(
-        directory=directory, preprocess=preprocess_image
+        directory=directory, preprocess=preprocess_image, fast_decode=fast_decode
     )
     print("Dataset created")
     dataloader = torch.utils.data.DataLoader(
@@ -317,11 +410,37 @@ def preprocess_images_to_feature_pyramids(
             for j, stage in enumerate(out_features):
                 feature_maps[stage] = out.feature_maps[j][i].cpu()
             save_file(
-                feature_maps,
+                quantize_tensors(feature_maps, precision),
                 os.path.join(outfolder, f"{image_id[i]}.safetensors"),
             )
         if idx % 10 == 0:
             logging.info(f"Step {idx}/{len(dataloader)}")
+    mark_embeddings_updated(outfolder)
+
+
+def quantize_embeddings(emb_dir, outfolder, precision):
+    """
+    Convert a directory of per-image safetensors files (embeddings or feature pyramids)
+    to the given storage precision, without running the encoder again. Other tensors
+    stored with the embeddings (e.g. ground truths) are copied as they are.
+
+    Args:
+        emb_dir (str): directory of the embeddings, stored at any precision
+        outfolder (str): directory of the converted embeddings
+        precision (str): storage precision (fp32, fp16, bf16 or int8)
+    """
+    from safetensors.torch import load_file
+
+    from label_anything.data.quantization import dequantize_tensors
+
+    os.makedirs(outfolder, exist_ok=True)
+    filenames = sorted(f for f in os.listdir(emb_dir) if f.endswith(".safetensors"))
+    for filename in tqdm(filenames, desc=f"Quantizing embeddings to {precision}"):
+        tensors = dequantize_tensors(load_file(os.path.join(emb_dir, filename)))
+        save_file(
+            quantize_tensors(tensors, precision), os.path.join(outfolder, filename)
+        )
+    mark_embeddings_updated(outfolder)
 
 
 def rename_coco20i_json(instances_path: str):
@@ -0,0 +1,134 @@
+import json
+import multiprocessing
+import resource
+
+import numpy as np
+import pytest
+import torch
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "benchmark: timing benchmarks, run with -m benchmark -s to see the results",
+    )
+    # benchmarks only run when selected, e.g. with -m benchmark
+    if not config.option.markexpr:
+        config.option.markexpr = "not benchmark"
+
+
+def _measure(setup, args):
+    torch.set_num_threads(1)
+    run = setup(*args)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = run()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    return result, peak / 1024
+
+
+@pytest.fixture
+def peak_memory():
+    """Calls setup(*args) in a forked process, so that its peak RSS is the one of this run
+    only, then the function it returns. Returns the result of the function and the growth
+    of the peak RSS while it ran, in MiB."""
+
+    def measure(setup, *args):
+        context = multiprocessing.get_context("fork")
+        with context.Pool(1) as pool:
+            return pool.apply(_measure, (setup, args))
+
+    return measure
+
+
+# (segmentation kind, category id) of the annotations of each image, in the order of the
+# instances file: overlapping masks of different categories, and empty ones
+COCO_ANNOTATIONS = [
+    ("polygon", 1),
+    ("rle", 2),
+    ("uncompressed_rle", 3),
+    ("polygon", 2),
+    ("empty_polygon", 1),
+    ("empty_rle", 4),
+    ("rle", 5),
+    ("uncompressed_rle", 1),
+]
+
+
+def _segmentation(kind, h, w, rng):
+    from pycocotools import mask as mask_utils
+
+    x0, x1 = sorted(rng.integers(0, w, 2).tolist())
+    y0, y1 = sorted(rng.integers(0, h, 2).tolist())
+    if kind == "polygon":
+        x1, y1 = x1 + 0.5, y1 + 0.5
+        return [[x0, y0, x1, y0, x1, y1, x0, y1]]
+    if kind == "empty_polygon":
+        return [[x0 + 0.2, y0 + 0.2, x0 + 0.4, y0 + 0.2, x0 + 0.3, y0 + 0.2]]
+    mask = np.zeros((h, w), dtype=np.uint8)
+    if kind != "empty_rle":
+        mask[y0 : y1 + 1, x0 : x1 + 1] = 1
+        mask[rng.random((h, w)) < 0.1] = 1
+    if kind == "uncompressed_rle":
+        # run lengths of the column-major mask, starting with background
+        flat = mask.flatten(order="F")
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(flat)) + 1, [flat.size]])
+        counts = np.diff(bounds).tolist()
+        return {"size": [h, w], "counts": [0] + counts if flat[0] else counts}
+    rle = mask_utils.encode(np.asfortranarray(mask))
+    return {"size": [h, w], "counts": rle["counts"].decode()}
+
+
+@pytest.fixture
+def coco_instances(tmp_path):
+    """A small instances file with every kind of segmentation. Returns its path and the
+    instances."""
+    rng = np.random.default_rng(0)
+    images, annotations = [], []
+    for image_id, (h, w) in enumerate([(30, 40), (25, 33)], start=1):
+        images.append(
+            {
+                "id": image_id,
+                "height": h,
+                "width": w,
+                "file_name": f"{image_id}.jpg",
+                "coco_url": f"http://localhost/{image_id}.jpg",
+            }
+        )
+        for kind, cat_id in COCO_ANNOTATIONS:
+            annotations.append(
+                {
+                    "id": len(annotations) + 1,
+                    "image_id": image_id,
+                    "category_id": cat_id,
+                    "segmentation": _segmentation(kind, h, w, rng),
+                    "area": float(h * w // 4),
+                    "bbox": [1.0, 1.0, w / 2, h / 2],
+                    "iscrowd": 0,
+                }
+            )
+    instances = {
+        "images": images,
+        "annotations": annotations,
+        "categories": [{"id": i, "name": f"category{i}"} for i in range(1, 6)],
+    }
+    path = tmp_path / "instances.json"
+    with open(path, "w") as f:
+        json.dump(instances, f)
+    return str(path), instances
+
+
+@pytest.fixture
+def coco_dataset(coco_instances, tmp_path):
+    """Builds a CocoLVISDataset over coco_instances, with the given parameters."""
+    from label_anything.data.coco import CocoLVISDataset
+
+    def build(**kwargs):
+        return CocoLVISDataset(
+            name="coco",
+            instances_path=coco_instances[0],
+            img_dir=str(tmp_path),
+            load_embeddings=False,
+            **kwargs,
+        )
+
+    return build
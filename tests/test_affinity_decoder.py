@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from label_anything.models.common import set_masked_attention
+from label_anything.models.mask_decoder import AffinityDecoder
+from label_anything.models.transformer import AffinityTransformer
+from label_anything.utils.utils import ResultDict
+
+
+def build_decoder(dim, transformer_keys_are_images=True):
+    torch.manual_seed(0)
+    return AffinityDecoder(
+        transformer_dim=dim,
+        transformer=AffinityTransformer(
+            depth=2, embedding_dim=dim, num_heads=8, mlp_dim=2 * dim
+        ),
+        transformer_keys_are_images=transformer_keys_are_images,
+    ).eval()
+
+
+def decoder_inputs(b, n, c, dim, size, seed=1):
+    torch.manual_seed(seed)
+    flag_examples = torch.ones(b, n, c, dtype=torch.long)
+    flag_examples[0, 1, 1] = 0  # missing example
+    flag_examples[-1, :, -1] = 0  # padding class
+    return dict(
+        query_embeddings=torch.randn(b, dim, size, size),
+        support_embeddings=torch.randn(b, n, dim, size, size),
+        image_pe=torch.randn(1, dim, size, size),
+        class_embeddings={
+            ResultDict.EXAMPLES_CLASS_SRC: torch.randn(b * n * c, dim, size * size),
+            ResultDict.EXAMPLES_CLASS_EMBS: torch.randn(b, n, c, dim),
+        },
+        flag_examples=flag_examples,
+    )
+
+
+@pytest.mark.parametrize("masked_attention", [False, True])
+@pytest.mark.parametrize("transformer_keys_are_images", [True, False])
+@torch.no_grad()
+def test_class_batched_matches_replicated(transformer_keys_are_images, masked_attention):
+    decoder = build_decoder(64, transformer_keys_are_images)
+    set_masked_attention(decoder, masked_attention)
+    inputs = decoder_inputs(b=2, n=2, c=3, dim=64, size=8)
+    expected = decoder(**inputs)
+    decoder.class_batched = True
+    torch.testing.assert_close(decoder(**inputs), expected, rtol=1e-4, atol=1e-4)
+
+
+def setup_decoder(class_batched, num_classes):
+    decoder = build_decoder(256)
+    decoder.class_batched = class_batched
+    inputs = decoder_inputs(b=1, n=2, c=num_classes, dim=256, size=16)
+
+    @torch.no_grad()
+    def run():
+        decoder(**inputs)
+
+    return run
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("num_classes", [2, 10, 50])
+def test_class_batched_memory(peak_memory, num_classes):
+    for class_batched in [False, True]:
+        _, peak = peak_memory(setup_decoder, class_batched, num_classes)
+        name = "class batched" if class_batched else "replicated"
+        print(f"{num_classes} classes {name}: peak memory +{peak:.0f} MiB")
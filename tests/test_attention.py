@@ -0,0 +1,136 @@
+import time
+
+import pytest
+import torch
+
+from label_anything.models.common import (
+    Attention,
+    AttentionBackend,
+    set_masked_attention,
+)
+from label_anything.models.transformer import AffinityTransformer, TwoWayTransformer
+
+
+def attention_pair(**kwargs):
+    torch.manual_seed(0)
+    eager = Attention(**kwargs, backend=AttentionBackend.EAGER).eval()
+    sdpa = Attention(**kwargs, backend=AttentionBackend.SDPA).eval()
+    eager.masked_attention = sdpa.masked_attention = True
+    sdpa.load_state_dict(eager.state_dict())
+    return eager, sdpa
+
+
+@pytest.mark.parametrize("downsample_rate", [1, 2])
+@pytest.mark.parametrize(
+    "masks",
+    [
+        [],
+        ["key_mask"],
+        ["attn_mask"],
+        ["broadcast_attn_mask"],
+        ["key_mask", "attn_mask"],
+    ],
+)
+@torch.no_grad()
+def test_sdpa_matches_eager(downsample_rate, masks):
+    eager, sdpa = attention_pair(
+        embedding_dim=64, num_heads=8, downsample_rate=downsample_rate
+    )
+    q, k = torch.randn(3, 10, 64), torch.randn(3, 17, 64)
+    all_masks = {
+        "key_mask": torch.rand(3, 17) > 0.3,
+        "attn_mask": torch.rand(3, 8, 10, 17) > 0.3,
+        "broadcast_attn_mask": torch.rand(3, 1, 10, 17) > 0.3,
+    }
+    kwargs = {name.replace("broadcast_", ""): all_masks[name] for name in masks}
+    torch.testing.assert_close(
+        sdpa(q, k, k, **kwargs), eager(q, k, k, **kwargs), rtol=1e-5, atol=1e-5
+    )
+
+
+@pytest.mark.parametrize("backend", list(AttentionBackend))
+@torch.no_grad()
+def test_masked_keys_are_ignored(backend):
+    torch.manual_seed(0)
+    attention = Attention(64, 8, backend=backend, masked_attention=True).eval()
+    q, k = torch.randn(2, 10, 64), torch.randn(2, 17, 64)
+    key_mask = torch.ones(2, 17, dtype=torch.long)
+    key_mask[0, 12:] = 0
+    key_mask[1] = 0  # all padding
+    out = attention(q, k, k, key_mask=key_mask)
+    torch.testing.assert_close(
+        out[:1], attention(q[:1], k[:1, :12], k[:1, :12]), rtol=1e-5, atol=1e-5
+    )
+    assert not out.isnan().any()
+
+
+@pytest.mark.parametrize("backend", list(AttentionBackend))
+@torch.no_grad()
+def test_legacy_masking_ignores_masks(backend):
+    torch.manual_seed(0)
+    attention = Attention(64, 8, backend=backend).eval()
+    q, k = torch.randn(2, 10, 64), torch.randn(2, 17, 64)
+    key_mask = torch.rand(2, 17) > 0.3
+    attn_mask = torch.rand(2, 8, 10, 17) > 0.3
+    torch.testing.assert_close(
+        attention(q, k, k, key_mask=key_mask, attn_mask=attn_mask),
+        attention(q, k, k),
+    )
+
+
+@torch.no_grad()
+def test_sdpa_transformers_match_eager():
+    outputs = {}
+    for backend in AttentionBackend:
+        torch.manual_seed(0)
+        params = dict(depth=2, embedding_dim=64, num_heads=8, mlp_dim=128)
+        two_way = TwoWayTransformer(**params, attention_backend=backend).eval()
+        affinity = AffinityTransformer(**params, attention_backend=backend).eval()
+        set_masked_attention(two_way, True)
+        set_masked_attention(affinity, True)
+        torch.manual_seed(1)
+        image, pe = torch.randn(2, 64, 8, 8), torch.randn(1, 64, 8, 8)
+        tokens = torch.randn(2, 5, 64)
+        token_mask = torch.tensor([[1, 1, 1, 0, 0], [1, 1, 1, 1, 1]])
+        flag_examples = torch.tensor([[[1, 1], [0, 1]]])
+        batch_mask = torch.ones(2, dtype=torch.bool)
+        outputs[backend] = two_way(
+            image, pe.expand(2, -1, -1, -1), tokens, token_mask=token_mask
+        ) + (
+            affinity(
+                torch.randn(2, 64, 64),
+                torch.randn(2, 128, 64),
+                torch.randn(2, 128, 64),
+                pe,
+                flag_examples,
+                batch_mask,
+            ),
+        )
+    for eager, sdpa in zip(*outputs.values()):
+        torch.testing.assert_close(sdpa, eager, rtol=1e-4, atol=1e-4)
+
+
+def setup_attention(backend, num_tokens, trials):
+    torch.manual_seed(0)
+    attention = Attention(256, 8, backend=backend).eval()
+    q = torch.randn(4, num_tokens, 256)
+
+    @torch.no_grad()
+    def run():
+        attention(q, q, q)
+        start = time.time()
+        for _ in range(trials):
+            attention(q, q, q)
+        return (time.time() - start) / trials
+
+    return run
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("num_tokens", [256, 1024, 4096])
+def test_attention_benchmark(peak_memory, num_tokens):
+    for backend in AttentionBackend:
+        elapsed, peak = peak_memory(setup_attention, backend, num_tokens, 5)
+        print(
+            f"{num_tokens} tokens {backend}: {elapsed * 1000:.1f} ms, peak memory +{peak:.0f} MiB"
+        )
@@ -0,0 +1,133 @@
+import time
+from collections import Counter
+
+import numpy as np
+import pytest
+import torch
+
+from label_anything.data.class_sampling import AliasTable, PowerLawSampler
+from label_anything.data.examples import (
+    ExampleGenerator,
+    sample_over_inverse_frequency,
+    sample_power_law,
+    uniform_sampling,
+)
+
+NUM_DRAWS = 20000
+# total variation distance allowed between two empirical distributions of NUM_DRAWS draws
+TOLERANCE = 0.03
+
+
+def total_variation(a: Counter, b: Counter) -> float:
+    n_a, n_b = sum(a.values()), sum(b.values())
+    return 0.5 * sum(abs(a[k] / n_a - b[k] / n_b) for k in set(a) | set(b))
+
+
+def generator(n_elements):
+    return ExampleGenerator(
+        images_to_categories=None,
+        categories_to_imgs=None,
+        n_classes_sample_function=lambda n: torch.tensor(n_elements),
+        class_sample_function=None,
+        image_sample_function=uniform_sampling,
+        min_size=1,
+    )
+
+
+def legacy(sample_function):
+    # a different function object, so that sample_classes_from_query takes the per-class path
+    return lambda *args, **kwargs: sample_function(*args, **kwargs)
+
+
+def subsets(example_generator, sample_function, frequencies=None):
+    class_list = torch.tensor(
+        list(frequencies.keys()) if frequencies else [3, 5, 7, 11, 13]
+    )
+    return Counter(
+        tuple(
+            example_generator.sample_classes_from_query(
+                class_list, sample_function, frequencies=frequencies
+            ).tolist()
+        )
+        for _ in range(NUM_DRAWS)
+    )
+
+
+def test_alias_table():
+    torch.manual_seed(42)
+    np.random.seed(42)
+    weights = np.array([1.0, 2.0, 3.0, 4.0, 0.5])
+    draws = AliasTable(weights).sample(200000)
+    frequencies = np.bincount(draws, minlength=len(weights)) / len(draws)
+    assert np.abs(frequencies - weights / weights.sum()).max() < 0.01
+
+
+def test_power_law_matches():
+    torch.manual_seed(42)
+    np.random.seed(42)
+    for alpha in [-2.0, 1.0]:
+        expected = Counter(sample_power_law(8, alpha, NUM_DRAWS).tolist())
+        actual = Counter(PowerLawSampler(alpha)(8, NUM_DRAWS).tolist())
+        assert total_variation(expected, actual) < TOLERANCE
+
+
+@pytest.mark.parametrize("n_elements", [2, 4])
+def test_uniform_subsets_match(n_elements):
+    torch.manual_seed(42)
+    np.random.seed(42)
+    example_generator = generator(n_elements)
+    expected = subsets(example_generator, legacy(uniform_sampling))
+    actual = subsets(example_generator, uniform_sampling)
+    assert total_variation(expected, actual) < TOLERANCE
+
+
+@pytest.mark.parametrize("n_elements", [2, 4])
+def test_frequency_subsets_match(n_elements):
+    torch.manual_seed(42)
+    np.random.seed(42)
+    example_generator = generator(n_elements)
+    frequencies = {3: 0, 5: 4, 7: 1, 11: 9, 13: 2}
+    expected = subsets(
+        example_generator, legacy(sample_over_inverse_frequency), frequencies
+    )
+    actual = subsets(example_generator, sample_over_inverse_frequency, frequencies)
+    assert total_variation(expected, actual) < TOLERANCE
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("num_classes", [5, 20, 80])
+def test_class_sampling_benchmark(num_classes):
+    frequencies = {k: k % 7 for k in range(num_classes)}
+    class_list = torch.tensor(list(frequencies.keys()))
+    trials = 1000
+
+    # up to half of the classes are drawn with inverse weights, more by removing
+    # classes drawn with the counts as weights
+    for branch, n_elements in [
+        ("inverse", max(num_classes // 3, 1)),
+        ("removal", num_classes - max(num_classes // 3, 1)),
+    ]:
+        example_generator = generator(n_elements)
+        for name, sample_function in [
+            ("per-class", legacy(sample_over_inverse_frequency)),
+            ("subset", sample_over_inverse_frequency),
+        ]:
+            start = time.time()
+            for _ in range(trials):
+                example_generator.sample_classes_from_query(
+                    class_list, sample_function, frequencies=frequencies
+                )
+            print(
+                f"num_classes={num_classes} {branch} {name}: {(time.time() - start) / trials * 1e6:.1f} us per subset"
+            )
+
+    for name, sample_function in [
+        ("per-call", lambda n: sample_power_law(n, -2.0)),
+        ("alias", PowerLawSampler(-2.0)),
+    ]:
+        start = time.time()
+        for _ in range(trials):
+            sample_function(num_classes)
+        print(
+            f"num_classes={num_classes} power law {name}: {(time.time() - start) / trials * 1e6:.1f} us per draw"
+        )
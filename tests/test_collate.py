@@ -0,0 +1,142 @@
+import itertools
+import time
+
+import pytest
+import torch
+
+import label_anything.data.utils as utils
+from label_anything.data.dataset import LabelAnythingDataset
+
+
+def random_sample(num_examples, num_classes, max_annotations, size=64):
+    """A dataset item with a random number of classes and annotations, as the
+    datasets return them (flag dtypes included)."""
+    c = torch.randint(2, num_classes + 1, (1,)).item()
+    n = torch.randint(1, max_annotations + 1, (1,)).item()
+    h, w = torch.randint(size // 2, size + 1, (2,)).tolist()
+    classes = [set(range(1, c)) for _ in range(num_examples)]
+    return (
+        {
+            "embeddings": torch.rand(num_examples, 256, 4, 4),
+            "prompt_masks": torch.rand(num_examples, c, 256, 256),
+            "flag_masks": torch.randint(0, 2, (num_examples, c), dtype=torch.uint8),
+            "prompt_points": torch.rand(num_examples, c, n, 2),
+            "flag_points": torch.randint(0, 2, (num_examples, c, n)),
+            "prompt_bboxes": torch.rand(num_examples, c, n, 4),
+            "flag_bboxes": torch.randint(0, 2, (num_examples, c, n)),
+            "flag_examples": torch.randint(0, 2, (num_examples, c), dtype=torch.uint8),
+            "dims": torch.tensor([[h, w]] * num_examples),
+            "classes": classes,
+            "image_ids": list(range(num_examples)),
+            "ground_truths": torch.randint(0, c, (num_examples, h, w)).float(),
+        },
+        "coco",
+    )
+
+
+def legacy_collate(batched_input):
+    """The per-sample collate, for reference."""
+    batched_input, _ = zip(*batched_input)
+    max_classes = max([x["prompt_masks"].size(1) for x in batched_input])
+    dims = torch.stack([x["dims"] for x in batched_input])
+    max_dims = torch.max(
+        torch.tensor([x["ground_truths"].shape[-2:] for x in batched_input]), 0
+    ).values.tolist()
+    ground_truths = torch.stack(
+        [utils.collate_batch_gts(x["ground_truths"], max_dims) for x in batched_input]
+    )
+    masks_flags = [
+        utils.collate_mask(x["prompt_masks"], x["flag_masks"], max_classes)
+        for x in batched_input
+    ]
+    max_annotations = max(x["prompt_bboxes"].size(2) for x in batched_input)
+    bboxes_flags = [
+        utils.collate_bbox(
+            x["prompt_bboxes"], x["flag_bboxes"], max_classes, max_annotations
+        )
+        for x in batched_input
+    ]
+    max_annotations = max(x["prompt_points"].size(2) for x in batched_input)
+    points_flags = [
+        utils.collate_coords(
+            x["prompt_points"], x["flag_points"], max_classes, max_annotations
+        )
+        for x in batched_input
+    ]
+    flag_examples = torch.stack(
+        [
+            utils.collate_example_flags(x["flag_examples"], max_classes)
+            for x in batched_input
+        ]
+    )
+    flag_gts = torch.zeros((len(batched_input), max_classes), dtype=torch.bool)
+    for i, x in enumerate([x["classes"] for x in batched_input]):
+        flag_gts[i, : len(list(set(itertools.chain(*x)))) + 1] = 1
+    data_dict = {
+        "embeddings": torch.stack([x["embeddings"] for x in batched_input]),
+        "prompt_masks": torch.stack([x[0] for x in masks_flags]),
+        "flag_masks": torch.stack([x[1] for x in masks_flags]),
+        "prompt_bboxes": torch.stack([x[0] for x in bboxes_flags]),
+        "flag_bboxes": torch.stack([x[1] for x in bboxes_flags]),
+        "prompt_points": torch.stack([x[0] for x in points_flags]),
+        "flag_points": torch.stack([x[1] for x in points_flags]),
+        "flag_examples": flag_examples,
+        "dims": dims,
+        "flag_gts": flag_gts,
+    }
+    return data_dict, ground_truths
+
+
+def test_collate_matches_legacy():
+    dataset = LabelAnythingDataset(datasets_params={}, common_params={})
+    batch = [random_sample(4, 6, 5) for _ in range(4)]
+    (data_dict, ground_truths), _ = dataset.collate_fn(batch)
+    expected, expected_ground_truths = legacy_collate(batch)
+    assert torch.equal(ground_truths, expected_ground_truths)
+    for key, value in expected.items():
+        assert data_dict[key].dtype == value.dtype, key
+        assert torch.equal(data_dict[key], value), key
+
+
+def test_compact_ground_truths():
+    gt = torch.randint(0, 6, (20, 30), dtype=torch.uint8)
+    padded = utils.collate_gts(gt, [32, 32])
+    assert padded.dtype == torch.uint8
+    assert torch.equal(padded[:20, :30], gt) and not padded[20:].any()
+    resized = utils.resize_gt(gt, 64)
+    assert resized.dtype == torch.int16 and (resized[43:] == -100).all()
+
+    dataset = LabelAnythingDataset(datasets_params={}, common_params={})
+    batch = [random_sample(4, 6, 5) for _ in range(4)]
+    (_, expected), _ = dataset.collate_fn(batch)
+    for sample, _ in batch:
+        sample["ground_truths"] = sample["ground_truths"].to(torch.uint8)
+    (_, ground_truths), _ = dataset.collate_fn(batch)
+    assert ground_truths.dtype == torch.long
+    assert torch.equal(ground_truths, expected)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize(
+    "batch_size,num_examples,num_classes",
+    [(2, 4, 5), (8, 4, 5), (8, 8, 5), (8, 4, 10), (16, 8, 10)],
+)
+def test_collate_benchmark(batch_size, num_examples, num_classes):
+    dataset = LabelAnythingDataset(datasets_params={}, common_params={})
+    batch = [random_sample(num_examples, num_classes, 10) for _ in range(batch_size)]
+    trials = 10
+
+    start = time.time()
+    for _ in range(trials):
+        legacy_collate(batch)
+    legacy_time = (time.time() - start) / trials
+
+    start = time.time()
+    for _ in range(trials):
+        dataset.collate_fn(batch)
+    time_taken = (time.time() - start) / trials
+
+    print(
+        f"batch_size={batch_size} num_examples={num_examples} num_classes={num_classes}: "
+        f"per-sample {legacy_time * 1000:.2f} ms, preallocated {time_taken * 1000:.2f} ms"
+    )
@@ -0,0 +1,136 @@
+import os
+import random
+
+import numpy as np
+import torch
+
+import label_anything.data.dataset as dataset_module
+from label_anything.data.dataset import LabelAnythingDataset, VariableBatchSampler
+from label_anything.data.episode_plan import EpisodePlan, episode_plan_path, plan_epochs
+from label_anything.data.utils import BatchMetadataKeys
+
+
+class RangeDataset:
+    def __init__(self, length):
+        self.length = length
+        self.categories = {}
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx_metadata):
+        return idx_metadata[0]
+
+    def plan_episode(self, idx, batch_metadata):
+        num_examples = batch_metadata[BatchMetadataKeys.NUM_EXAMPLES]
+        return (
+            [idx] + torch.randint(0, self.length, (num_examples,)).tolist(),
+            torch.randint(0, 80, (2,)).tolist(),
+        )
+
+
+class EpisodeDataset(RangeDataset):
+    def __getitem__(self, idx_metadata):
+        # the episode of the plan, if any, as CocoLVISDataset does
+        idx, batch_metadata = idx_metadata
+        episode = batch_metadata.get(BatchMetadataKeys.EPISODE)
+        if episode is None:
+            episode = self.plan_episode(idx, batch_metadata)
+        return episode
+
+
+def mixed_dataset(monkeypatch, lengths, mixing_ratios, dataset_class=RangeDataset):
+    for name in lengths:
+        monkeypatch.setitem(dataset_module.datasets, name, dataset_class)
+    return LabelAnythingDataset(
+        datasets_params={name: {"length": length} for name, length in lengths.items()},
+        common_params={},
+        mixing_ratios=mixing_ratios,
+    )
+
+
+def test_mixing_ratios_reach_every_sample(monkeypatch):
+    lengths = {"large": 100, "odd": 77, "small": 20}
+    dataset = mixed_dataset(monkeypatch, lengths, {"large": 1, "odd": 1, "small": 4})
+    assert dataset.index_lengths == [33, 33, 131]
+
+    seen = {name: set() for name in lengths}
+    for epoch in range(4):
+        dataset.set_epoch(epoch)
+        epoch_samples = {name: [] for name in lengths}
+        for idx in range(len(dataset)):
+            sample, name = dataset[(idx, {})]
+            epoch_samples[name].append(sample)
+        for name, samples in epoch_samples.items():
+            assert all(0 <= x < lengths[name] for x in samples)
+            if len(samples) <= lengths[name]:
+                # strided over: no sample twice in an epoch
+                assert len(set(samples)) == len(samples)
+            seen[name].update(samples)
+        # the sampler estimates the episode sizes with the same mapping
+        num_categories, _ = dataset.episode_sizes()
+        assert len(num_categories) == len(dataset)
+    for name, length in lengths.items():
+        assert seen[name] == set(range(length))
+    assert np.array_equal(
+        dataset._dataset_positions(0, np.arange(33)),
+        [dataset._dataset_index(idx)[1] for idx in range(33)],
+    )
+
+
+def assert_same_plans(plan, expected):
+    assert plan.batch_metadata == expected.batch_metadata
+    for name in [
+        "indices",
+        "batch_offsets",
+        "image_offsets",
+        "image_ids",
+        "category_offsets",
+        "category_ids",
+    ]:
+        assert np.array_equal(getattr(plan, name), getattr(expected, name)), name
+
+
+def test_resumed_episode_plans_match(monkeypatch, tmp_path):
+    def planning_run():
+        random.seed(0)
+        dataset = mixed_dataset(
+            monkeypatch, {"large": 50, "small": 10}, {"large": 1, "small": 1}
+        )
+        sampler = VariableBatchSampler(
+            dataset, possible_batch_example_nums=[[2, 1], [3, 2]], shuffle=True
+        )
+        return dataset, sampler
+
+    dataset, sampler = planning_run()
+    plan_epochs(dataset, sampler, tmp_path, seed=0, num_epochs=3, num_workers=1)
+    paths = [episode_plan_path(tmp_path, epoch) for epoch in range(3)]
+    expected = [EpisodePlan.load(path) for path in paths]
+    assert not np.array_equal(expected[0].indices, expected[1].indices)
+
+    # resumed in the same process, after extra iterations, and in a new one
+    list(iter(sampler))
+    for dataset, sampler in [(dataset, sampler), planning_run()]:
+        os.remove(paths[1])
+        plan_epochs(dataset, sampler, tmp_path, seed=0, num_epochs=3, num_workers=1)
+        for path, expected_plan in zip(paths, expected):
+            assert_same_plans(EpisodePlan.load(path), expected_plan)
+
+
+def test_planned_episodes_are_replayed(monkeypatch, tmp_path):
+    random.seed(0)
+    lengths, mixing_ratios = {"large": 50, "small": 10}, {"large": 1, "small": 1}
+    dataset = mixed_dataset(monkeypatch, lengths, mixing_ratios, EpisodeDataset)
+    params = dict(possible_batch_example_nums=[[2, 1], [3, 2]], shuffle=True)
+    sampler = VariableBatchSampler(dataset, **params)
+    plan_epochs(dataset, sampler, tmp_path, seed=0, num_epochs=2, num_workers=1)
+
+    planned_sampler = VariableBatchSampler(dataset, **params, episode_plan_dir=tmp_path)
+    for epoch in range(2):
+        plan = EpisodePlan.load(episode_plan_path(tmp_path, epoch))
+        planned_sampler.set_epoch(epoch)
+        samples = [sample for batch in planned_sampler for sample in batch]
+        assert [idx for idx, _ in samples] == plan.indices.tolist()
+        for i, sample in enumerate(samples):
+            episode, _ = dataset[sample]
+            assert episode == plan.episode(i)
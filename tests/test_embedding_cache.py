@@ -0,0 +1,146 @@
+import multiprocessing
+import os
+import random
+import time
+import uuid
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from label_anything.data.embedding_cache import (
+    SharedEmbeddingCache,
+    embedding_cache_name,
+)
+from label_anything.data.embedding_store import (
+    SafetensorsEmbeddingStore,
+    mark_embeddings_updated,
+    open_embedding_store,
+)
+
+NUM_EMBEDDINGS = 16
+NUM_PROCESSES = 4
+
+
+class CountingStore(SafetensorsEmbeddingStore):
+    """Counts the reads from disk of all the processes."""
+
+    def __init__(self, emb_dir, reads):
+        super().__init__(emb_dir)
+        self.reads = reads
+
+    def __getitem__(self, key):
+        with self.reads.get_lock():
+            self.reads.value += 1
+        return super().__getitem__(key)
+
+
+def write_embeddings(emb_dir):
+    keys = [str(i).zfill(12) for i in range(NUM_EMBEDDINGS)]
+    for key in keys:
+        save_file(
+            {"embedding": torch.rand(32, 8, 8), "coco_gt": torch.randint(0, 5, (20, 30))},
+            f"{emb_dir}/{key}.safetensors",
+        )
+    return keys
+
+
+def read_all(emb_dir, name, max_bytes, keys, reads, failures, seed):
+    # every process opens the cache on its own, as DDP ranks do
+    cache = SharedEmbeddingCache(CountingStore(emb_dir, reads), name, max_bytes)
+    reference = SafetensorsEmbeddingStore(emb_dir)
+    keys = keys * 2
+    random.Random(seed).shuffle(keys)
+    for key in keys:
+        tensors = cache[key]
+        expected = reference[key]
+        if tensors.keys() != expected.keys() or not all(
+            torch.equal(tensors[k], expected[k]) for k in expected
+        ):
+            with failures.get_lock():
+                failures.value += 1
+
+
+def test_embeddings_read_once_per_node(tmp_path):
+    keys = write_embeddings(tmp_path)
+    name = f"la-emb-test-{uuid.uuid4().hex}"
+    context = multiprocessing.get_context("fork")
+    reads = context.Value("i", 0)
+    failures = context.Value("i", 0)
+    processes = [
+        context.Process(
+            target=read_all,
+            args=(tmp_path, name, 64 * 1024**2, keys, reads, failures, seed),
+        )
+        for seed in range(NUM_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    cache = SharedEmbeddingCache(SafetensorsEmbeddingStore(tmp_path), name, 0)
+    stats = cache.stats()
+    cache.unlink()
+    assert all(process.exitcode == 0 for process in processes)
+    assert failures.value == 0
+    # without the cache, every process reads every embedding twice
+    assert reads.value == NUM_EMBEDDINGS
+    assert stats["entries"] == NUM_EMBEDDINGS
+
+
+def test_lru_eviction(tmp_path):
+    keys = write_embeddings(tmp_path)
+    name = f"la-emb-test-{uuid.uuid4().hex}"
+    reads = multiprocessing.Value("i", 0)
+    cache = SharedEmbeddingCache(CountingStore(tmp_path, reads), name, 0)
+    try:
+        cache[keys[0]]
+        # room for 4 entries
+        cache.max_bytes = 4 * cache.stats()["slot_size"]
+        cache.unlink()
+        for key in keys[:4] + keys[:4]:
+            cache[key]
+        assert reads.value == 1 + 4
+        cache[keys[4]]  # evicts keys[0], the least recently used
+        cache[keys[1]]
+        assert reads.value == 1 + 5
+        cache[keys[0]]
+        assert reads.value == 1 + 6
+        assert cache.stats()["entries"] == 4
+    finally:
+        cache.unlink()
+
+
+def test_cache_name_follows_the_store(tmp_path):
+    keys = write_embeddings(tmp_path)
+    store = SafetensorsEmbeddingStore(tmp_path)
+    name = embedding_cache_name(tmp_path, "safetensors", store.fingerprint())
+    assert name == embedding_cache_name(tmp_path, "safetensors", store.fingerprint())
+    assert name != embedding_cache_name(
+        tmp_path, "safetensors", store.fingerprint(), slot_headroom=2.0
+    )
+    # embeddings regenerated in place
+    save_file({"embedding": torch.rand(32, 4, 4)}, f"{tmp_path}/{keys[3]}.safetensors")
+    mark_embeddings_updated(tmp_path)
+    regenerated = embedding_cache_name(tmp_path, "safetensors", store.fingerprint())
+    assert regenerated != name
+    # embeddings of new images, once the coarse clock of file times has ticked
+    time.sleep(0.05)
+    save_file({"embedding": torch.rand(32, 4, 4)}, f"{tmp_path}/new.safetensors")
+    assert regenerated != embedding_cache_name(
+        tmp_path, "safetensors", store.fingerprint()
+    )
+
+
+@pytest.mark.parametrize("keep", [False, True])
+def test_release(tmp_path, keep):
+    keys = write_embeddings(tmp_path)
+    cache = open_embedding_store(tmp_path, cache_bytes=64 * 1024**2, keep_cache=keep)
+    try:
+        cache[keys[0]]
+        assert os.path.exists(cache.path)
+        cache.release()
+        assert os.path.exists(cache.path) == keep
+    finally:
+        cache.unlink()
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from label_anything.data.transforms import PromptsProcessor
+from label_anything.data.utils import PromptType
+
+
+def legacy_ground_truths(instances, image_ids, cat_ids):
+    """The ground truths painted mask by mask, in the order of the instances file."""
+    processor = PromptsProcessor()
+    images = {x["id"]: x for x in instances["images"]}
+    ground_truths = []
+    for image_id in image_ids:
+        h, w = images[image_id]["height"], images[image_id]["width"]
+        ground_truth = np.zeros((h, w), dtype=np.int64)
+        for ann in instances["annotations"]:
+            if ann["image_id"] != image_id or ann["category_id"] not in cat_ids:
+                continue
+            mask = processor.convert_mask(ann["segmentation"], h, w)
+            ground_truth[mask == 1] = cat_ids.index(ann["category_id"])
+        ground_truths.append(ground_truth)
+    return ground_truths
+
+
+@pytest.mark.parametrize("reuse", ["none", "prompts", "cache"])
+@pytest.mark.parametrize(
+    "cat_ids",
+    [
+        [-1, 1, 2, 3, 4, 5],
+        [-1, 4, 2, 1],
+        [-1, 3],
+        # more than 256 classes, painted in uint16
+        [-1, *range(100, 400), 2, 1, 3],
+    ],
+    ids=["all", "subset", "single", "uint16"],
+)
+def test_ground_truths_match_legacy(coco_instances, coco_dataset, cat_ids, reuse):
+    _, instances = coco_instances
+    dataset = coco_dataset(mask_cache_bytes=2**20 if reuse == "cache" else 0)
+    image_ids = [2, 1]
+    decoded_masks = {} if reuse == "prompts" else None
+    if reuse != "none":
+        # the masks of the prompts are decoded first, as in __getitem__
+        dataset._get_prompts(image_ids, cat_ids[1:], [PromptType.MASK], decoded_masks)
+    ground_truths = dataset.compute_ground_truths(image_ids, cat_ids, decoded_masks)
+    for ground_truth, expected in zip(
+        ground_truths, legacy_ground_truths(instances, image_ids, cat_ids)
+    ):
+        assert ground_truth.shape == expected.shape
+        assert np.array_equal(ground_truth.numpy(), expected)
@@ -0,0 +1,64 @@
+from itertools import combinations
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from label_anything.data.annotation_index import AnnotationIndex
+from label_anything.data.examples import ExampleGenerator
+from label_anything.data.image_bitsets import CategoryImageBitsets
+
+CAT2IMG = {
+    1: {10, 11, 12, 13},
+    2: {11, 12, 14},
+    3: {12, 13, 14, 15, 16, 17, 18, 19, 20},
+    4: {15},
+}
+EXCLUDED = [[], [12], [12, 13], [99], [11, 99, 20]]
+
+
+def cat2img(kind):
+    if kind == "dict":
+        return CAT2IMG
+    # the annotation index only needs the image and category of each annotation
+    pairs = [(img, cat) for cat, imgs in CAT2IMG.items() for img in sorted(imgs)]
+    packed = SimpleNamespace(
+        ann_image_ids=np.array([img for img, _ in pairs]),
+        ann_category_ids=np.array([cat for _, cat in pairs]),
+    )
+    return AnnotationIndex(packed).cat2img
+
+
+def generator(categories_to_imgs, use_bitsets):
+    return ExampleGenerator(
+        images_to_categories=None,
+        categories_to_imgs=categories_to_imgs,
+        n_classes_sample_function=None,
+        class_sample_function=None,
+        image_sample_function=None,
+        min_size=1,
+        use_bitsets=use_bitsets,
+    )
+
+
+@pytest.mark.parametrize("kind", ["dict", "view"])
+def test_bitsets_match_sets(kind):
+    categories_to_imgs = cat2img(kind)
+    bitsets = generator(categories_to_imgs, use_bitsets=True)
+    sets = generator(categories_to_imgs, use_bitsets=False)
+    assert isinstance(bitsets.image_bitsets, CategoryImageBitsets)
+    for n in range(1, len(CAT2IMG) + 1):
+        for cat_ids in combinations(CAT2IMG, n):
+            for excluded_ids in EXCLUDED:
+                result = bitsets.get_image_ids_intersection(cat_ids, excluded_ids)
+                expected = sets.get_image_ids_intersection(cat_ids, excluded_ids)
+                assert set(result) == expected
+                assert len(result) == len(expected)
+                assert bool(result) == bool(expected)
+                for image_id in range(9, 22):
+                    assert (image_id in result) == (image_id in expected)
+                for other in EXCLUDED:
+                    assert set(result.difference(other)) == expected - set(other)
+                remaining = expected - {12}
+                for _ in range(5 if remaining else 0):
+                    assert result.sample([12]) in remaining
@@ -0,0 +1,64 @@
+import time
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torchvision.transforms import Compose, Resize, ToTensor
+
+from label_anything.data.image_decoding import decode_image
+from label_anything.data.transforms import CustomResize
+
+
+def write_jpeg(path, width, height):
+    # smooth gradients with some noise, closer to a photo than uniform noise
+    y, x = np.mgrid[0:height, 0:width]
+    rng = np.random.default_rng(42)
+    image = np.stack(
+        [255 * x / width, 255 * y / height, 128 + 64 * np.sin(x / 17 + y / 23)], axis=-1
+    )
+    image = image + rng.normal(0, 8, image.shape)
+    Image.fromarray(image.clip(0, 255).astype(np.uint8)).save(path, quality=90)
+    return str(path)
+
+
+def full_decode(path, preprocess):
+    return preprocess(Image.open(path).convert("RGB"))
+
+
+@pytest.mark.parametrize(
+    "preprocess",
+    [
+        Compose([CustomResize(480), ToTensor()]),
+        Compose([Resize((384, 384)), ToTensor()]),
+        Compose([Resize(320), ToTensor()]),
+    ],
+)
+def test_fast_decode_matches_full_decode(tmp_path, preprocess):
+    path = write_jpeg(tmp_path / "image.jpg", 2047, 1535)
+    expected = full_decode(path, preprocess)
+    actual = preprocess(decode_image(path, preprocess))
+    assert actual.shape == expected.shape
+    assert (actual - expected).abs().mean() < 0.03
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("width,height", [(640, 480), (2048, 1536), (4000, 3000)])
+@pytest.mark.parametrize("long_side_length", [1024, 480])
+def test_decode_benchmark(tmp_path, width, height, long_side_length):
+    torch.set_num_threads(1)
+    path = write_jpeg(tmp_path / "image.jpg", width, height)
+    preprocess = Compose([CustomResize(long_side_length), ToTensor()])
+    trials = 20
+
+    for name, decode in [
+        ("full", lambda: full_decode(path, preprocess)),
+        ("fast", lambda: preprocess(decode_image(path, preprocess))),
+    ]:
+        decode()
+        start = time.time()
+        for _ in range(trials):
+            decode()
+        print(
+            f"{width}x{height} -> {long_side_length} {name}: {trials / (time.time() - start):.1f} images/s per core"
+        )
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from label_anything.data.image_fetcher import BLOBS_DIR, ImageFetcher
+
+CONTENTS = {
+    "/a.jpg": b"image a",
+    "/b.jpg": b"image b",
+    "/copy_of_a.jpg": b"image a",
+}
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # the first request of each path fails, as an overloaded server would
+    requests = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.requests[self.path] += 1
+            first = self.requests[self.path] == 1
+        if self.path not in CONTENTS:
+            self.send_error(404)
+            return
+        if first:
+            self.send_error(503)
+            return
+        data = CONTENTS[self.path]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ImageHandler.requests = Counter()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_and_cache(server, tmp_path):
+    fetcher = ImageFetcher(tmp_path, backoff_factor=0)
+    assert fetcher.get(f"{server}/a.jpg") == CONTENTS["/a.jpg"]
+    assert ImageHandler.requests["/a.jpg"] == 2
+
+    # another process reads it from the cache
+    assert ImageFetcher(tmp_path).get(f"{server}/a.jpg") == CONTENTS["/a.jpg"]
+    assert ImageHandler.requests["/a.jpg"] == 2
+
+    with pytest.raises(requests.HTTPError):
+        fetcher.get(f"{server}/missing.jpg")
+
+
+def test_no_cache(server):
+    fetcher = ImageFetcher(backoff_factor=0)
+    assert fetcher.get(f"{server}/b.jpg") == CONTENTS["/b.jpg"]
+    assert fetcher.get(f"{server}/b.jpg") == CONTENTS["/b.jpg"]
+    assert ImageHandler.requests["/b.jpg"] == 3
+
+
+def test_prefetch(server, tmp_path):
+    fetcher = ImageFetcher(tmp_path, max_connections=2, backoff_factor=0)
+    urls = [f"{server}{path}" for path in CONTENTS]
+    fetcher.prefetch(urls + urls)
+    for url, data in zip(urls, CONTENTS.values()):
+        assert fetcher.get(url) == data
+    deadline = time.time() + 5
+    while not all(fetcher.is_cached(url) for url in urls) and time.time() < deadline:
+        time.sleep(0.01)
+
+    fetcher.prefetch(urls)
+    for path in CONTENTS:
+        assert ImageHandler.requests[path] == 2
+    # identical images are stored once
+    blobs = [files for _, _, files in os.walk(tmp_path / BLOBS_DIR) if files]
+    assert sum(len(files) for files in blobs) == 2
@@ -0,0 +1,61 @@
+import numpy as np
+
+from label_anything.data.mask_cache import MaskCache
+from label_anything.data.utils import PromptType
+
+
+def mask(nbytes):
+    return np.zeros(nbytes, dtype=np.uint8)
+
+
+def test_eviction_follows_the_byte_budget():
+    cache = MaskCache(max_bytes=300)
+    for key in "abc":
+        cache.put(key, mask(100))
+    assert cache.nbytes == 300 and len(cache) == 3
+    cache.get("a")  # a is now the most recently used
+    cache.put("d", mask(100))
+    assert "b" not in cache and {"a", "c", "d"} == set(cache._masks)
+    cache.put("e", mask(200))  # evicts c then a
+    assert set(cache._masks) == {"d", "e"}
+    assert cache.nbytes == 300
+    cache.put("big", mask(301))  # larger than the budget, never cached
+    assert "big" not in cache and cache.nbytes == 300
+    assert not cache.get("d").flags.writeable
+
+
+def test_get_or_decode_counts_lookups():
+    cache = MaskCache(max_bytes=1000)
+    decoded = []
+
+    def decode(key):
+        decoded.append(key)
+        return mask(10)
+
+    for key in [1, 2, 1, 1, 3, 2]:
+        cache.get_or_decode(key, lambda: decode(key))
+    assert decoded == [1, 2, 3]
+    assert cache.stats() == {
+        "hits": 3,
+        "misses": 3,
+        "hit_rate": 0.5,
+        "entries": 3,
+        "bytes": 30,
+        "max_bytes": 1000,
+    }
+    assert cache.lookup(4) is None
+    assert (cache.hits, cache.misses) == (3, 4)
+
+
+def test_ground_truths_reuse_the_prompt_masks(coco_dataset):
+    dataset = coco_dataset(mask_cache_bytes=2**20)
+    image_ids, cat_ids = [1, 2], [1, 2, 3, 4, 5]
+    dataset._get_prompts(image_ids, cat_ids, [PromptType.MASK])
+    entries = len(dataset.mask_cache)
+    assert entries > 0 and dataset.mask_cache.hits == 0
+
+    # every annotation of the episode is found in the cache
+    dataset.compute_ground_truths(image_ids, [-1, *cat_ids])
+    assert len(dataset.mask_cache) == entries
+    assert dataset.mask_cache.hits == entries
+    assert dataset.mask_cache.misses == entries
@@ -0,0 +1,85 @@
+import pytest
+import torch
+
+from label_anything.models.common import set_masked_attention
+from label_anything.models.prompt_encoder import PromptImageEncoder, RandomMatrixEncoder
+from label_anything.models.transformer import TwoWayTransformer
+from label_anything.utils.utils import ResultDict
+
+
+def build_encoder(dim, class_encoder, size=8):
+    torch.manual_seed(0)
+    return PromptImageEncoder(
+        embed_dim=dim,
+        image_embedding_size=(size, size),
+        input_image_size=(4 * size, 4 * size),
+        mask_in_chans=16,
+        transformer=TwoWayTransformer(
+            depth=2, embedding_dim=dim, num_heads=8, mlp_dim=2 * dim
+        ),
+        class_encoder=class_encoder,
+    ).eval()
+
+
+def encoder_inputs(b, m, c, dim, size=8, seed=1):
+    torch.manual_seed(seed)
+    flag_examples = torch.ones(b, m, c, dtype=torch.long)
+    flag_examples[0, 1, 1] = 0  # missing example
+    flag_examples[-1, :, -1] = 0  # padding class
+    masks = (torch.rand(b, m, c, 4 * size, 4 * size) > 0.5).float()
+    return dict(
+        image_embeddings=torch.randn(b, m, dim, size, size),
+        points=None,
+        boxes=None,
+        masks=(masks, flag_examples),
+        flag_examples=flag_examples,
+    )
+
+
+@pytest.mark.parametrize("random_matrix", [False, True])
+@torch.no_grad()
+def test_sparse_pairs_match_padded(random_matrix):
+    if random_matrix:
+        class_encoder = RandomMatrixEncoder(bank_size=16, embed_dim=64)
+    else:
+        class_encoder = lambda x, y: (x, y)
+    encoder = set_masked_attention(build_encoder(64, class_encoder), True)
+    inputs = encoder_inputs(b=2, m=3, c=4, dim=64)
+    torch.manual_seed(2)  # same class rows for the random matrix
+    expected = encoder(**inputs)[ResultDict.CLASS_EMBS]
+    encoder.sparse_pairs = True
+    torch.manual_seed(2)
+    torch.testing.assert_close(
+        encoder(**inputs)[ResultDict.CLASS_EMBS], expected, rtol=1e-5, atol=1e-5
+    )
+
+
+@torch.no_grad()
+def test_sparse_pairs_need_masked_attention():
+    encoder = build_encoder(64, lambda x, y: (x, y))
+    encoder.sparse_pairs = True
+    with pytest.raises(ValueError):
+        encoder(**encoder_inputs(b=2, m=3, c=4, dim=64))
+
+
+def setup_encoder(num_classes):
+    encoder = build_encoder(256, lambda x, y: (x, y), size=32)
+    inputs = encoder_inputs(b=1, m=2, c=num_classes, dim=256, size=32)
+
+    @torch.no_grad()
+    def run():
+        encoder(**inputs)
+
+    return run
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("num_classes", [5, 20, 50])
+def test_prompt_encoder_memory(peak_memory, num_classes):
+    _, peak = peak_memory(setup_encoder, num_classes)
+    # one B x M x C x D x H x W float tensor, the size of each copy per class
+    pairs_size = 2 * num_classes * 256 * 32 * 32 * 4 / 2**20
+    print(
+        f"{num_classes} classes: peak memory +{peak:.0f} MiB "
+        f"({pairs_size:.0f} MiB per dense tensor)"
+    )
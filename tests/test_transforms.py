@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from pycocotools import mask as mask_utils
+
+from label_anything.data.transforms import PromptsProcessor, rle_counts
+
+
+def uncompressed_counts(mask):
+    """Run lengths of the column-major mask, starting with background."""
+    flat = mask.flatten(order="F")
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(flat)) + 1, [flat.size]])
+    counts = np.diff(bounds)
+    return np.concatenate([[0], counts]) if flat[0] else counts
+
+
+@pytest.mark.parametrize("density", [0.0, 0.01, 0.5, 0.99, 1.0])
+def test_rle_counts_match_coco(density):
+    rng = np.random.default_rng(0)
+    for h, w in [(1, 1), (7, 13), (64, 48), (300, 200)]:
+        mask = (rng.random((h, w)) < density).astype(np.uint8)
+        rle = mask_utils.encode(np.asfortranarray(mask))
+        counts = rle_counts(rle["counts"])
+        assert np.array_equal(counts, uncompressed_counts(mask))
+        assert np.array_equal(counts, rle_counts(rle["counts"].decode()))
+        # and back through the COCO API
+        decoded = mask_utils.decode(
+            mask_utils.frPyObjects({"size": [h, w], "counts": counts.tolist()}, h, w)
+        )
+        assert np.array_equal(decoded, mask)
+
+
+def test_sampled_points_are_in_the_mask(coco_instances):
+    _, instances = coco_instances
+    processor = PromptsProcessor()
+    images = {x["id"]: x for x in instances["images"]}
+    np.random.seed(0)
+    for ann in instances["annotations"]:
+        h, w = images[ann["image_id"]]["height"], images[ann["image_id"]]["width"]
+        segmentation = ann["segmentation"]
+        mask = processor.convert_mask(segmentation, h, w)
+        points = processor.sample_points(segmentation, h, w, num_points=200)
+        assert points.shape == (200, 2)
+        x, y = points[:, 0], points[:, 1]
+        assert mask[y, x].all()
+
+        # the runs cover the mask, empty ones included (the pixel set by convert_mask)
+        starts, lengths = processor.rle_runs(segmentation, h, w)
+        expected = np.flatnonzero(mask.flatten(order="F"))
+        positions = np.concatenate(
+            [np.arange(s, s + n) for s, n in zip(starts, lengths)]
+        )
+        assert np.array_equal(positions, expected)